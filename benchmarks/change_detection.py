@@ -0,0 +1,106 @@
+"""
+Measures the time the default pipeline (``'O2'``) takes on large generated functions
+with the fixed point detected by identity (as ``PassManager`` does),
+and with the structural comparison of the whole tree after every iteration
+(as ``optimized_ast()`` did before), along with the time of the comparisons themselves.
+
+Usage (from the repository root):
+
+    PYTHONPATH=. python benchmarks/change_detection.py [max_blocks]
+"""
+
+import sys
+import time
+
+from peval.tools import ast_equal, immutablechainmap
+from peval.core.function import Function
+from peval.highlevelapi import OPTIMIZATION_LEVELS, make_pass_manager
+
+
+def make_source(blocks):
+    # Every block has a foldable condition and a dead branch,
+    # so the passes take several iterations to converge.
+    lines = ["def func(x):", "    total = 0"]
+    for block in range(blocks):
+        lines.append("    a{block} = x + C{block}".format(block=block))
+        lines.append("    if C{block} > one:".format(block=block))
+        lines.append("        b{block} = a{block} * one".format(block=block))
+        lines.append("    else:")
+        lines.append("        b{block} = a{block} - one".format(block=block))
+        lines.append("    total = total + b{block}".format(block=block))
+    lines.append("    return total")
+    return "\n".join(lines)
+
+
+def make_function(blocks):
+    source = make_source(blocks)
+    # Using globals instead of literals to support Python versions
+    # where numbers are represented by ``Constant`` nodes.
+    globals_ = dict(('C' + str(block), block) for block in range(blocks))
+    globals_['one'] = 1
+    exec(source, globals_)
+    func = globals_['func']
+    func._peval_source = source
+    return Function.from_object(func)
+
+
+def run_identity(tree, constants):
+    return make_pass_manager('O2').run(tree, constants)
+
+
+def run_structural(tree, constants, comparison_time):
+    # The fixed point loop of ``optimized_ast()`` before the change detection by identity
+    passes = [pass_ for _, pass_ in OPTIMIZATION_LEVELS['O2']]
+    while True:
+        new_tree = tree
+        new_constants = constants
+        for pass_ in passes:
+            new_tree, new_constants = pass_(new_tree, new_constants)
+
+        start = time.time()
+        equal = ast_equal(new_tree, tree)
+        comparison_time[0] += time.time() - start
+
+        tree = new_tree
+        constants = new_constants
+        if equal:
+            return tree, constants
+
+
+def run(blocks, repetitions=3):
+    function = make_function(blocks)
+    bindings = immutablechainmap(function.get_external_variables())
+
+    # Warming up the caches of the passes
+    run_identity(function.tree, bindings)
+
+    start = time.time()
+    for _ in range(repetitions):
+        run_identity(function.tree, bindings)
+    identity_time = (time.time() - start) / repetitions
+
+    comparison_time = [0.]
+    start = time.time()
+    for _ in range(repetitions):
+        run_structural(function.tree, bindings, comparison_time)
+    structural_time = (time.time() - start) / repetitions
+
+    return identity_time, structural_time, comparison_time[0] / repetitions
+
+
+def main():
+    max_blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print("statements    identity (ms)    structural (ms)    comparisons (ms)")
+    blocks = 25
+    while blocks <= max_blocks:
+        identity_time, structural_time, comparison_time = run(blocks)
+        print(
+            "{statements:10}    {identity:13.2f}    {structural:15.2f}    {comparisons:16.2f}"
+            .format(
+                statements=blocks * 5 + 2, identity=identity_time * 1000,
+                structural=structural_time * 1000, comparisons=comparison_time * 1000))
+        blocks *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Measures the time ``fold`` takes to converge on functions with deeply nested loops,
+and the number of statement transfers it performs.
+
+Usage (from the repository root):
+
+    PYTHONPATH=. python benchmarks/fold_nested_loops.py [max_depth]
+"""
+
+import sys
+import time
+
+from peval.tools import immutablechainmap
+from peval.core.function import Function
+from peval.components import fold as fold_module
+
+
+def make_source(depth):
+    # Every loop reads a variable at the start of its body
+    # and reassigns it after the inner loop, so the information
+    # has to be propagated along the back edges of all the loops.
+    lines = ["def func(x):"]
+    for level in range(depth):
+        lines.append("    a{level} = C{level}".format(level=level))
+    for level in range(depth):
+        indent = "    " * (level + 1)
+        lines.append(indent + "for i{level} in range(x):".format(level=level))
+        lines.append(indent + "    t{level} = a{level} + one".format(level=level))
+        lines.append(indent + "    if t{level} > x:".format(level=level))
+        lines.append(indent + "        continue")
+    for level in reversed(range(depth)):
+        indent = "    " * (level + 2)
+        lines.append(indent + "a{level} = t{level} + a{next}".format(
+            level=level, next=(level + 1) % depth))
+    lines.append("    return a0")
+    return "\n".join(lines)
+
+
+def make_function(depth):
+    source = make_source(depth)
+    # Using globals instead of literals to support Python versions
+    # where numbers are represented by ``Constant`` nodes.
+    globals_ = dict(('C' + str(level), level) for level in range(depth))
+    globals_['one'] = 1
+    exec(source, globals_)
+    func = globals_['func']
+    func._peval_source = source
+    return Function.from_object(func)
+
+
+def run(depth, repetitions=10):
+    function = make_function(depth)
+    bindings = immutablechainmap(function.get_external_variables())
+
+    transfers = [0]
+    original_transfer = fold_module.forward_transfer
+    def counting_transfer(*args):
+        transfers[0] += 1
+        return original_transfer(*args)
+
+    fold_module.forward_transfer = counting_transfer
+    try:
+        start = time.time()
+        for _ in range(repetitions):
+            fold_module.fold(function.tree, bindings)
+        elapsed = (time.time() - start) / repetitions
+    finally:
+        fold_module.forward_transfer = original_transfer
+
+    return elapsed, transfers[0] // repetitions
+
+
+def main():
+    max_depth = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    print("depth    time (ms)    transfers")
+    for depth in range(1, max_depth + 1):
+        elapsed, transfers = run(depth)
+        print("{depth:5}    {time:9.2f}    {transfers:9}".format(
+            depth=depth, time=elapsed * 1000, transfers=transfers))
+
+
+if __name__ == '__main__':
+    main()
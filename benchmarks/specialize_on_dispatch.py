@@ -0,0 +1,69 @@
+"""
+Measures the overhead of the dispatchers created by ``specialize_on``
+compared to calling the specialized variant directly.
+
+Usage (from the repository root):
+
+    PYTHONPATH=. python benchmarks/specialize_on_dispatch.py [number]
+"""
+
+import sys
+import timeit
+
+from peval import specialize_on
+
+
+def power(n, x):
+    v = 1
+    for _ in range(n):
+        v = v * x
+    return v
+
+
+def power_varargs(n, x, *args):
+    v = 1
+    for _ in range(n):
+        v = v * x
+    return v
+
+
+def run(number):
+    # A signature with only positional-or-keyword parameters gets the generated dispatcher,
+    # the rest go through the generic one that rebinds the arguments.
+    fast = specialize_on('n')(power)
+    slow = specialize_on('n')(power_varargs)
+    megamorphic = specialize_on('n', max_variants=0)(power)
+
+    fast(3, 2)
+    slow(3, 2)
+    variant = fast.variants[next(iter(fast.variants))]
+
+    cases = [
+        ("original function", lambda: power(3, 2)),
+        ("variant (direct call)", lambda: variant(2)),
+        ("dispatcher", lambda: fast(3, 2)),
+        ("dispatcher (keywords)", lambda: fast(n=3, x=2)),
+        ("dispatcher (varargs)", lambda: slow(3, 2)),
+        ("dispatcher (no variant)", lambda: megamorphic(3, 2)),
+        ]
+
+    baseline = None
+    results = []
+    for name, call in cases:
+        elapsed = min(timeit.repeat(call, number=number, repeat=5)) / number
+        if baseline is None:
+            baseline = elapsed
+        results.append((name, elapsed, elapsed / baseline))
+    return results
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print("call                         time (ns)    relative")
+    for name, elapsed, relative in run(number):
+        print("{name:25}    {time:9.1f}    {relative:8.2f}".format(
+            name=name, time=elapsed * 1e9, relative=relative))
+
+
+if __name__ == '__main__':
+    main()
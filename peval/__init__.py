@@ -1 +1,3 @@
-from peval.highlevelapi import partial_eval, partial_apply
+from peval.highlevelapi import (
+    partial_eval, partial_apply, specialize, specialize_on, specialization_cache,
+    make_pass_manager, default_pass_manager)
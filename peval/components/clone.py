@@ -0,0 +1,142 @@
+"""
+Call-site cloning of the functions marked with :py:func:`~peval.tags.clone`.
+"""
+
+import ast
+import inspect
+import sys
+import threading
+
+import funcsigs
+
+from peval.tags import is_clone
+from peval.wisdom import is_resumable
+from peval.core.value import value_to_node
+from peval.core.expression import try_peval_expression
+from peval.core.gensym import GenSym
+from peval.tools import ast_walker, replace_fields
+
+
+# The state of the cloning in the current thread:
+# ``cloning`` is the list of the functions the clones of which are being created at the moment
+# (used to limit the depth of cloning of recursive functions).
+_local = threading.local()
+
+
+def _cloning():
+    if not hasattr(_local, 'cloning'):
+        _local.cloning = []
+    return _local.cloning
+
+
+def clone_functions(tree, constants, max_depth=4):
+    """
+    Replaces the calls to the functions marked with :py:func:`~peval.tags.clone`
+    that have some of the arguments known by the calls to the versions of these functions
+    specialized for the known arguments (using :py:func:`~peval.specialize`
+    with the pass manager of the function being specialized,
+    so the clones with the same known arguments are cached and shared between the call sites).
+    The remaining arguments are passed by keyword,
+    except for the positional-only ones.
+
+    :param max_depth: the maximum depth of cloning the functions
+        that call themselves (directly or through other cloned functions).
+    """
+    gen_sym = GenSym.for_tree(tree)
+    new_tree, state = _clone_functions_walker(
+        tree, state=dict(gen_sym=gen_sym, new_bindings={}), ctx=dict(
+            constants=constants, max_depth=max_depth))
+
+    if new_tree is tree:
+        return tree, constants
+    else:
+        return new_tree, constants.update(state.new_bindings)
+
+
+def _bind_arguments(call, fn, constants):
+    """
+    Returns a tuple ``(known_values, unknown_args)``, where ``known_values``
+    is a dictionary of the parameter names and the values of the known arguments,
+    and ``unknown_args`` is a list of pairs ``(parameter, node)`` for the rest of the arguments
+    (in the order of evaluation);
+    or ``None`` if the call cannot be cloned.
+    """
+    if (getattr(call, 'starargs', None) is not None
+            or getattr(call, 'kwargs', None) is not None
+            or (sys.version_info >= (3, 5) and any(type(arg) == ast.Starred for arg in call.args))
+            or any(keyword.arg is None for keyword in call.keywords)):
+        return None
+
+    signature = funcsigs.signature(fn)
+    try:
+        bound = signature.bind(
+            *call.args, **dict((keyword.arg, keyword.value) for keyword in call.keywords))
+    except TypeError:
+        return None
+
+    params = {}
+    for name, arg in bound.arguments.items():
+        param = signature.parameters[name]
+        if param.kind in (funcsigs.Parameter.VAR_POSITIONAL, funcsigs.Parameter.VAR_KEYWORD):
+            # Packed arguments are not supported
+            return None
+        params[id(arg)] = param
+
+    known_values = {}
+    unknown_args = []
+    for arg in list(call.args) + [keyword.value for keyword in call.keywords]:
+        param = params[id(arg)]
+        evaluated, value = try_peval_expression(arg, constants)
+        if evaluated and param.kind != funcsigs.Parameter.POSITIONAL_ONLY:
+            known_values[param.name] = value
+        else:
+            unknown_args.append((param, arg))
+
+    return known_values, unknown_args
+
+
+def _specialize(fn, known_values):
+    # ``peval.highlevelapi`` uses this module, so it cannot be imported at the top level.
+    from peval.highlevelapi import specialize, _current_pass_manager
+
+    cloning = _cloning()
+    cloning.append(fn)
+    try:
+        return specialize(fn, kwds=known_values, pass_manager=_current_pass_manager())
+    finally:
+        cloning.pop()
+
+
+@ast_walker
+class _clone_functions_walker:
+
+    @staticmethod
+    def handle_Call(node, state, ctx, **kwds):
+        evaluated, fn = try_peval_expression(node.func, ctx.constants)
+        if (not evaluated or not inspect.isfunction(fn) or not is_clone(fn)
+                or is_resumable(fn) or _cloning().count(fn) >= ctx.max_depth):
+            return node, state
+
+        result = _bind_arguments(node, fn, ctx.constants)
+        if result is None:
+            return node, state
+        known_values, unknown_args = result
+        if len(known_values) == 0:
+            return node, state
+
+        new_fn = _specialize(fn, known_values)
+
+        new_func, gen_sym, binding = value_to_node(new_fn, state.gen_sym)
+        new_bindings = dict(state.new_bindings)
+        new_bindings.update(binding)
+
+        args = []
+        keywords = []
+        for param, arg in unknown_args:
+            if param.kind == funcsigs.Parameter.POSITIONAL_ONLY:
+                args.append(arg)
+            else:
+                keywords.append(ast.keyword(arg=param.name, value=arg))
+
+        new_node = replace_fields(node, func=new_func, args=args, keywords=keywords)
+        return new_node, state.update(gen_sym=gen_sym, new_bindings=new_bindings)
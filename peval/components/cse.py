@@ -0,0 +1,418 @@
+"""
+Common subexpression elimination.
+"""
+
+import ast
+
+from peval.wisdom import is_known_pure
+from peval.core.cfg import build_cfg
+from peval.core.expression import try_peval_expression
+from peval.core.gensym import GenSym
+from peval.core.symbol_finder import find_symbol_creations, find_unassigned_usages
+from peval.components.licm import (
+    _INVARIANT_TYPES, _AUXILIARY_TYPES, _TRIVIAL_TYPES, _unconditional_children, _can_raise)
+from peval.tools import ast_transformer, replace_fields
+
+
+COMMON_TAG = 'common'
+
+ANN_ASSIGN = getattr(ast, 'AnnAssign', None)
+
+
+# Nodes that make the function ineligible: nested scopes and ``global``/``nonlocal``
+# declarations let the calls change the local variables, suspensions let the outside code
+# mutate anything, the exceptions can leave a statement before the temporary variable
+# is assigned and still be caught by a handler (or suppressed by a context manager),
+# and assignment expressions change the variables in the middle of a statement.
+_FORBIDDEN_NODES = tuple(
+    getattr(ast, name) for name in (
+        'FunctionDef', 'AsyncFunctionDef', 'ClassDef', 'Lambda',
+        'Global', 'Nonlocal', 'Yield', 'YieldFrom', 'Await',
+        'Try', 'TryStar', 'TryExcept', 'TryFinally', 'With', 'AsyncWith', 'AsyncFor',
+        'Match', 'NamedExpr', 'Exec')
+    if hasattr(ast, name))
+
+# Nested scopes that can appear in an expression; the names in them may refer
+# to their own variables, so the subexpressions inside are not replaced.
+_SCOPE_NODES = tuple(
+    getattr(ast, name) for name in ('GeneratorExp', 'ListComp', 'SetComp', 'DictComp', 'Lambda')
+    if hasattr(ast, name))
+
+# The statements that can have the temporary variable assigned right before them
+# (the loop headers are evaluated on every iteration).
+_GENERATING_TYPES = tuple(
+    stmt_type for stmt_type in (
+        ast.Assign, ast.AugAssign, ANN_ASSIGN, ast.Expr, ast.Return, ast.If)
+    if stmt_type is not None)
+
+
+def eliminate_common_subexpressions(tree, constants):
+    """
+    Saves the values of the pure expressions that are evaluated more than once
+    in temporary variables, and reuses them.
+
+    The available expressions are found by a dataflow analysis
+    over the control flow graph of the function (the same one ``fold`` uses).
+    An expression computed by a statement is available in another statement
+    if it is computed on every path leading to it, and none of the variables it uses
+    are assigned on the way. The expressions reading the state of objects
+    (attributes, items, and calls to functions known to be pure,
+    see :py:func:`~peval.wisdom.is_known_pure`) are invalidated by any statement
+    that can mutate an object (calls to other functions, augmented assignments,
+    or assignments to attributes and items). The expressions are compared syntactically,
+    and the values known at compile time are left to ``fold``.
+
+    The first computation of an expression is moved to a temporary variable
+    assigned right before the statement it is in. So that the exceptions are raised
+    in the same order (and the side effects happen before them), this is only done
+    for the expressions containing the first evaluation in the statement that can raise
+    (that is, the ones that nothing outside of them can raise before).
+    """
+    for node in ast.walk(tree):
+        if node is not tree and isinstance(node, _FORBIDDEN_NODES):
+            return tree, constants
+
+    cfg = build_cfg(tree.body)
+    graph = cfg.graph
+    order = graph.reverse_postorder(cfg.enter)
+
+    # The names of the local variables that are assigned before every statement
+    assigned_before = {}
+    find_unassigned_usages(tree.body, find_symbol_creations(tree.args), assigned_before)
+    local_names = find_symbol_creations(tree)
+
+    statements = {}
+    for node_id in order:
+        node = graph._nodes[node_id].ast_node
+        statements[node_id] = _StatementInfo(
+            node, constants, assigned_before.get(id(node), frozenset()), local_names)
+    available = _available_expressions(graph, order, statements)
+
+    # For every use of an available expression, choosing the earliest computation:
+    # since the computations along every path to the use are valid,
+    # they all dominate it, and the earliest of them is not a reuse itself.
+    index = dict((node_id, i) for i, node_id in enumerate(order))
+    uses = {}
+    temps = {}
+    for node_id in order:
+        statement = statements[node_id]
+        sources = {}
+        for key, source_id in available[node_id]:
+            if key not in sources or index[source_id] < index[sources[key]]:
+                sources[key] = source_id
+        used = set()
+        for _, expr in statement.fields:
+            _find_uses(expr, statement, sources, used)
+        uses[node_id] = dict((key, sources[key]) for key in used)
+        for key in used:
+            temps[(key, sources[key])] = None
+
+        # The expressions computed more than once in the statement itself
+        counts = dict((key, 0) for key in statement.exprs if key not in sources)
+        for _, expr in statement.fields:
+            _count_computations(expr, sources, counts)
+        for key, count in counts.items():
+            if count > 1:
+                temps[(key, node_id)] = None
+
+    if len(temps) == 0:
+        return tree, constants
+
+    gen_sym = GenSym.for_tree(tree)
+    for node_id in order:
+        for key in statements[node_id].order:
+            if (key, node_id) in temps:
+                name, gen_sym = gen_sym(COMMON_TAG)
+                temps[(key, node_id)] = name
+
+    rewrites = {}
+    for node_id in order:
+        statement = statements[node_id]
+        names = dict((key, temps[(key, source_id)]) for key, source_id in uses[node_id].items())
+
+        prelude = []
+        for key in statement.order:
+            name = temps.get((key, node_id))
+            if name is None:
+                continue
+            # The temporaries for the subexpressions are assigned first
+            value = _replace_expressions(statement.exprs[key], ctx=dict(names=names))
+            prelude.append(ast.Assign(targets=[ast.Name(id=name, ctx=ast.Store())], value=value))
+            names[key] = name
+
+        if len(names) == 0:
+            continue
+
+        fields = dict(
+            (field, _replace_expressions(expr, ctx=dict(names=names)))
+            for field, expr in statement.fields)
+        rewrites[id(statement.node)] = (prelude, fields)
+
+    new_tree = _rewrite_statements(tree, ctx=dict(rewrites=rewrites))
+    return new_tree, constants
+
+
+class _StatementInfo:
+    """
+    The properties of a statement (or of a header of a compound statement)
+    relevant to the availability of expressions.
+    """
+
+    def __init__(self, node, constants, assigned_names, local_names):
+        self.node = node
+
+        stmt_type = type(node)
+        if stmt_type in (ast.Assign, ast.AugAssign, ANN_ASSIGN, ast.Expr, ast.Return):
+            header = [node]
+            self.fields = [('value', node.value)] if node.value is not None else []
+        elif stmt_type in (ast.If, ast.While):
+            header = [node.test]
+            self.fields = [('test', node.test)]
+        elif stmt_type == ast.For:
+            header = [node.target, node.iter]
+            self.fields = [('iter', node.iter)]
+        elif stmt_type in (ast.Break, ast.Continue, ast.Pass):
+            header = []
+            self.fields = []
+        else:
+            header = [node]
+            self.fields = []
+
+        self.assigned_names = find_symbol_creations(header)
+        self.mutating = stmt_type in (ast.AugAssign, ast.Delete) or any(
+            _is_mutation(subnode, constants) for part in header for subnode in ast.walk(part))
+
+        # The candidate expressions, keyed by their dumps
+        self.constants = constants
+        self.exprs = {}
+        self.infos = {}
+        if stmt_type in _GENERATING_TYPES:
+            for _, expr in self.fields:
+                self._find_computed(expr)
+
+        # Only the expressions that nothing else in the statement can raise before
+        # can be moved before it.
+        if len(self.exprs) > 0:
+            first = None
+            for _, expr in self.fields:
+                first = _first_raising(expr, assigned_names, local_names, constants)
+                if first is not None:
+                    break
+            if first is not None:
+                movable = set(
+                    key for key, expr in self.exprs.items()
+                    if any(subnode is first for subnode in ast.walk(expr)))
+                self.exprs = dict(
+                    (key, expr) for key, expr in self.exprs.items() if key in movable)
+                self.infos = dict(
+                    (key, info) for key, info in self.infos.items() if key in movable)
+
+        # The keys in the order of evaluation (the subexpressions first)
+        self.order = []
+        for _, expr in self.fields:
+            for subnode in _postorder(expr):
+                if isinstance(subnode, ast.expr):
+                    key = ast.dump(subnode)
+                    if key in self.exprs and key not in self.order:
+                        self.order.append(key)
+
+    def candidate_info(self, node):
+        """
+        Returns a tuple ``(names, reads_objects)`` if ``node`` is an expression
+        that can be reused in this statement, or ``None`` otherwise.
+        """
+        if not isinstance(node, ast.expr) or isinstance(node, _TRIVIAL_TYPES):
+            return None
+
+        names = set()
+        reads_objects = False
+        for subnode in ast.walk(node):
+            if isinstance(subnode, _AUXILIARY_TYPES):
+                continue
+            if not isinstance(subnode, _INVARIANT_TYPES):
+                return None
+            if type(subnode) == ast.Name:
+                names.add(subnode.id)
+            elif type(subnode) == ast.Call:
+                evaluated, fn = try_peval_expression(subnode.func, self.constants)
+                if not evaluated or not is_known_pure(fn):
+                    return None
+                reads_objects = True
+            elif type(subnode) in (ast.Attribute, ast.Subscript):
+                reads_objects = True
+
+        # If the statement mutates an object, it may happen before the expression is evaluated.
+        if reads_objects and self.mutating:
+            return None
+
+        # Expressions with known values are left to ``fold``
+        evaluated, _ = try_peval_expression(node, self.constants)
+        if evaluated:
+            return None
+
+        return names, reads_objects
+
+    def _find_computed(self, node):
+        # Finds the candidate expressions evaluated every time ``node`` is evaluated
+        info = self.candidate_info(node)
+        if info is not None:
+            key = ast.dump(node)
+            self.exprs.setdefault(key, node)
+            self.infos[key] = info
+        for child in _unconditional_children(node):
+            if isinstance(child, ast.expr):
+                self._find_computed(child)
+
+    def kills(self, info):
+        names, reads_objects = info
+        return (reads_objects and self.mutating) or not self.assigned_names.isdisjoint(names)
+
+
+def _first_raising(node, assigned_names, local_names, constants):
+    """
+    Returns the first node in the order of evaluation of ``node``
+    which can raise an exception, or ``None`` if there is none.
+    If some of the subexpressions that may or may not be evaluated can raise,
+    the node containing them is returned instead.
+    """
+    if type(node) == ast.BoolOp:
+        unconditional = node.values[:1]
+    elif type(node) == ast.IfExp:
+        unconditional = [node.test]
+    elif isinstance(node, _SCOPE_NODES):
+        return node
+    else:
+        unconditional = list(ast.iter_child_nodes(node))
+
+    for child in unconditional:
+        first = _first_raising(child, assigned_names, local_names, constants)
+        if first is not None:
+            return first
+
+    for child in ast.iter_child_nodes(node):
+        if child not in unconditional and any(
+                _can_raise(subnode, assigned_names, local_names, constants)
+                for subnode in ast.walk(child)):
+            return node
+
+    if _can_raise(node, assigned_names, local_names, constants):
+        return node
+    return None
+
+
+def _is_mutation(node, constants):
+    if type(node) in (ast.Attribute, ast.Subscript) and type(node.ctx) != ast.Load:
+        return True
+    if type(node) == ast.Call:
+        evaluated, fn = try_peval_expression(node.func, constants)
+        return not evaluated or not is_known_pure(fn)
+    return False
+
+
+def _postorder(node):
+    for child in ast.iter_child_nodes(node):
+        if not isinstance(child, _SCOPE_NODES):
+            for subnode in _postorder(child):
+                yield subnode
+    yield node
+
+
+def _available_expressions(graph, order, statements):
+    """
+    Returns a dictionary mapping node ids to the sets of pairs ``(key, node_id)``
+    of the expressions available before the statement, and the statements computing them.
+    """
+    infos = {}
+    for statement in statements.values():
+        infos.update(statement.infos)
+
+    # ``None`` stands for the set of all expressions (nothing is known about the node yet)
+    in_sets = dict((node_id, None) for node_id in order)
+    out_sets = dict((node_id, None) for node_id in order)
+    in_sets[order[0]] = frozenset()
+
+    changed = True
+    while changed:
+        changed = False
+        for node_id in order:
+            if node_id != order[0]:
+                parent_sets = [
+                    out_sets[parent_id] for parent_id in graph.parents_of(node_id)
+                    if out_sets.get(parent_id) is not None]
+                if len(parent_sets) == 0:
+                    continue
+                in_set = frozenset.intersection(*parent_sets)
+                in_sets[node_id] = in_set
+            else:
+                in_set = in_sets[node_id]
+
+            statement = statements[node_id]
+            generated = set(in_set)
+            generated.update((key, node_id) for key in statement.exprs)
+            out_set = frozenset(
+                (key, source_id) for key, source_id in generated
+                if not statement.kills(infos[key]))
+            if out_set != out_sets[node_id]:
+                out_sets[node_id] = out_set
+                changed = True
+
+    return dict((node_id, in_sets[node_id] or frozenset()) for node_id in order)
+
+
+def _find_uses(node, statement, sources, used):
+    # Finds the maximal available expressions in ``node``
+    if isinstance(node, _SCOPE_NODES):
+        return
+    if isinstance(node, ast.expr):
+        key = ast.dump(node)
+        if key in sources and statement.candidate_info(node) is not None:
+            used.add(key)
+            return
+    for child in ast.iter_child_nodes(node):
+        _find_uses(child, statement, sources, used)
+
+
+def _count_computations(node, sources, counts):
+    # Counts the occurrences of the expressions in ``counts``,
+    # except for the ones inside the available expressions from ``sources``.
+    if isinstance(node, _SCOPE_NODES):
+        return
+    if isinstance(node, ast.expr):
+        key = ast.dump(node)
+        if key in sources:
+            return
+        if key in counts:
+            counts[key] += 1
+    for child in ast.iter_child_nodes(node):
+        _count_computations(child, sources, counts)
+
+
+@ast_transformer
+def _replace_expressions(node, ctx, skip_fields, **kwds):
+    if isinstance(node, _SCOPE_NODES):
+        skip_fields()
+        return node
+    if isinstance(node, ast.expr) and not isinstance(node, _TRIVIAL_TYPES):
+        name = ctx.names.get(ast.dump(node))
+        if name is not None:
+            return ast.Name(id=name, ctx=ast.Load())
+    return node
+
+
+@ast_transformer
+def _rewrite_statements(node, ctx, walk_field, skip_fields, **kwds):
+    if id(node) not in ctx.rewrites:
+        return node
+
+    prelude, fields = ctx.rewrites[id(node)]
+    new_fields = dict(fields)
+    for attr, value in ast.iter_fields(node):
+        if attr not in fields:
+            new_fields[attr] = walk_field(value, block_context=attr in ('body', 'orelse'))
+    skip_fields()
+
+    new_node = replace_fields(node, **new_fields)
+    if len(prelude) > 0:
+        return prelude + [new_node]
+    else:
+        return new_node
@@ -0,0 +1,423 @@
+"""
+Compile-time execution of ``while`` loops whose state is fully known.
+"""
+
+import ast
+import time
+
+from peval.core.gensym import GenSym
+from peval.core.value import value_to_node
+from peval.core.expression import BIN_OPS, try_call, try_peval_expression, find_mutated_names
+from peval.core.symbol_finder import find_symbol_creations
+from peval.components.unfold import find_loop_prefixes
+from peval.tools import ast_walker, immutablechainmap
+from peval.wisdom import is_immutable_value
+
+
+# The maximum total number of loop iterations executed for a single loop.
+DEFAULT_MAX_ITERATIONS = 10000
+
+# Expressions that always create a new object.
+# Only the containers created by them (in the loop or directly before it)
+# can be mutated during the execution.
+FRESH_CONTAINER_NODES = (ast.List, ast.Dict, ast.Set, ast.ListComp, ast.DictComp, ast.SetComp)
+
+# Mutating methods of containers that can be called during the execution.
+MUTATING_METHODS = {
+    list: ('append', 'extend', 'insert', 'pop', 'remove', 'reverse', 'sort', 'clear'),
+    dict: ('update', 'setdefault', 'pop', 'clear'),
+    set: ('add', 'update', 'discard', 'remove', 'clear'),
+    }
+
+# The types of iterables ``for`` loops can iterate over during the execution.
+ITERABLE_TYPES = (tuple, list, dict, set, frozenset, str, bytes, range)
+
+
+class _CannotExecute(Exception):
+    pass
+
+
+class _Break(Exception):
+    pass
+
+
+class _Continue(Exception):
+    pass
+
+
+def execute_loops(
+        tree, constants, max_iterations=DEFAULT_MAX_ITERATIONS, max_time=None):
+    """
+    Executes ``while`` loops with all the variables they read known at compile time,
+    replacing them with the assignments of the final values of the variables they changed.
+
+    The values known at the loop entry are taken from the assignments directly preceding
+    the loop in the same block, and from the globals.
+    Expressions are evaluated with the same purity and mutation policies
+    as in :py:func:`~peval.components.fold.fold`.
+    In addition, lists, dictionaries and sets created by literals or comprehensions
+    (in the loop, or directly before it) can be mutated by assigning to their elements
+    and by calling their mutating methods.
+    Containers are only assigned after the loop if they consist of immutable values,
+    and they are copied on assignment, so that every call of the function gets a new object.
+
+    Only assignments, expression statements, ``if``, ``for``, ``while``, ``break``,
+    ``continue`` and ``pass`` can be executed.
+    A loop is left unchanged if it contains any other statements,
+    or its execution takes more than ``max_iterations`` iterations (of all nested loops in total)
+    or (if ``max_time`` is given) more than ``max_time`` seconds.
+    The time limit is off by default, since with it the result of the specialization
+    would depend on the load of the machine.
+
+    To use non-default parameters in a pass manager,
+    register ``functools.partial(execute_loops, max_iterations=..., max_time=...)``.
+    """
+
+    # Local variables shadow the globals with the same names,
+    # so their values are not known in general.
+    external_constants = constants
+    for name in find_symbol_creations(tree):
+        external_constants = external_constants.del_(name)
+
+    # Neither are the values of mutable objects the function can change
+    # (outside of the executed loop), since the changes are not tracked.
+    mutated_names = find_mutated_names(tree, constants)
+    for name in mutated_names:
+        if name in external_constants and not is_immutable_value(external_constants[name]):
+            external_constants = external_constants.del_(name)
+
+    prefixes = {}
+    find_loop_prefixes(tree.body, prefixes)
+
+    gen_sym = GenSym.for_tree(tree)
+    new_tree, state = _execute_loops_walker(
+        tree,
+        state=dict(gen_sym=gen_sym, new_bindings={}),
+        ctx=dict(
+            prefixes=prefixes, external_constants=external_constants,
+            mutated_names=mutated_names, max_iterations=max_iterations, max_time=max_time))
+
+    if new_tree is tree:
+        return tree, constants
+    else:
+        return new_tree, constants.update(state.new_bindings)
+
+
+class _LoopExecutor(object):
+    """
+    Executes statements on a dictionary of known values of local variables ``env``.
+    ``owned`` is the set of names of variables referring to containers
+    created during the execution, which can be mutated.
+    Raises ``_CannotExecute`` if a statement cannot be executed at compile time.
+    """
+
+    def __init__(self, env, owned, external_constants, max_iterations, max_time):
+        self.env = env
+        self.owned = owned
+        self.external_constants = external_constants
+        self.iterations_left = max_iterations
+        self.deadline = None if max_time is None else time.time() + max_time
+
+        # The names of variables assigned or mutated during the execution
+        self.changed = set()
+
+    def _evaluate(self, node):
+        evaluated, value = try_peval_expression(
+            node, immutablechainmap(self.env, self.external_constants), create_containers=True)
+        if not evaluated:
+            raise _CannotExecute()
+        return value
+
+    def _truth(self, node):
+        success, value = try_call(bool, args=(self._evaluate(node),))
+        if not success:
+            raise _CannotExecute()
+        return value
+
+    def _next_iteration(self):
+        self.iterations_left -= 1
+        if self.iterations_left < 0 or (
+                self.deadline is not None and time.time() > self.deadline):
+            raise _CannotExecute()
+
+    def _owned_container(self, node):
+        # Returns the container the node refers to, if it can be mutated.
+        if type(node) != ast.Name or node.id not in self.owned:
+            raise _CannotExecute()
+        self.changed.add(node.id)
+        return self.env[node.id]
+
+    def _assign(self, target, value, value_node=None):
+        target_type = type(target)
+
+        if target_type == ast.Name:
+            self.env[target.id] = value
+            self.changed.add(target.id)
+            if type(value_node) in FRESH_CONTAINER_NODES:
+                self.owned.add(target.id)
+            else:
+                # The value may be referenced from elsewhere
+                self.owned.discard(target.id)
+
+        elif target_type in (ast.Tuple, ast.List):
+            if type(value) not in (tuple, list) or len(value) != len(target.elts):
+                raise _CannotExecute()
+            for elt, elt_value in zip(target.elts, value):
+                self._assign(elt, elt_value)
+
+        elif target_type == ast.Subscript:
+            container = self._owned_container(target.value)
+            key = self._evaluate(target.slice)
+            try:
+                container[key] = value
+            except Exception:
+                raise _CannotExecute()
+
+        else:
+            raise _CannotExecute()
+
+    def _augmented_value(self, op, left, right):
+        success, value = try_call(BIN_OPS[type(op)].value, args=(left, right))
+        if not success:
+            raise _CannotExecute()
+        return value
+
+    def _call_mutating_method(self, call):
+        # Executes ``name.method(args)`` for a container ``name`` created during the execution.
+        if (type(call) != ast.Call or type(call.func) != ast.Attribute
+                or len(call.keywords) > 0
+                or any(type(arg) == ast.Starred for arg in call.args)):
+            raise _CannotExecute()
+        container = self._owned_container(call.func.value)
+        if call.func.attr not in MUTATING_METHODS.get(type(container), ()):
+            raise _CannotExecute()
+
+        args = [self._evaluate(arg) for arg in call.args]
+        try:
+            getattr(container, call.func.attr)(*args)
+        except Exception:
+            raise _CannotExecute()
+
+    def execute_block(self, statements):
+        for statement in statements:
+            self.execute(statement)
+
+    def execute(self, statement):
+        stmt_type = type(statement)
+
+        if stmt_type == ast.Assign:
+            value = self._evaluate(statement.value)
+            for target in statement.targets:
+                self._assign(target, value, value_node=statement.value)
+
+        elif stmt_type == ast.AugAssign:
+            target = statement.target
+            right = self._evaluate(statement.value)
+            if type(target) == ast.Name:
+                # For mutable values ``x op= y`` is an in-place operation,
+                # which is not the same as ``x = x op y``.
+                left = self._evaluate(target)
+                if not is_immutable_value(left):
+                    raise _CannotExecute()
+                self._assign(target, self._augmented_value(statement.op, left, right))
+            elif type(target) == ast.Subscript:
+                container = self._owned_container(target.value)
+                key = self._evaluate(target.slice)
+                try:
+                    left = container[key]
+                except Exception:
+                    raise _CannotExecute()
+                if not is_immutable_value(left):
+                    raise _CannotExecute()
+                container[key] = self._augmented_value(statement.op, left, right)
+            else:
+                raise _CannotExecute()
+
+        elif stmt_type == ast.Expr:
+            evaluated, _ = try_peval_expression(
+                statement.value, immutablechainmap(self.env, self.external_constants),
+                create_containers=True)
+            if not evaluated:
+                self._call_mutating_method(statement.value)
+
+        elif stmt_type == ast.If:
+            if self._truth(statement.test):
+                self.execute_block(statement.body)
+            else:
+                self.execute_block(statement.orelse)
+
+        elif stmt_type == ast.While:
+            while True:
+                self._next_iteration()
+                if not self._truth(statement.test):
+                    self.execute_block(statement.orelse)
+                    break
+                try:
+                    self.execute_block(statement.body)
+                except _Break:
+                    break
+                except _Continue:
+                    pass
+
+        elif stmt_type == ast.For:
+            iterable = self._evaluate(statement.iter)
+            if type(iterable) not in ITERABLE_TYPES:
+                raise _CannotExecute()
+            # Iterating over a copy, in case the iterable is mutated in the loop
+            for element in list(iterable):
+                self._next_iteration()
+                self._assign(statement.target, element)
+                try:
+                    self.execute_block(statement.body)
+                except _Break:
+                    break
+                except _Continue:
+                    pass
+            else:
+                self.execute_block(statement.orelse)
+
+        elif stmt_type == ast.Break:
+            raise _Break()
+
+        elif stmt_type == ast.Continue:
+            raise _Continue()
+
+        elif stmt_type == ast.Pass:
+            pass
+
+        else:
+            raise _CannotExecute()
+
+
+def _entry_state(prefix, external_constants, mutated_names):
+    """
+    Returns the dictionary of values of local variables known after executing
+    the list of statements ``prefix``, and the set of names referring to
+    the containers created in it.
+    The mutable values of the variables from ``mutated_names``
+    (the ones the function can change) are only known if they are created in ``prefix``
+    and are not changed by it.
+    """
+    env = {}
+    owned = set()
+    for statement in prefix:
+        bindings = immutablechainmap(env, external_constants)
+        if (type(statement) == ast.Assign and len(statement.targets) == 1
+                and type(statement.targets[0]) == ast.Name):
+            name = statement.targets[0].id
+            evaluated, value = try_peval_expression(
+                statement.value, bindings, create_containers=True)
+            fresh = type(statement.value) in FRESH_CONTAINER_NODES
+            if evaluated and (fresh or name not in mutated_names or is_immutable_value(value)):
+                env[name] = value
+                if fresh:
+                    owned.add(name)
+                else:
+                    owned.discard(name)
+                continue
+
+        names = set(find_symbol_creations(statement))
+        # The objects changed by the statement (or the ones a variable that can be changed
+        # is bound to by it) can be referred to by any of these variables.
+        if len(find_mutated_names(statement, bindings)) > 0 or not names.isdisjoint(mutated_names):
+            names.update(mutated_names)
+        for name in names:
+            env.pop(name, None)
+            owned.discard(name)
+
+    return env, owned
+
+
+def _is_copyable_container(value):
+    # A shallow copy of the container does not share mutable objects with the original.
+    if type(value) == dict:
+        return all(
+            is_immutable_value(key) and is_immutable_value(elem)
+            for key, elem in value.items())
+    elif type(value) in (list, set):
+        return all(is_immutable_value(elem) for elem in value)
+    else:
+        return False
+
+
+def _references(value, ids):
+    # Returns ``True`` if ``value`` is one of the objects with the given ``id()``s,
+    # or contains one of them.
+    if id(value) in ids:
+        return True
+    elif type(value) in (tuple, list, set, frozenset):
+        return any(_references(elem, ids) for elem in value)
+    elif type(value) == dict:
+        return any(
+            _references(key, ids) or _references(elem, ids) for key, elem in value.items())
+    else:
+        return False
+
+
+def _final_assignments(executor, gen_sym):
+    """
+    Returns a tuple ``(assignments, gen_sym, new_bindings)``
+    with the assignments of the final values of the variables changed by the loop,
+    or ``None`` if some of them cannot be assigned.
+    """
+    env = executor.env
+
+    # The mutated containers are replaced with their copies,
+    # so they must not be referenced by other variables.
+    mutated = set(name for name in executor.changed if name in executor.owned)
+    mutated_ids = set(id(env[name]) for name in mutated)
+    if any(_references(value, mutated_ids) for name, value in env.items() if name not in mutated):
+        return None
+
+    assignments = []
+    new_bindings = {}
+    containers = set()
+    for name in sorted(executor.changed):
+        value = env[name]
+        value_node, gen_sym, binding = value_to_node(value, gen_sym)
+        new_bindings.update(binding)
+
+        if name in mutated and _is_copyable_container(value):
+            # Two variables referring to the same container would get different copies
+            if id(value) in containers:
+                return None
+            containers.add(id(value))
+            value_node = ast.Call(
+                func=ast.Attribute(value=value_node, attr='copy', ctx=ast.Load()),
+                args=[], keywords=[])
+        elif not is_immutable_value(value):
+            # The object would be shared between the calls of the function
+            return None
+
+        assignments.append(
+            ast.Assign(targets=[ast.Name(id=name, ctx=ast.Store())], value=value_node))
+
+    return assignments, gen_sym, new_bindings
+
+
+@ast_walker
+class _execute_loops_walker:
+
+    @staticmethod
+    def handle_While(node, state, ctx, **kwds):
+        prefix = ctx.prefixes.get(id(node))
+        if prefix is None:
+            return node, state
+
+        env, owned = _entry_state(prefix, ctx.external_constants, ctx.mutated_names)
+        executor = _LoopExecutor(
+            env, owned, ctx.external_constants, ctx.max_iterations, ctx.max_time)
+        try:
+            executor.execute(node)
+        except (_CannotExecute, _Break, _Continue):
+            # ``break`` and ``continue`` in the ``else`` clause belong to an outer loop
+            return node, state
+
+        result = _final_assignments(executor, state.gen_sym)
+        if result is None:
+            return node, state
+
+        assignments, gen_sym, new_bindings = result
+        new_state = state.update(
+            gen_sym=gen_sym, new_bindings=dict(state.new_bindings, **new_bindings))
+        return assignments, new_state
@@ -1,14 +1,23 @@
 import ast
+import heapq
+try:
+    from collections.abc import Mapping
+except ImportError:
+    # Py2
+    from collections import Mapping
 import astunparse
 import inspect
 import itertools
 from functools import reduce
 import copy
 
-from peval.tools import replace_fields, ast_transformer
+from peval.tools import (
+    replace_fields, ast_transformer, ast_inspector, immutabledict, immutableset)
 from peval.core.gensym import GenSym
-from peval.core.cfg import build_cfg
-from peval.core.expression import peval_expression
+from peval.core.cfg import build_cfg, BasicBlocks
+from peval.core.symbol_finder import find_symbol_creations
+from peval.core.expression import peval_expression, find_mutated_names, _root_name
+from peval.wisdom import is_immutable_value
 
 
 class Value:
@@ -62,23 +71,99 @@ def meet_values(val1, val2):
         return Value(undefined=True)
 
 
-class Environment:
+UNDEFINED = Value(undefined=True)
+
+
+# Statement types that may not exist in some Python versions
+ANN_ASSIGN = getattr(ast, 'AnnAssign', None)
+MATCH = getattr(ast, 'Match', None)
+MATCH_CASE = getattr(ast, 'match_case', None)
+FOR_TYPES = tuple(getattr(ast, name) for name in ('For', 'AsyncFor') if hasattr(ast, name))
+WITH_TYPES = tuple(getattr(ast, name) for name in ('With', 'AsyncWith') if hasattr(ast, name))
+DEF_TYPES = tuple(
+    getattr(ast, name) for name in ('FunctionDef', 'AsyncFunctionDef', 'ClassDef')
+    if hasattr(ast, name))
+
+
+class KnownValues(Mapping):
+    """
+    A read-only view of the known values of variables,
+    with ``values`` (a mapping of names to ``Value`` objects) taking precedence
+    over ``base`` (a mapping of names to actual values).
+    """
+
+    def __init__(self, values, base):
+        self._values = values
+        self._base = base
+
+    def __getitem__(self, name):
+        if name in self._values:
+            value = self._values[name]
+            if value.defined:
+                return value.value
+            else:
+                raise KeyError(name)
+        return self._base[name]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        if name in self._values:
+            return self._values[name].defined
+        return name in self._base
 
-    def __init__(self, values=None):
-        self.values = values if values is not None else {}
+    def _flatten(self):
+        result = dict(self._base.items())
+        for name, value in self._values.items():
+            if value.defined:
+                result[name] = value.value
+            else:
+                result.pop(name, None)
+        return result
 
-    @classmethod
-    def from_dict(cls, values):
-        return cls(values=dict((name, Value(value=value)) for name, value in values.items()))
+    def __iter__(self):
+        return iter(self._flatten())
+
+    def __len__(self):
+        return len(self._flatten())
+
+
+class Environment:
+    """
+    Values of variables at some point of the function.
+
+    ``base`` is a mapping of the values of external variables,
+    shared by all the environments of the function.
+    ``values`` is an ``immutabledict`` with ``Value`` objects for the variables
+    assigned or mutated in the function, which take precedence over ``base``.
+    So the size of the environment does not depend on the number of globals,
+    and the environments that do not differ can be shared between CFG nodes.
+    """
+
+    def __init__(self, base, values=None):
+        self.base = base
+        self.values = values if values is not None else immutabledict()
+
+    def update(self, new_values):
+        values = self.values.update(new_values)
+        if values is self.values:
+            return self
+        else:
+            return Environment(self.base, values=values)
 
     def known_values(self):
-        return dict((name, value.value) for name, value in self.values.items() if value.defined)
+        return KnownValues(self.values, self.base)
 
     def __eq__(self, other):
-        return self.values == other.values
+        return self.base is other.base and (
+            self.values is other.values or self.values == other.values)
 
     def __ne__(self, other):
-        return self.values != other.values
+        return not self.__eq__(other)
 
     def __repr__(self):
         return "Environment(values={values})".format(values=self.values)
@@ -86,22 +171,30 @@ class Environment:
 
 def meet_envs(env1, env2):
 
+    assert env1.base is env2.base
+
     lhs = env1.values
     rhs = env2.values
+    if lhs is rhs:
+        return env1
+
+    base = env1.base
     lhs_keys = set(lhs.keys())
     rhs_keys = set(rhs.keys())
     result = {}
 
+    # A variable missing from one of the environments either has the value from ``base``,
+    # or has not been assigned yet along that path (in which case it does not restrict the other one).
     for var in lhs_keys - rhs_keys:
-        result[var] = lhs[var]
+        result[var] = meet_values(lhs[var], Value(value=base[var])) if var in base else lhs[var]
 
     for var in rhs_keys - lhs_keys:
-        result[var] = rhs[var]
+        result[var] = meet_values(rhs[var], Value(value=base[var])) if var in base else rhs[var]
 
     for var in lhs_keys & rhs_keys:
         result[var] = meet_values(lhs[var], rhs[var])
 
-    return Environment(values=result)
+    return Environment(env1.base, values=immutabledict(result))
 
 
 def my_reduce(func, seq):
@@ -118,135 +211,331 @@ class CachedExpression:
         self.path = path
 
 
-def forward_transfer(gen_sym, in_env, statement):
+# The types of sequences that can be safely unpacked to assignment targets at compile time.
+UNPACKABLE_TYPES = (tuple, list, range, str, bytes)
 
-    if isinstance(statement, ast.Assign):
-        target = statement.targets[0].id
-        result, gen_sym = peval_expression(statement.value, gen_sym, in_env.known_values())
+# The types for which an augmented assignment is equivalent to a binary operation
+# (for mutable types it changes the object in place).
+IMMUTABLE_TYPES = (bool, int, float, complex, str, bytes, tuple, frozenset, type(None))
 
-        new_values=dict(in_env.values)
 
-        for name in result.mutated_bindings:
-            new_values[name] = Value(undefined=True)
+def _target_names(target):
+    """
+    Returns a set of names of variables that are bound or changed
+    by an assignment to ``target``.
+    """
+    if type(target) == ast.Name:
+        return set([target.id])
+    elif type(target) in (ast.Tuple, ast.List):
+        return set().union(*[_target_names(elt) for elt in target.elts])
+    elif type(target) == ast.Starred:
+        return _target_names(target.value)
+    else:
+        # An attribute or an item assignment mutates the object
+        name = _root_name(target)
+        return set() if name is None else set([name])
+
+
+def _bind_target(target, value):
+    """
+    Returns a dictionary of values of variables bound by the assignment of ``value``
+    to ``target``, or ``None`` if it cannot be determined at compile time.
+    """
+    if type(target) == ast.Name:
+        return {target.id: value}
+
+    if type(target) not in (ast.Tuple, ast.List) or type(value) not in UNPACKABLE_TYPES:
+        return None
+
+    values = list(value)
+    elts = target.elts
+    starred = [i for i, elt in enumerate(elts) if type(elt) == ast.Starred]
+
+    if len(starred) == 0:
+        if len(values) != len(elts):
+            return None
+        pairs = list(zip(elts, values))
+    else:
+        star_idx = starred[0]
+        num_after = len(elts) - star_idx - 1
+        if len(values) < len(elts) - 1:
+            return None
+        pairs = (
+            list(zip(elts[:star_idx], values[:star_idx]))
+            + [(elts[star_idx].value, values[star_idx:len(values) - num_after])]
+            + list(zip(elts[star_idx+1:], values[len(values) - num_after:])))
 
-        if result.fully_evaluated:
-            new_value = Value(value=result.value)
+    result = {}
+    for elt, elt_value in pairs:
+        elt_bindings = _bind_target(elt, elt_value)
+        if elt_bindings is None:
+            return None
+        result.update(elt_bindings)
+    return result
+
+
+def _assign_values(targets, result):
+    # Returns a dictionary of ``Value`` objects for the variables changed
+    # by the assignment of the evaluation ``result`` to ``targets``.
+    new_values = dict((name, UNDEFINED) for name in result.mutated_bindings)
+    for target in targets:
+        bindings = _bind_target(target, result.value) if result.fully_evaluated else None
+        if bindings is None:
+            for name in _target_names(target):
+                new_values[name] = UNDEFINED
         else:
-            new_value = Value(undefined=True)
-        new_values[target] = new_value
+            for name, value in bindings.items():
+                new_values[name] = Value(value=value)
+    return new_values
 
-        out_env = Environment(values=new_values)
-        new_exprs = [CachedExpression(path=['value'], node=result.node)]
 
-        return gen_sym, out_env, new_exprs, result.temp_bindings
+def _undefined_values(names):
+    return dict((name, UNDEFINED) for name in names)
 
-    elif isinstance(statement, (ast.Expr, ast.Return)):
-        result, gen_sym = peval_expression(statement.value, gen_sym, in_env.known_values())
 
-        new_values=dict(in_env.values)
+def _hide_mutated_values(new_values, mutated_names):
+    # The mutable objects that can be changed somewhere in the function
+    # are not known anywhere in it, since the changes are not tracked.
+    return dict(
+        (name, UNDEFINED
+            if name in mutated_names and value.defined and not is_immutable_value(value.value)
+            else value)
+        for name, value in new_values.items())
 
-        for name in result.mutated_bindings:
-            new_values[name] = Value(undefined=True)
 
-        new_exprs = [CachedExpression(path=['value'], node=result.node)]
-        out_env = Environment(values=new_values)
+@ast_inspector
+class _find_pattern_names:
+    """
+    Finds the names bound by a ``match`` statement pattern,
+    and by assignment expressions in a guard.
+    """
 
-        return gen_sym, out_env, new_exprs, result.temp_bindings
+    @staticmethod
+    def handle_MatchAs(node, state, **kwds):
+        return state if node.name is None else state.update(names=state.names.add(node.name))
 
-    elif isinstance(statement, ast.If):
-        result, gen_sym = peval_expression(statement.test, gen_sym, in_env.known_values())
+    @staticmethod
+    def handle_MatchStar(node, state, **kwds):
+        return state if node.name is None else state.update(names=state.names.add(node.name))
 
-        new_values=dict(in_env.values)
+    @staticmethod
+    def handle_MatchMapping(node, state, **kwds):
+        return state if node.rest is None else state.update(names=state.names.add(node.rest))
 
-        for name in result.mutated_bindings:
-            new_values[name] = Value(undefined=True)
+    @staticmethod
+    def handle_NamedExpr(node, state, **kwds):
+        return state.update(names=state.names.add(node.target.id))
 
-        out_env = Environment(values=new_values)
 
-        new_exprs = [CachedExpression(path=['test'], node=result.node)]
+def _evaluate(gen_sym, known_values, node, path, new_values=None):
+    # Evaluates an expression at ``path`` in ``node``
+    # and marks the variables changed by it as undefined.
+    result, gen_sym = peval_expression(getattr(node, path), gen_sym, known_values)
+    new_values = dict(new_values) if new_values is not None else {}
+    new_values.update(_undefined_values(result.mutated_bindings))
+    new_exprs = [CachedExpression(path=[path], node=result.node)]
+    return gen_sym, result, new_values, new_exprs
 
-        return gen_sym, out_env, new_exprs, result.temp_bindings
-
-    else:
-        return gen_sym, in_env, [], {}
 
+def forward_transfer(gen_sym, known_values, statement):
+    """
+    Evaluates the expressions in ``statement`` given the mapping of ``known_values``.
+    Returns a tuple of the new ``gen_sym``, a dictionary of the changed ``Value`` objects,
+    a list of ``CachedExpression`` objects, and a dictionary of the created temporary bindings.
+    Only the "header" of a compound statement is processed
+    (e.g. the test of an ``if``, but not its branches, which are separate nodes in the CFG).
+    """
 
-class State:
-
-    def __init__(self, out_env, exprs, temp_bindings):
-        self.out_env = out_env
-        self.exprs = exprs
-        self.temp_bindings = temp_bindings
+    stmt_type = type(statement)
 
+    if stmt_type == ast.Assign:
+        result, gen_sym = peval_expression(statement.value, gen_sym, known_values)
+        new_values = _assign_values(statement.targets, result)
+        new_exprs = [CachedExpression(path=['value'], node=result.node)]
+        return gen_sym, new_values, new_exprs, result.temp_bindings
+
+    elif stmt_type == ANN_ASSIGN:
+        if statement.value is None:
+            # Only an annotation; annotations of local variables are not evaluated
+            return gen_sym, {}, [], {}
+        result, gen_sym = peval_expression(statement.value, gen_sym, known_values)
+        new_values = _assign_values([statement.target], result)
+        new_exprs = [CachedExpression(path=['value'], node=result.node)]
+        return gen_sym, new_values, new_exprs, result.temp_bindings
+
+    elif stmt_type == ast.AugAssign:
+        target = statement.target
+        gen_sym, result, new_values, new_exprs = _evaluate(
+            gen_sym, known_values, statement, 'value')
+        temp_bindings = result.temp_bindings
+
+        if (type(target) == ast.Name and result.fully_evaluated
+                and target.id in known_values
+                and type(known_values[target.id]) in IMMUTABLE_TYPES):
+            # For immutable values ``x op= y`` is the same as ``x = x op y``
+            binop = ast.BinOp(
+                left=ast.Name(id=target.id, ctx=ast.Load()), op=statement.op,
+                right=statement.value)
+            binop_result, gen_sym = peval_expression(binop, gen_sym, known_values)
+            if binop_result.fully_evaluated:
+                new_values[target.id] = Value(value=binop_result.value)
+                return gen_sym, new_values, new_exprs, temp_bindings
+
+        new_values.update(_undefined_values(_target_names(target)))
+        return gen_sym, new_values, new_exprs, temp_bindings
+
+    elif stmt_type in (ast.Expr, ast.Return):
+        if statement.value is None:
+            # A bare ``return``
+            return gen_sym, {}, [], {}
+        gen_sym, result, new_values, new_exprs = _evaluate(
+            gen_sym, known_values, statement, 'value')
+        return gen_sym, new_values, new_exprs, result.temp_bindings
+
+    elif stmt_type in (ast.If, ast.While):
+        gen_sym, result, new_values, new_exprs = _evaluate(
+            gen_sym, known_values, statement, 'test')
+        return gen_sym, new_values, new_exprs, result.temp_bindings
+
+    elif stmt_type in FOR_TYPES:
+        # The loop header is visited on every iteration;
+        # since the loop is not unrolled, the values of the targets are unknown.
+        gen_sym, result, new_values, new_exprs = _evaluate(
+            gen_sym, known_values, statement, 'iter',
+            new_values=_undefined_values(_target_names(statement.target)))
+        return gen_sym, new_values, new_exprs, result.temp_bindings
+
+    elif stmt_type in WITH_TYPES:
+        names = set()
+        for item in statement.items:
+            if item.optional_vars is not None:
+                names.update(_target_names(item.optional_vars))
+        return gen_sym, _undefined_values(names), [], {}
+
+    elif stmt_type == MATCH:
+        gen_sym, result, new_values, new_exprs = _evaluate(
+            gen_sym, known_values, statement, 'subject')
+        return gen_sym, new_values, new_exprs, result.temp_bindings
+
+    elif stmt_type == MATCH_CASE:
+        nodes = [statement.pattern] + ([statement.guard] if statement.guard is not None else [])
+        state = _find_pattern_names(nodes, state=dict(names=immutableset()))
+        return gen_sym, _undefined_values(state.names), [], {}
+
+    elif stmt_type == ast.ExceptHandler:
+        if statement.name is None:
+            return gen_sym, {}, [], {}
+        name = statement.name if isinstance(statement.name, str) else statement.name.id
+        return gen_sym, _undefined_values([name]), [], {}
+
+    elif stmt_type in (ast.Import, ast.ImportFrom):
+        names = [
+            alias.asname if alias.asname is not None else alias.name.split('.', 1)[0]
+            for alias in statement.names]
+        return gen_sym, _undefined_values(names), [], {}
+
+    elif stmt_type in DEF_TYPES:
+        return gen_sym, _undefined_values([statement.name]), [], {}
+
+    elif stmt_type == ast.Delete:
+        names = set().union(*[_target_names(target) for target in statement.targets])
+        return gen_sym, _undefined_values(names), [], {}
 
-def get_sorted_nodes(graph, enter):
-    sorted_nodes = []
-    todo_list = [enter]
-    visited = set()
+    else:
+        return gen_sym, {}, [], {}
+
+
+def block_transfer(
+        gen_sym, in_env, graph, statements, exprs, temp_bindings, mutated_names=frozenset()):
+    """
+    Propagates ``in_env`` through a basic block with the given ``statements``
+    (a list of node ids in ``graph``), saving the evaluated expressions
+    and the temporary bindings for each statement in ``exprs`` and ``temp_bindings``.
+    The mutable values assigned to ``mutated_names`` are not propagated.
+    Returns the new ``gen_sym`` and the environment at the exit of the block.
+    """
+
+    # The values are copied (once per block) only if some statement changes them.
+    values = None
+    known_values = in_env.known_values()
+
+    for node_id in statements:
+        gen_sym, new_values, new_exprs, new_temp_bindings = \
+            forward_transfer(gen_sym, known_values, graph._nodes[node_id].ast_node)
+
+        exprs[node_id] = new_exprs
+        temp_bindings[node_id] = new_temp_bindings
+
+        if len(new_values) > 0:
+            if values is None:
+                values = dict(in_env.values)
+                known_values = KnownValues(values, in_env.base)
+            values.update(_hide_mutated_values(new_values, mutated_names))
+
+    if values is None:
+        return gen_sym, in_env
+    else:
+        return gen_sym, Environment(in_env.base, values=immutabledict(values))
 
-    while len(todo_list) > 0:
-        src_id = todo_list.pop()
-        if src_id in visited:
-            continue
-        sorted_nodes.append(src_id)
-        visited.add(src_id)
 
-        for dest_id in sorted(graph.children_of(src_id)):
-            todo_list.append(dest_id)
+def maximal_fixed_point(
+        gen_sym, graph, enter, bindings, mutated_names=frozenset(), local_names=()):
 
-    return sorted_nodes
+    blocks = BasicBlocks(graph, enter)
 
+    # The parameters and the local variables shadow the globals with the same names,
+    # and their values at the entry to the function are not known.
+    for name in local_names:
+        bindings = bindings.del_(name)
+    enter_env = Environment(bindings).update(_undefined_values(local_names))
 
-def maximal_fixed_point(gen_sym, graph, enter, bindings):
+    # The blocks that have not been visited yet do not restrict the values
+    initial_env = Environment(bindings)
+    out_envs = [initial_env] * len(blocks)
+    exprs = {}
+    temp_bindings = {}
 
-    states = dict(
-        (node_id, State(Environment.from_dict(bindings), [], {}))
-        for node_id in graph._nodes)
-    enter_env = Environment.from_dict(bindings)
+    # The worklist is a heap of positions of blocks in the reverse postorder,
+    # so that a block is (re)visited after all of its updated predecessors
+    # except the ones along back edges, which minimizes the number of iterations.
+    # It also makes the names of the final bindings deterministic.
+    sorted_blocks = blocks.reverse_postorder()
+    priorities = dict((block_id, i) for i, block_id in enumerate(sorted_blocks))
 
     # first make a pass over each basic block
-    # TODO is sorted to make the names of the final bindings deterministic
-    todo_forward = get_sorted_nodes(graph, enter)
-    todo_forward_set = set(todo_forward)
-
-    make_label = lambda nid: astunparse.unparse(graph._nodes[nid].ast_node).strip().split("\n")[0]
+    todo_forward = list(range(len(sorted_blocks)))
+    todo_forward_set = set(sorted_blocks)
 
     while len(todo_forward) > 0:
-        node_id = todo_forward.pop(0)
-        todo_forward_set.remove(node_id)
-        state = states[node_id]
+        block_id = sorted_blocks[heapq.heappop(todo_forward)]
+        todo_forward_set.remove(block_id)
 
         # compute the environment at the entry of this BB
-        if node_id == enter:
-            new_in_env = enter_env
-        else:
-            parent_envs = list(map(
-                lambda parent_id: states[parent_id].out_env,
-                graph.parents_of(node_id)))
-            new_in_env = my_reduce(meet_envs, parent_envs)
+        parent_envs = [out_envs[parent_id] for parent_id in blocks.predecessors[block_id]]
+        if block_id == blocks.enter:
+            parent_envs.append(enter_env)
+        new_in_env = my_reduce(meet_envs, parent_envs)
 
         # propagate information for this basic block
-        gen_sym, new_out_env, new_exprs, temp_bindings = \
-            forward_transfer(gen_sym, new_in_env, graph._nodes[node_id].ast_node)
-
-        states[node_id].exprs = new_exprs
-        states[node_id].temp_bindings = temp_bindings
+        gen_sym, new_out_env = block_transfer(
+            gen_sym, new_in_env, graph, blocks.statements[block_id], exprs, temp_bindings,
+            mutated_names)
 
-        if new_out_env != states[node_id].out_env:
-            states[node_id] = State(new_out_env, new_exprs, temp_bindings)
-            for dest_id in sorted(graph.children_of(node_id)):
+        if new_out_env != out_envs[block_id]:
+            out_envs[block_id] = new_out_env
+            for dest_id in blocks.successors[block_id]:
                 if dest_id not in todo_forward_set:
                     todo_forward_set.add(dest_id)
-                    todo_forward.append(dest_id)
+                    heapq.heappush(todo_forward, priorities[dest_id])
 
     # Converged
     new_exprs = {}
-    temp_bindings = {}
-    for node_id, state in states.items():
-        new_exprs[node_id] = state.exprs
-        temp_bindings.update(state.temp_bindings)
+    all_temp_bindings = {}
+    for node_id in sorted(exprs):
+        new_exprs[id(graph._nodes[node_id].ast_node)] = exprs[node_id]
+        all_temp_bindings.update(temp_bindings[node_id])
 
-    return new_exprs, temp_bindings
+    return new_exprs, all_temp_bindings
 
 
 def replace_exprs(tree, new_exprs):
@@ -270,7 +559,7 @@ def replace_by_path(obj, path, new_value):
 
 
 @ast_transformer
-def _replace_exprs(node, ctx, walk_field, **kwds):
+def _replace_exprs(node, ctx, walk_field, skip_fields, **kwds):
     if id(node) in ctx.new_exprs:
         exprs = ctx.new_exprs[id(node)]
         visited_fields = set()
@@ -278,10 +567,13 @@ def _replace_exprs(node, ctx, walk_field, **kwds):
             visited_fields.add(expr.path[0])
             node = replace_by_path(node, expr.path, expr.node)
 
+        new_fields = {}
         for attr, value in ast.iter_fields(node):
             if attr not in visited_fields:
-                setattr(node, attr, walk_field(value))
-        return node
+                new_fields[attr] = walk_field(value, block_context=attr in ('body', 'orelse'))
+
+        skip_fields()
+        return replace_fields(node, **new_fields)
     else:
         return node
 
@@ -290,8 +582,18 @@ def fold(tree, constants):
     statements = tree.body
     cfg = build_cfg(statements)
     gen_sym = GenSym.for_tree(tree)
-    new_nodes, temp_bindings = maximal_fixed_point(gen_sym, cfg.graph, cfg.enter, constants)
-    constants = dict(constants)
-    constants.update(temp_bindings)
+
+    # The known mutable objects that the function can change
+    # (or the variables that may refer to such objects) cannot be relied upon.
+    mutated_names = find_mutated_names(tree, constants)
+    bindings = constants
+    for name in mutated_names:
+        if name in bindings and not is_immutable_value(bindings[name]):
+            bindings = bindings.del_(name)
+
+    new_nodes, temp_bindings = maximal_fixed_point(
+        gen_sym, cfg.graph, cfg.enter, bindings, mutated_names,
+        find_symbol_creations(tree))
+    constants = constants.update(temp_bindings)
     new_tree = replace_exprs(tree, new_nodes)
     return new_tree, constants
@@ -1,21 +1,66 @@
 import ast
 import copy
+import functools
+import inspect
+import re
 import sys
 
-from peval.tags import is_inline
+import funcsigs
+
+from peval.tags import is_inline, is_macro, is_pure
+from peval.wisdom import is_resumable
 from peval.core.value import value_to_node
-from peval.core.expression import try_peval_expression
+from peval.core.expression import try_peval_expression, try_get_attribute
 from peval.core.function import Function
 from peval.core.mangler import mangle
 from peval.core.gensym import GenSym
-from peval.tools import get_fn_arg_id, ast_walker, replace_fields
+from peval.core.pass_manager import count_nodes
+from peval.core.symbol_finder import find_symbol_creations, find_symbol_usages
+from peval.tools import get_fn_arg_id, ast_walker, ast_transformer, replace_fields
+
+
+# Recursive references in the inlined bodies are replaced by the names with this tag
+# and the recursion depth, so that the depth can be tracked between the runs of the component.
+RECURSION_TAG = 'recursion'
+_RECURSION_NAME = re.compile(r'^__peval_' + RECURSION_TAG + r'_(\d+)_\d+$')
 
+# The weights of the cost model for the functions not marked for inlining
+# (in AST nodes, subtracted from the size of the function body).
+KNOWN_ARGUMENT_BONUS = 5
+FOLDING_BONUS = 20
+SINGLE_CALL_BONUS = 10
 
-def inline_functions(tree, constants):
+_SCOPE_NODES = (ast.Global,)
+if sys.version_info >= (3,):
+    _SCOPE_NODES += (ast.Nonlocal,)
+
+
+def inline_functions(tree, constants, max_size=5000, max_depth=8, auto_inline_size=0):
+    """
+    Inlines the calls to the functions marked with :py:func:`~peval.tags.inline`.
+
+    :param max_size: the code growth budget: a call is not inlined
+        if the inlined bodies would add more than this number of AST nodes to the tree
+        (so that large functions can still have their calls inlined).
+    :param max_depth: the maximum depth of inlining of the recursive calls
+        (the calls of a function by its name in its own body).
+    :param auto_inline_size: if positive, the functions that are not marked for inlining
+        (and not marked as impure) are inlined too, if the estimated cost of inlining
+        does not exceed this value. The cost is the size of the function body (in AST nodes),
+        reduced for every known argument, for known arguments used in conditions
+        (since inlining will allow folding them), and for the functions called only once.
+    """
     gen_sym = GenSym.for_tree(tree)
-    constants = dict(constants)
+    if auto_inline_size > 0:
+        call_sites = _count_call_sites(tree, constants)
+    else:
+        call_sites = {}
+
     tree, state = _inline_functions_walker(
-        tree, state=dict(gen_sym=gen_sym, constants=constants))
+        tree, state=dict(gen_sym=gen_sym, constants=constants, growth=0),
+        ctx=dict(
+            local_names=find_symbol_creations(tree), max_size=max_size, max_depth=max_depth,
+            auto_inline_size=auto_inline_size, call_sites=call_sites))
     return tree, state.constants
 
 
@@ -23,43 +68,323 @@ def inline_functions(tree, constants):
 class _inline_functions_walker:
 
     @staticmethod
-    def handle_Call(node, state, prepend, **kwds):
+    def handle_Call(node, state, ctx, prepend, **kwds):
         gen_sym = state.gen_sym
         constants = state.constants
 
-        evaluated, fn = try_peval_expression(node.func, constants)
+        evaluated, fn = _evaluate_callee(node.func, constants)
+        if not evaluated:
+            return node, state
+
+        fn, call_node, gen_sym, new_bindings = _resolve_callee(fn, node, gen_sym)
+        if not inspect.isfunction(fn) or is_resumable(fn) or is_macro(fn):
+            return node, state
 
-        if not evaluated or not is_inline(fn):
+        depth = _recursion_depth(node.func)
+        if depth >= ctx.max_depth:
             return node, state
 
+        if not is_inline(fn) and not _should_auto_inline(fn, call_node, constants, ctx):
+            return node, state
+
+        constants = constants.update(new_bindings)
+
         return_name, gen_sym = gen_sym('return')
-        inlined_body, gen_sym, constants = _inline(node, gen_sym, return_name, constants)
+        result = _inline(
+            call_node, fn, gen_sym, return_name, constants, ctx.local_names, depth)
+        if result is None:
+            return node, state
+
+        inlined_body, gen_sym, constants = result
+        growth = state.growth + sum(count_nodes(statement) for statement in inlined_body)
+        if growth > ctx.max_size:
+            return node, state
+
         prepend(inlined_body)
-        new_state = state.update(gen_sym=gen_sym, constants=constants)
+        new_state = state.update(gen_sym=gen_sym, constants=constants, growth=growth)
 
         return ast.Name(id=return_name, ctx=ast.Load()), new_state
 
 
-def _inline(node, gen_sym, return_name, constants):
+    # The inlined body is evaluated before the statement containing the call,
+    # so the calls in the parts of the expressions that are evaluated conditionally
+    # (or repeatedly) are not inlined.
+
+    @staticmethod
+    def handle_IfExp(node, state, skip_fields, walk_field, **kwds):
+        new_test, state = walk_field(node.test, state)
+        skip_fields()
+        return replace_fields(node, test=new_test), state
+
+    @staticmethod
+    def handle_BoolOp(node, state, skip_fields, walk_field, **kwds):
+        new_value, state = walk_field(node.values[0], state)
+        skip_fields()
+        if new_value is node.values[0]:
+            return node, state
+        else:
+            return replace_fields(node, values=[new_value] + node.values[1:]), state
+
+    @staticmethod
+    def handle_While(node, state, skip_fields, walk_field, **kwds):
+        new_body, state = walk_field(node.body, state, block_context=True)
+        new_orelse, state = walk_field(node.orelse, state, block_context=True)
+        skip_fields()
+        return replace_fields(node, body=new_body, orelse=new_orelse), state
+
+    @staticmethod
+    def handle_Lambda(node, state, skip_fields, **kwds):
+        skip_fields()
+        return node, state
+
+    handle_ListComp = handle_Lambda
+    handle_SetComp = handle_Lambda
+    handle_DictComp = handle_Lambda
+    handle_GeneratorExp = handle_Lambda
+
+
+def _recursion_depth(func_node):
+    # Returns the depth of a recursive call created by inlining, or 0 for other calls.
+    if type(func_node) == ast.Name:
+        match = _RECURSION_NAME.match(func_node.id)
+        if match is not None:
+            return int(match.group(1))
+    return 0
+
+
+def _count_call_sites(tree, constants):
+    """
+    Returns a dictionary of functions and the number of the calls to them in ``tree``.
+    """
+    call_sites = {}
+    gen_sym = GenSym()
+    for node in ast.walk(tree):
+        if type(node) != ast.Call:
+            continue
+        evaluated, fn = _evaluate_callee(node.func, constants)
+        if not evaluated:
+            continue
+        fn, _, _, _ = _resolve_callee(fn, node, gen_sym)
+        if inspect.isfunction(fn):
+            call_sites[fn] = call_sites.get(fn, 0) + 1
+    return call_sites
+
+
+def _should_auto_inline(fn, call_node, constants, ctx):
+    """
+    Returns ``True`` if ``fn`` is not marked for inlining,
+    but it is cheap enough to be inlined in ``call_node`` anyway.
+    """
+    if ctx.auto_inline_size <= 0 or is_pure(fn) is False:
+        return False
+
+    try:
+        fn_ast = Function.from_object(fn).tree
+    except (IOError, OSError, TypeError):
+        # The source is not available
+        return False
+
+    if type(fn_ast) != ast.FunctionDef:
+        return False
+    if any(isinstance(node, _SCOPE_NODES) for node in ast.walk(fn_ast)):
+        return False
+
+    cost = _inlining_cost(fn, fn_ast, call_node, constants, ctx.call_sites.get(fn, 1))
+    return cost <= ctx.auto_inline_size
+
+
+def _inlining_cost(fn, fn_ast, call_node, constants, call_sites):
     """
-    Return a list of nodes, representing inlined function call.
+    Returns the estimated cost of inlining ``fn`` (with the definition ``fn_ast``)
+    in ``call_node`` (the number of AST nodes with the bonuses subtracted).
     """
-    fn = constants[node.func.id]
-    fn_ast = Function.from_object(fn).tree
+    cost = sum(count_nodes(statement) for statement in fn_ast.body)
+
+    known_params = _known_parameters(fn, call_node, constants)
+    cost -= KNOWN_ARGUMENT_BONUS * len(known_params)
+
+    condition_names = set()
+    for node in ast.walk(fn_ast):
+        if type(node) in (ast.If, ast.While, ast.IfExp):
+            condition_names.update(find_symbol_usages(node.test))
+    if not known_params.isdisjoint(condition_names):
+        cost -= FOLDING_BONUS
+
+    if call_sites == 1:
+        cost -= SINGLE_CALL_BONUS
+
+    return cost
+
+
+def _known_parameters(fn, call_node, constants):
+    # Returns the set of the parameters of ``fn`` bound to known arguments in ``call_node``.
+    if (getattr(call_node, 'starargs', None) is not None
+            or getattr(call_node, 'kwargs', None) is not None
+            or (sys.version_info >= (3, 5) and any(type(arg) == ast.Starred for arg in call_node.args))
+            or any(keyword.arg is None for keyword in call_node.keywords)):
+        return set()
+
+    try:
+        bound = funcsigs.signature(fn).bind_partial(
+            *call_node.args,
+            **dict((keyword.arg, keyword.value) for keyword in call_node.keywords))
+    except TypeError:
+        return set()
+
+    known_params = set()
+    for name, arg in bound.arguments.items():
+        if isinstance(arg, ast.AST) and try_peval_expression(arg, constants)[0]:
+            known_params.add(name)
+    return known_params
+
+
+def _evaluate_callee(func, constants):
+    # The methods of mutable objects are not evaluated by ``try_peval_expression()``
+    # (the calls to them can change the objects), but they can still be inlined.
+    if type(func) == ast.Attribute:
+        evaluated, obj = try_peval_expression(func.value, constants)
+        if evaluated:
+            return try_get_attribute(obj, func.attr)
+    return try_peval_expression(func, constants)
+
+
+def _resolve_callee(fn, call_node, gen_sym):
+    """
+    Unwraps bound methods and ``functools.partial`` objects called in ``call_node``.
+    Returns a tuple ``(fn, call_node, gen_sym, new_bindings)``,
+    where ``fn`` is the underlying function, and ``call_node`` is the equivalent call to it,
+    with the bound object and the stored arguments added to the arguments of the call.
+    """
+    new_bindings = {}
+    while True:
+        if inspect.ismethod(fn) and fn.__self__ is not None:
+            prefix = [fn.__self__]
+            keywords = {}
+            fn = fn.__func__
+        elif isinstance(fn, functools.partial):
+            prefix = fn.args
+            keywords = fn.keywords or {}
+            fn = fn.func
+        else:
+            return fn, call_node, gen_sym, new_bindings
+
+        prefix_nodes = []
+        for value in prefix:
+            value_node, gen_sym, binding = value_to_node(value, gen_sym)
+            new_bindings.update(binding)
+            prefix_nodes.append(value_node)
+
+        # The keywords given in the call override the ones stored in the partial object
+        call_names = set(keyword.arg for keyword in call_node.keywords)
+        keyword_nodes = []
+        for name, value in sorted(keywords.items()):
+            if name in call_names:
+                continue
+            value_node, gen_sym, binding = value_to_node(value, gen_sym)
+            new_bindings.update(binding)
+            keyword_nodes.append(ast.keyword(arg=name, value=value_node))
+
+        call_node = replace_fields(
+            call_node,
+            args=prefix_nodes + list(call_node.args),
+            keywords=keyword_nodes + list(call_node.keywords))
+
+
+def _inline(node, fn, gen_sym, return_name, constants, local_names, depth):
+    """
+    Return a list of nodes, representing inlined function call,
+    or ``None`` if the arguments of the call cannot be bound to the parameters of ``fn``,
+    or some of the undefined global names it uses are defined in the outer function.
+    """
+    function = Function.from_object(fn)
+    fn_ast = function.tree
 
     gen_sym, new_fn_ast = mangle(gen_sym, fn_ast)
 
-    parameter_assignments = _build_parameter_assignments(node, new_fn_ast)
+    result = _build_parameter_assignments(gen_sym, node, new_fn_ast, fn, constants)
+    if result is None:
+        return None
+    parameter_assignments, gen_sym, new_bindings = result
+    constants = constants.update(new_bindings)
 
-    body_nodes = new_fn_ast.body
+    result = _remap_globals(
+        gen_sym, new_fn_ast, fn, function.get_external_variables(), constants, local_names,
+        depth)
+    if result is None:
+        return None
+    body_nodes, gen_sym, new_bindings = result
+    constants = constants.update(new_bindings)
 
     gen_sym, inlined_body, new_bindings = _wrap_in_loop(gen_sym, body_nodes, return_name)
-    constants = dict(constants)
-    constants.update(new_bindings)
+    constants = constants.update(new_bindings)
 
     return parameter_assignments + inlined_body, gen_sym, constants
 
 
+_MISSING = object()
+
+
+@ast_transformer
+class _replace_names:
+
+    @staticmethod
+    def handle_Name(node, ctx, **kwds):
+        if type(node.ctx) == ast.Load and node.id in ctx.substitutions:
+            return copy.deepcopy(ctx.substitutions[node.id])
+        else:
+            return node
+
+
+def _remap_globals(gen_sym, fn_ast, fn, fn_constants, constants, local_names, depth):
+    """
+    Replaces the external names used in the body of the (mangled) function ``fn_ast``
+    that refer to different objects in the function it is inlined in
+    (e.g. if the inlined function is defined in a different module,
+    or the name is shadowed by a local variable), with their values.
+    The names referring to ``fn`` itself are replaced by new names marked with
+    the recursion depth ``depth + 1``.
+    Returns a tuple ``(body_nodes, gen_sym, new_bindings)``,
+    or ``None`` if an undefined name would be captured by the outer function.
+    """
+    fn_local_names = find_symbol_creations(fn_ast)
+    substitutions = {}
+    new_bindings = {}
+    for name in sorted(find_symbol_usages(fn_ast.body)):
+        if name in fn_local_names:
+            continue
+        if name not in fn_constants:
+            # An undefined name can be left as it is,
+            # unless it would refer to something in the function it is inlined in.
+            if name in local_names or name in constants:
+                return None
+            continue
+        value = fn_constants[name]
+        if value is fn:
+            recursion_name, gen_sym = _recursion_name(gen_sym, depth + 1, constants)
+            substitutions[name] = ast.Name(id=recursion_name, ctx=ast.Load())
+            new_bindings[recursion_name] = fn
+            continue
+        if name not in local_names and constants.get(name, _MISSING) is value:
+            continue
+        substitutions[name], gen_sym, binding = value_to_node(value, gen_sym)
+        new_bindings.update(binding)
+
+    if len(substitutions) == 0:
+        return fn_ast.body, gen_sym, new_bindings
+
+    body_nodes = _replace_names(fn_ast.body, ctx=dict(substitutions=substitutions))
+    return body_nodes, gen_sym, new_bindings
+
+
+def _recursion_name(gen_sym, depth, constants):
+    # The names are only used in the expressions, so ``gen_sym`` does not know
+    # about the ones created in the previous runs of the component.
+    while True:
+        name, gen_sym = gen_sym(RECURSION_TAG + '_' + str(depth))
+        if name not in constants:
+            return name, gen_sym
+
+
 def _wrap_in_loop(gen_sym, body_nodes, return_name):
 
     new_bindings = dict()
@@ -106,15 +431,172 @@ def _wrap_in_loop(gen_sym, body_nodes, return_name):
     return gen_sym, inlined_body, new_bindings
 
 
-def _build_parameter_assignments(call_node, functiondef_node):
-    assert not call_node.starargs and not call_node.kwargs
-    parameter_assignments = []
-    for callee_arg, fn_arg in zip(call_node.args, functiondef_node.args.args):
-        arg_id = get_fn_arg_id(fn_arg)
-        parameter_assignments.append(ast.Assign(
-            targets=[ast.Name(arg_id, ast.Store())],
-            value=callee_arg))
-    return parameter_assignments
+def _arg_name(arg):
+    # Before Py3.4 ``vararg`` and ``kwarg`` are strings
+    if arg is None or isinstance(arg, str):
+        return arg
+    else:
+        return get_fn_arg_id(arg)
+
+
+def _is_constant_node(node):
+    if sys.version_info >= (3, 8):
+        return type(node) == ast.Constant
+    else:
+        return type(node) in (ast.Num, ast.Str) or (
+            sys.version_info >= (3, 4) and type(node) == ast.NameConstant)
+
+
+def _call_arguments(call_node, gen_sym, constants):
+    """
+    Returns the lists of positional argument nodes and ``(name, node)`` keyword pairs
+    of a call, with the known ``*args`` and ``**kwds`` expanded,
+    the new ``gen_sym`` and the bindings for the expanded values;
+    or ``None`` if some of them are not known.
+    """
+    new_bindings = {}
+
+    def known_value(node):
+        evaluated, value = try_peval_expression(node, constants)
+        return value if evaluated else None
+
+    # Before Py3.5 ``*args`` and ``**kwds`` are separate fields of a call
+    args = list(call_node.args)
+    starargs = getattr(call_node, 'starargs', None)
+    if starargs is not None:
+        args.append(ast.Starred(value=starargs, ctx=ast.Load()))
+    keywords = list(call_node.keywords)
+    kwargs = getattr(call_node, 'kwargs', None)
+    if kwargs is not None:
+        keywords.append(ast.keyword(arg=None, value=kwargs))
+
+    positional = []
+    for arg in args:
+        if type(arg) == ast.Starred:
+            values = known_value(arg.value)
+            if type(values) not in (tuple, list):
+                return None
+            for value in values:
+                value_node, gen_sym, binding = value_to_node(value, gen_sym)
+                new_bindings.update(binding)
+                positional.append(value_node)
+        else:
+            positional.append(arg)
+
+    named = []
+    for keyword in keywords:
+        if keyword.arg is None:
+            values = known_value(keyword.value)
+            if type(values) != dict or not all(isinstance(key, str) for key in values):
+                return None
+            for key, value in values.items():
+                value_node, gen_sym, binding = value_to_node(value, gen_sym)
+                new_bindings.update(binding)
+                named.append((key, value_node))
+        else:
+            named.append((keyword.arg, keyword.value))
+
+    return positional, named, gen_sym, new_bindings
+
+
+def _build_parameter_assignments(gen_sym, call_node, functiondef_node, fn, constants):
+    """
+    Binds the arguments of ``call_node`` to the parameters of ``functiondef_node``
+    (the definition of the function object ``fn``, possibly with mangled names)
+    in the same way ``inspect.Signature.bind()`` does,
+    and returns a tuple ``(assignments, gen_sym, new_bindings)``,
+    where ``assignments`` is a list of assignments of the argument expressions
+    (in the order of evaluation) to the parameters, followed by the assignments
+    of the default values, and of the tuple and the dictionary for ``*args`` and ``**kwds``.
+    Returns ``None`` if the arguments cannot be bound.
+    """
+    result = _call_arguments(call_node, gen_sym, constants)
+    if result is None:
+        return None
+    positional, named, gen_sym, new_bindings = result
+
+    args = functiondef_node.args
+    posonly_params = [get_fn_arg_id(arg) for arg in getattr(args, 'posonlyargs', [])]
+    positional_params = posonly_params + [get_fn_arg_id(arg) for arg in args.args]
+    kwonly_params = [get_fn_arg_id(arg) for arg in getattr(args, 'kwonlyargs', [])]
+    vararg = _arg_name(args.vararg)
+    kwarg = _arg_name(args.kwarg)
+
+    # The original names of the parameters (the ones used for keyword arguments
+    # and in ``__kwdefaults__``) in the same order as the mangled ones.
+    code = fn.__code__
+    original_names = code.co_varnames[
+        :code.co_argcount + getattr(code, 'co_kwonlyargcount', 0)]
+    by_name = dict(zip(original_names, positional_params + kwonly_params))
+
+    assignments = []
+    bound = set()
+    packed_args = []
+    packed_kwds = []
+
+    def assign(name, value_node):
+        assignments.append(ast.Assign(targets=[ast.Name(id=name, ctx=ast.Store())], value=value_node))
+        bound.add(name)
+
+    def pack(value_node, gen_sym):
+        # The packed arguments must be evaluated in the same order as in the call,
+        # so they are saved to temporary variables, unless they are constants.
+        if _is_constant_node(value_node):
+            return value_node, gen_sym
+        temp_name, gen_sym = gen_sym('arg')
+        assign(temp_name, value_node)
+        return ast.Name(id=temp_name, ctx=ast.Load()), gen_sym
+
+    for i, value_node in enumerate(positional):
+        if i < len(positional_params):
+            assign(positional_params[i], value_node)
+        elif vararg is not None:
+            value_node, gen_sym = pack(value_node, gen_sym)
+            packed_args.append(value_node)
+        else:
+            return None
+
+    for name, value_node in named:
+        param = by_name.get(name)
+        if param is not None and param not in posonly_params:
+            if param in bound:
+                return None
+            assign(param, value_node)
+        elif kwarg is not None:
+            if name in [key for key, _ in packed_kwds]:
+                return None
+            value_node, gen_sym = pack(value_node, gen_sym)
+            packed_kwds.append((name, value_node))
+        else:
+            return None
+
+    # The default values are taken from the function object,
+    # since the expressions in the definition were evaluated in its scope.
+    defaults = dict(zip(positional_params[::-1], (fn.__defaults__ or ())[::-1]))
+    kwdefaults = getattr(fn, '__kwdefaults__', None) or {}
+    for original_name, param in zip(original_names, positional_params + kwonly_params):
+        if param in bound:
+            continue
+        if param in defaults:
+            value = defaults[param]
+        elif original_name in kwdefaults:
+            value = kwdefaults[original_name]
+        else:
+            return None
+        value_node, gen_sym, binding = value_to_node(value, gen_sym)
+        new_bindings.update(binding)
+        assign(param, value_node)
+
+    if vararg is not None:
+        assign(vararg, ast.Tuple(elts=packed_args, ctx=ast.Load()))
+    if kwarg is not None:
+        key_nodes = []
+        for key, _ in packed_kwds:
+            key_node, gen_sym, binding = value_to_node(key, gen_sym)
+            key_nodes.append(key_node)
+        assign(kwarg, ast.Dict(keys=key_nodes, values=[value for _, value in packed_kwds]))
+
+    return assignments, gen_sym, new_bindings
 
 
 def _handle_loop(node, state, ctx, visit_after, visiting_after, walk_field, **kwds):
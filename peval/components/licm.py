@@ -0,0 +1,450 @@
+"""
+Loop-invariant code motion.
+"""
+
+import ast
+
+from peval.wisdom import is_known_pure
+from peval.core.cfg import build_cfg
+from peval.core.expression import try_peval_expression
+from peval.core.gensym import GenSym
+from peval.core.symbol_finder import find_symbol_creations, find_unassigned_usages
+from peval.tools import ast_walker, ast_transformer, replace_fields
+
+
+INVARIANT_TAG = 'invariant'
+RANGE_TAG = 'range'
+
+
+# Nodes that make a loop ineligible for the code motion:
+# nested scopes can see the state of the loop at an unknown moment,
+# suspensions let the outside code mutate it, exception handlers would catch
+# the exceptions from the hoisted expressions at a different place,
+# and the rest create or delete names in ways ``find_symbol_creations()`` does not track.
+_FORBIDDEN_NODES = tuple(
+    getattr(ast, name) for name in (
+        'FunctionDef', 'AsyncFunctionDef', 'ClassDef', 'Lambda',
+        'GeneratorExp', 'ListComp', 'SetComp', 'DictComp',
+        'Global', 'Nonlocal', 'Yield', 'YieldFrom', 'Await',
+        'Try', 'TryStar', 'TryExcept', 'TryFinally', 'With', 'AsyncWith', 'AsyncFor',
+        'Delete', 'Exec', 'Match')
+    if hasattr(ast, name))
+
+# Expressions that can be hoisted (if the names they use are not assigned in the loop).
+_INVARIANT_TYPES = tuple(
+    getattr(ast, name) for name in (
+        'Name', 'Constant', 'Num', 'Str', 'Bytes', 'NameConstant', 'Ellipsis',
+        'BinOp', 'UnaryOp', 'Compare', 'BoolOp', 'Tuple', 'Attribute', 'Subscript',
+        'Index', 'Slice', 'ExtSlice', 'Call', 'keyword')
+    if hasattr(ast, name))
+
+# Auxiliary nodes (contexts and operators) that can be a part of any expression.
+_AUXILIARY_TYPES = (ast.expr_context, ast.operator, ast.unaryop, ast.cmpop, ast.boolop)
+
+_TRIVIAL_TYPES = tuple(
+    getattr(ast, name) for name in (
+        'Name', 'Constant', 'Num', 'Str', 'Bytes', 'NameConstant', 'Ellipsis')
+    if hasattr(ast, name))
+
+# Expressions that cannot raise an exception themselves
+# (provided that their subexpressions did not, and the names are assigned).
+_NONRAISING_TYPES = tuple(
+    getattr(ast, name) for name in (
+        'Name', 'Constant', 'Num', 'Str', 'Bytes', 'NameConstant', 'Ellipsis', 'Tuple', 'List')
+    if hasattr(ast, name))
+
+# Statements that can enclose a loop and catch (or suppress) the exceptions raised in it.
+_HANDLING_NODES = tuple(
+    getattr(ast, name) for name in (
+        'Try', 'TryStar', 'TryExcept', 'TryFinally', 'With', 'AsyncWith')
+    if hasattr(ast, name))
+
+
+def hoist_invariants(tree, constants):
+    """
+    Moves the loop-invariant expressions out of ``while`` loops
+    and ``for`` loops over ``range()``.
+
+    The natural loops are found using the dominators of the control flow graph
+    of the function. In a loop that does not mutate anything but local variables
+    (all the calls in it are to known pure functions, see
+    :py:func:`~peval.wisdom.is_known_pure`, and there are no assignments to attributes
+    or items), the maximal subexpressions that do not use the variables assigned in the loop
+    are evaluated once, before the loop, and saved in temporary variables.
+    Only the expressions evaluated on every iteration (that is, the ones in the statements
+    dominating all the back edges and the exits of the loop) are hoisted,
+    and their evaluation is guarded by the loop condition (or by the range being non-empty),
+    so that they are not evaluated if the loop body is not executed.
+    Nested loops are processed before the outer ones.
+
+    Since any of the hoisted expressions can raise an exception, an expression is only hoisted
+    if nothing that can raise is evaluated before it in the first iteration
+    (not counting the loop condition, which the guard evaluates first as well),
+    so the exception is raised at the same point in the computation.
+    The loops inside ``try`` and ``with`` blocks are not processed,
+    since the handlers could see the variables assigned in the first iteration
+    before the exception.
+    The augmented assignments to local variables (e.g. ``x += [1]``) are assumed
+    not to mutate the objects that can be referenced by other names.
+    """
+    cfg = build_cfg(tree.body)
+    graph = cfg.graph
+    dominators = graph.dominators(cfg.enter)
+
+    handled = set()
+    for node in ast.walk(tree):
+        if isinstance(node, _HANDLING_NODES):
+            handled.update(id(subnode) for subnode in ast.walk(node))
+
+    loops = {}
+    for loop in graph.natural_loops(cfg.enter, dominators=dominators):
+        header = graph._nodes[loop.header].ast_node
+        if type(header) not in (ast.While, ast.For) or id(header) in handled:
+            continue
+        loops[id(header)] = _evaluated_statements(graph, dominators, loop)
+
+    if len(loops) == 0:
+        return tree, constants
+
+    # The names of the local variables that are assigned before every loop.
+    assigned_before = {}
+    find_unassigned_usages(tree.body, find_symbol_creations(tree.args), assigned_before)
+    local_names = find_symbol_creations(tree)
+
+    gen_sym = GenSym.for_tree(tree)
+    new_tree, state = _hoist_invariants_walker(
+        tree, state=dict(gen_sym=gen_sym), ctx=dict(
+            constants=constants, loops=loops, assigned_before=assigned_before,
+            local_names=local_names))
+    return new_tree, constants
+
+
+def _evaluated_statements(graph, dominators, loop):
+    """
+    Returns the list of statements of the loop (not counting the header)
+    that are executed on every iteration which ends by jumping back to the header
+    or by leaving the loop.
+    """
+    ends = loop.latches + [
+        node_id for node_id in loop.exiting_nodes(graph) if node_id != loop.header]
+    return [
+        graph._nodes[node_id].ast_node for node_id in sorted(loop.nodes)
+        if node_id != loop.header
+        and all(dominators.dominates(node_id, end_id) for end_id in ends)]
+
+
+def _loop_parts(node):
+    # The parts of a loop that are evaluated on every iteration (that is, excluding ``orelse``)
+    if type(node) == ast.While:
+        return [node.test] + node.body
+    else:
+        return [node.target] + node.body
+
+
+def _is_mutation_free(node, constants):
+    """
+    Returns ``True`` if the loop ``node`` can only change the values of local variables.
+    """
+    for part in _loop_parts(node):
+        for subnode in ast.walk(part):
+            if isinstance(subnode, _FORBIDDEN_NODES):
+                return False
+            if (type(subnode) in (ast.Attribute, ast.Subscript)
+                    and type(subnode.ctx) != ast.Load):
+                return False
+            if type(subnode) == ast.Call:
+                evaluated, fn = try_peval_expression(subnode.func, constants)
+                if not evaluated or not is_known_pure(fn):
+                    return False
+    return True
+
+
+def _range_guard(node, constants):
+    """
+    Returns the expression of the iterable of a ``for`` loop if it is a ``range()`` object,
+    or ``None`` otherwise.
+    """
+    iterable = node.iter
+    if type(iterable) == ast.Name and iterable.id.startswith('__peval_' + RANGE_TAG + '_'):
+        # Created by this component during one of the previous passes
+        return iterable
+    if type(iterable) == ast.Call:
+        evaluated, fn = try_peval_expression(iterable.func, constants)
+        if evaluated and fn is range:
+            return iterable
+    return None
+
+
+def _is_invariant(node, assigned_names):
+    for subnode in ast.walk(node):
+        if isinstance(subnode, _AUXILIARY_TYPES):
+            continue
+        if not isinstance(subnode, _INVARIANT_TYPES):
+            return False
+        if type(subnode) == ast.Name and subnode.id in assigned_names:
+            return False
+    return True
+
+
+def _unconditional_children(node):
+    # The subexpressions of ``node`` that are evaluated every time ``node`` is evaluated
+    if type(node) == ast.BoolOp:
+        return node.values[:1]
+    elif type(node) == ast.Compare:
+        return [node.left, node.comparators[0]]
+    elif type(node) == ast.IfExp:
+        return [node.test]
+    elif isinstance(node, _FORBIDDEN_NODES):
+        return []
+    else:
+        return [
+            child.value if type(child) == ast.keyword else child
+            for child in ast.iter_child_nodes(node)]
+
+
+def _find_invariants(node, assigned_names, constants, invariants):
+    """
+    Adds the maximal non-trivial invariant subexpressions of ``node``
+    (that is, the ones that will be evaluated if ``node`` is evaluated)
+    to the ``invariants`` dictionary (mapping their dumps to the nodes).
+    """
+    if not isinstance(node, ast.expr):
+        return
+
+    if _is_invariant(node, assigned_names):
+        if isinstance(node, _TRIVIAL_TYPES):
+            return
+        # Expressions with known values are left to ``fold``
+        evaluated, _ = try_peval_expression(node, constants)
+        if not evaluated:
+            invariants.setdefault(ast.dump(node), node)
+        return
+
+    for child in _unconditional_children(node):
+        _find_invariants(child, assigned_names, constants, invariants)
+
+
+def _evaluated_expressions(statement):
+    # The expressions evaluated every time ``statement`` is executed
+    if type(statement) in (ast.Assign, ast.AugAssign, ast.Expr, ast.Return):
+        return [statement.value]
+    elif type(statement) in (ast.If, ast.While, ast.Assert):
+        return [statement.test]
+    elif type(statement) == ast.For:
+        return [statement.iter]
+    else:
+        return []
+
+
+def _can_raise(node, assigned_names, local_names, constants):
+    """
+    Returns ``True`` if the evaluation of ``node`` itself (after its subexpressions)
+    can raise an exception. ``assigned_names`` are the local variables known to be assigned.
+    """
+    if isinstance(node, _AUXILIARY_TYPES + (ast.keyword,)):
+        return False
+    if not isinstance(node, _NONRAISING_TYPES):
+        return True
+    if type(node) == ast.Name and type(node.ctx) == ast.Load:
+        if node.id in local_names:
+            return node.id not in assigned_names
+        else:
+            return node.id not in constants
+    return False
+
+
+class _FirstIteration(object):
+    """
+    Follows the order of evaluation of the expressions in the first iteration of a loop,
+    collecting the invariants (from the dictionary of their dumps to the nodes)
+    evaluated before anything that can raise an exception.
+    """
+
+    def __init__(self, invariants, assigned_names, local_names, constants):
+        self.invariants = invariants
+        self.assigned_names = assigned_names
+        self.local_names = local_names
+        self.constants = constants
+        self.found = []
+        self.stopped = False
+
+    def _can_raise(self, node):
+        return _can_raise(node, self.assigned_names, self.local_names, self.constants)
+
+    def expression(self, node):
+        if self.stopped:
+            return
+
+        dump = ast.dump(node) if isinstance(node, ast.expr) else None
+        if dump in self.invariants:
+            # The exceptions from the subexpressions are raised in the same order
+            if dump not in self.found:
+                self.found.append(dump)
+            return
+
+        if type(node) == ast.BoolOp:
+            unconditional = node.values[:1]
+        elif type(node) == ast.IfExp:
+            unconditional = [node.test]
+        else:
+            unconditional = list(ast.iter_child_nodes(node))
+
+        for child in unconditional:
+            self.expression(child)
+        # The subexpressions that may or may not be evaluated
+        for child in ast.iter_child_nodes(node):
+            if child not in unconditional and any(
+                    self._can_raise(subnode) for subnode in ast.walk(child)):
+                self.stopped = True
+        if self._can_raise(node):
+            self.stopped = True
+
+    def statements(self, statements):
+        for statement in statements:
+            if self.stopped:
+                return
+            stmt_type = type(statement)
+            if stmt_type in (ast.Assign, ast.Expr):
+                self.expression(statement.value)
+                if stmt_type == ast.Assign and any(
+                        type(target) != ast.Name for target in statement.targets):
+                    # Unpacking can raise
+                    self.stopped = True
+            elif stmt_type == ast.AugAssign and type(statement.target) == ast.Name:
+                self.expression(ast.Name(id=statement.target.id, ctx=ast.Load()))
+                self.expression(statement.value)
+                self.stopped = True
+            elif stmt_type == ast.Pass:
+                pass
+            else:
+                # Either the statement can raise, or the rest of the body may not be executed
+                # (including the truth value of a condition, which can raise too).
+                for expr in _evaluated_expressions(statement):
+                    self.expression(expr)
+                self.stopped = True
+
+
+@ast_transformer
+def _replace_invariants(node, ctx, **kwds):
+    if isinstance(node, ast.expr) and not isinstance(node, _TRIVIAL_TYPES):
+        name = ctx.names.get(ast.dump(node))
+        if name is not None:
+            return ast.Name(id=name, ctx=ast.Load())
+    return node
+
+
+def _hoist(node, statements, gen_sym, constants, assigned_before, local_names):
+    """
+    Returns a list of statements replacing the loop ``node``, and the new ``gen_sym``.
+    """
+    if not _is_mutation_free(node, constants):
+        return node, gen_sym
+
+    if type(node) == ast.For:
+        iterable = _range_guard(node, constants)
+        if iterable is None:
+            return node, gen_sym
+        roots = []
+    else:
+        roots = [node.test]
+
+    for statement in statements:
+        roots.extend(_evaluated_expressions(statement))
+
+    assigned_names = find_symbol_creations(_loop_parts(node))
+    invariants = {}
+    for root in roots:
+        _find_invariants(root, assigned_names, constants, invariants)
+    if len(invariants) == 0:
+        return node, gen_sym
+
+    # Only the invariants evaluated in the first iteration before anything that can raise
+    # are hoisted (in the order of evaluation).
+    # The guard evaluates the loop condition before the ones from the body,
+    # so the latter are followed from the start of the body.
+    if type(node) == ast.While:
+        first_iteration = _FirstIteration(invariants, assigned_before, local_names, constants)
+        first_iteration.expression(node.test)
+        ordered = first_iteration.found
+        body_assigned = assigned_before
+    else:
+        ordered = []
+        body_assigned = assigned_before | find_symbol_creations(node.target)
+    first_iteration = _FirstIteration(invariants, body_assigned, local_names, constants)
+    first_iteration.statements(node.body)
+    ordered += [dump for dump in first_iteration.found if dump not in ordered]
+    if len(ordered) == 0:
+        return node, gen_sym
+
+    names = {}
+    assignments = []
+    for dump in ordered:
+        name, gen_sym = gen_sym(INVARIANT_TAG)
+        names[dump] = name
+        assignments.append(ast.Assign(
+            targets=[ast.Name(id=name, ctx=ast.Store())], value=invariants[dump]))
+
+    ctx = dict(names=names)
+    new_body = _replace_invariants(node.body, ctx=ctx)
+
+    if type(node) == ast.While:
+        # The hoisted expressions from the condition are always evaluated,
+        # and the rest only if the body is going to be executed.
+        new_test = _replace_invariants(node.test, ctx=ctx)
+        test_names = set(
+            names[dump] for dump in ordered
+            if any(ast.dump(subnode) == dump for subnode in ast.walk(node.test)))
+        prelude = [
+            assignment for assignment in assignments if assignment.targets[0].id in test_names]
+        guarded = [
+            assignment for assignment in assignments
+            if assignment.targets[0].id not in test_names]
+        evaluated, value = try_peval_expression(new_test, constants)
+        if len(guarded) > 0 and not (evaluated and value is True):
+            prelude.append(ast.If(test=new_test, body=guarded, orelse=[]))
+        else:
+            prelude.extend(guarded)
+        return prelude + [replace_fields(node, test=new_test, body=new_body)], gen_sym
+    else:
+        if type(iterable) == ast.Name:
+            range_name = iterable.id
+            prelude = []
+        else:
+            range_name, gen_sym = gen_sym(RANGE_TAG)
+            prelude = [ast.Assign(
+                targets=[ast.Name(id=range_name, ctx=ast.Store())], value=iterable)]
+        prelude.append(ast.If(
+            test=ast.Name(id=range_name, ctx=ast.Load()), body=assignments, orelse=[]))
+        new_node = replace_fields(
+            node, iter=ast.Name(id=range_name, ctx=ast.Load()), body=new_body)
+        return prelude + [new_node], gen_sym
+
+
+@ast_walker
+class _hoist_invariants_walker:
+
+    @staticmethod
+    def handle_While(node, state, ctx, visit_after, visiting_after, **kwds):
+        return _handle_loop(node, state, ctx, visit_after, visiting_after)
+
+    @staticmethod
+    def handle_For(node, state, ctx, visit_after, visiting_after, **kwds):
+        return _handle_loop(node, state, ctx, visit_after, visiting_after)
+
+
+def _handle_loop(node, state, ctx, visit_after, visiting_after):
+    if not visiting_after:
+        # Processing the nested loops first
+        visit_after()
+        return node, state
+
+    # If the node was rebuilt because some of the nested loops changed,
+    # its statements are not in the CFG anymore; it will be processed on the next pass.
+    statements = ctx.loops.get(id(node))
+    assigned_names = ctx.assigned_before.get(id(node))
+    if statements is None or assigned_names is None:
+        return node, state
+
+    new_nodes, gen_sym = _hoist(
+        node, statements, state.gen_sym, ctx.constants, assigned_names, ctx.local_names)
+    return new_nodes, state.update(gen_sym=gen_sym)
@@ -0,0 +1,258 @@
+"""
+Expansion of the functions marked with :py:func:`~peval.tags.macro`.
+"""
+
+import ast
+import copy
+import sys
+
+import funcsigs
+
+from peval.tags import is_macro
+from peval.core.value import value_to_node
+from peval.core.expression import try_peval_expression
+from peval.core.function import Function
+from peval.core.mangler import mangle
+from peval.core.gensym import GenSym
+from peval.core.symbol_finder import find_symbol_creations, find_symbol_usages
+from peval.tools import ast_walker, ast_transformer, replace_fields, get_fn_arg_id
+
+
+# Nodes that cannot appear in the body of a macro:
+# nested scopes would not be mangled correctly,
+# and the rest change the control flow of the function the macro is expanded in.
+_FORBIDDEN_NODES = (
+    ast.FunctionDef, ast.ClassDef, ast.Lambda, ast.Global,
+    ast.Yield, ast.Return)
+if sys.version_info >= (3,):
+    _FORBIDDEN_NODES += (ast.Nonlocal, ast.YieldFrom)
+if sys.version_info >= (3, 5):
+    _FORBIDDEN_NODES += (ast.AsyncFunctionDef, ast.Await)
+
+
+class _CannotExpand(Exception):
+    pass
+
+
+def expand_macros(tree, constants):
+    """
+    Expands the calls to the functions marked with :py:func:`~peval.tags.macro`.
+
+    The argument expressions are substituted into the body of the macro as they are
+    (so they are evaluated as many times as the corresponding parameters are used),
+    and the local variables of the macro are mangled.
+    In the statement context (a call being an expression statement)
+    the call is replaced by the body of the macro;
+    in the expression context, the body must consist of a single expression
+    (either an expression statement, or a ``return``), which replaces the call.
+
+    Macros called in the body of a macro are expanded too; recursive macros are not expanded.
+    The parameters of a macro cannot be assigned to, and its body cannot contain
+    ``return`` (except for the single-expression case), ``yield``, ``global``, ``nonlocal``,
+    or nested functions and classes.
+    """
+    gen_sym = GenSym.for_tree(tree)
+    new_tree, state = _expand_macros_walker(
+        tree,
+        state=dict(gen_sym=gen_sym, new_bindings={}),
+        ctx=dict(
+            constants=constants, local_names=find_symbol_creations(tree), expanding=()))
+
+    if new_tree is tree:
+        return tree, constants
+    else:
+        return new_tree, constants.update(state.new_bindings)
+
+
+def _get_macro(node, constants):
+    # Returns the macro function called in ``node``, or ``None``.
+    if type(node) != ast.Call:
+        return None
+    evaluated, fn = try_peval_expression(node.func, constants)
+    if evaluated and is_macro(fn):
+        return fn
+    else:
+        return None
+
+
+def _bind_arguments(call, fn, gen_sym):
+    """
+    Returns a dictionary of parameter names and the corresponding argument nodes
+    (with the nodes of default values for the missing arguments),
+    the new ``gen_sym`` and the bindings for the default values.
+    """
+    if (getattr(call, 'starargs', None) is not None
+            or getattr(call, 'kwargs', None) is not None
+            or (sys.version_info >= (3, 5) and any(type(arg) == ast.Starred for arg in call.args))
+            or any(keyword.arg is None for keyword in call.keywords)):
+        raise _CannotExpand()
+
+    signature = funcsigs.signature(fn)
+    if any(param.kind in (funcsigs.Parameter.VAR_POSITIONAL, funcsigs.Parameter.VAR_KEYWORD)
+            for param in signature.parameters.values()):
+        raise _CannotExpand()
+
+    try:
+        bound = signature.bind(
+            *call.args, **dict((keyword.arg, keyword.value) for keyword in call.keywords))
+    except TypeError:
+        raise _CannotExpand()
+
+    arguments = dict(bound.arguments)
+    new_bindings = {}
+    for name, param in signature.parameters.items():
+        if name not in arguments:
+            arguments[name], gen_sym, binding = value_to_node(param.default, gen_sym)
+            new_bindings.update(binding)
+
+    return arguments, gen_sym, new_bindings
+
+
+@ast_transformer
+class _substitute_names:
+
+    @staticmethod
+    def handle_Name(node, ctx, **kwds):
+        if type(node.ctx) == ast.Load and node.id in ctx.substitutions:
+            # Every use of a parameter gets its own copy of the argument expression,
+            # since some components identify nodes by ``id()``.
+            return copy.deepcopy(ctx.substitutions[node.id])
+        else:
+            return node
+
+
+def _expand(call, fn, gen_sym, ctx, statement_context):
+    """
+    Returns a tuple ``(new_nodes, gen_sym, new_bindings)``, where ``new_nodes``
+    is a list of statements in the statement context, and an expression otherwise.
+    Raises ``_CannotExpand`` if the call cannot be expanded.
+    """
+    if fn in ctx.expanding:
+        raise _CannotExpand()
+
+    arguments, gen_sym, new_bindings = _bind_arguments(call, fn, gen_sym)
+
+    function = Function.from_object(fn)
+    fn_ast = function.tree
+    if type(fn_ast) != ast.FunctionDef:
+        raise _CannotExpand()
+
+    body = fn_ast.body
+    if len(body) > 1 and ast.get_docstring(fn_ast) is not None:
+        body = body[1:]
+    for statement in body:
+        for node in ast.walk(statement):
+            if isinstance(node, _FORBIDDEN_NODES) and not (
+                    type(node) == ast.Return and len(body) == 1 and node is body[0]):
+                raise _CannotExpand()
+
+    # Expanding the macros used in the macro itself, in the context of its own globals
+    fn_constants = function.get_external_variables()
+    body, state = _expand_macros_walker(
+        body,
+        state=dict(gen_sym=gen_sym, new_bindings={}),
+        ctx=dict(
+            constants=fn_constants, local_names=find_symbol_creations(fn_ast),
+            expanding=ctx.expanding + (fn,)))
+    gen_sym = state.gen_sym
+    fn_constants = fn_constants.update(state.new_bindings)
+
+    gen_sym, new_fn_ast = mangle(gen_sym, replace_fields(fn_ast, body=body))
+    body = new_fn_ast.body
+
+    local_names = find_symbol_creations(new_fn_ast)
+    param_names = dict(
+        (get_fn_arg_id(new_arg), arguments[get_fn_arg_id(arg)])
+        for arg, new_arg in zip(_parameters(fn_ast), _parameters(new_fn_ast)))
+
+    # The argument expressions cannot be assigned to
+    if not find_symbol_creations(body).isdisjoint(param_names):
+        raise _CannotExpand()
+
+    substitutions = dict(param_names)
+
+    # The global names used in the macro can refer to different objects
+    # in the function it is expanded in (or be shadowed by its local variables).
+    for name in find_symbol_usages(body):
+        if name in local_names:
+            continue
+        if name not in fn_constants:
+            raise _CannotExpand()
+        value = fn_constants[name]
+        if name not in ctx.local_names and ctx.constants.get(name, _MISSING) is value:
+            continue
+        substitutions[name], gen_sym, binding = value_to_node(value, gen_sym)
+        new_bindings.update(binding)
+
+    body = _substitute_names(body, ctx=dict(substitutions=substitutions))
+
+    if statement_context:
+        if len(body) == 1 and type(body[0]) == ast.Return:
+            body = [ast.Expr(value=body[0].value)]
+        return body, gen_sym, new_bindings
+    else:
+        if (len(body) != 1 or type(body[0]) not in (ast.Expr, ast.Return)
+                or body[0].value is None):
+            raise _CannotExpand()
+        return body[0].value, gen_sym, new_bindings
+
+
+_MISSING = object()
+
+
+def _parameters(function_def):
+    # Returns the list of parameter nodes of a function definition
+    # (the ones that can be bound to arguments in a macro).
+    args = function_def.args
+    return getattr(args, 'posonlyargs', []) + args.args + getattr(args, 'kwonlyargs', [])
+
+
+def _update_state(state, gen_sym, new_bindings):
+    all_bindings = dict(state.new_bindings)
+    all_bindings.update(new_bindings)
+    return state.update(gen_sym=gen_sym, new_bindings=all_bindings)
+
+
+@ast_walker
+class _expand_macros_walker:
+
+    @staticmethod
+    def handle_Expr(node, state, ctx, skip_fields, walk_field, **kwds):
+        fn = _get_macro(node.value, ctx.constants)
+        if fn is None:
+            return node, state
+
+        # The arguments may contain macro calls themselves,
+        # but the call itself is expanded in the statement context.
+        call = node.value
+        new_args, state = walk_field(call.args, state)
+        new_keywords, state = walk_field(call.keywords, state)
+        skip_fields()
+        call = replace_fields(call, args=new_args, keywords=new_keywords)
+
+        try:
+            new_nodes, gen_sym, new_bindings = _expand(
+                call, fn, state.gen_sym, ctx, statement_context=True)
+        except _CannotExpand:
+            return replace_fields(node, value=call), state
+
+        return new_nodes, _update_state(state, gen_sym, new_bindings)
+
+    @staticmethod
+    def handle_Call(node, state, ctx, visit_after, visiting_after, **kwds):
+        if not visiting_after:
+            # Expanding the calls in the arguments first
+            visit_after()
+            return node, state
+
+        fn = _get_macro(node, ctx.constants)
+        if fn is None:
+            return node, state
+
+        try:
+            new_node, gen_sym, new_bindings = _expand(
+                node, fn, state.gen_sym, ctx, statement_context=False)
+        except _CannotExpand:
+            return node, state
+
+        return new_node, _update_state(state, gen_sym, new_bindings)
@@ -15,6 +15,15 @@ def prune_assignments(node, constants):
     return node, constants
 
 
+# Expressions suspending the execution of a generator or a coroutine
+SUSPENSION_TYPES = tuple(
+    getattr(ast, name) for name in ('Yield', 'YieldFrom', 'Await') if hasattr(ast, name))
+
+
+def _has_suspensions(node):
+    return any(isinstance(subnode, SUSPENSION_TYPES) for subnode in ast.walk(node))
+
+
 @ast_transformer
 class remove_unused_assignments:
     @staticmethod
@@ -22,7 +31,12 @@ class remove_unused_assignments:
         if all(type(target) == ast.Name for target in node.targets):
             names = set(target.id for target in node.targets)
             if ctx.used_symbols.isdisjoint(names):
-                return None
+                if _has_suspensions(node.value):
+                    # The value is not needed, but the generator or the coroutine
+                    # must still be suspended at this point.
+                    return ast.Expr(value=node.value)
+                else:
+                    return None
             else:
                 return node
         else:
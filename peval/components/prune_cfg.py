@@ -3,7 +3,6 @@ import copy
 
 from peval.tools import replace_fields, ast_transformer, ast_inspector
 from peval.core.expression import try_peval_expression
-from peval.tools import ast_equal
 
 
 def prune_cfg(node, bindings):
@@ -15,7 +14,8 @@ def prune_cfg(node, bindings):
         for func in (remove_unreachable_statements, simplify_loops, remove_unreachable_branches):
             new_node = func(new_node, ctx=dict(bindings=bindings))
 
-        if ast_equal(new_node, node):
+        # The transformers return the same object if nothing has changed.
+        if new_node is node:
             break
 
         node = new_node
@@ -26,7 +26,8 @@ def prune_cfg(node, bindings):
 @ast_transformer
 def remove_unreachable_statements(node, walk_field, **kwds):
     for attr in ('body', 'orelse'):
-        if hasattr(node, attr):
+        # ``IfExp`` and ``Lambda`` have expressions in these fields
+        if isinstance(getattr(node, attr, None), list):
             old_list = getattr(node, attr)
             new_list = filter_block(old_list)
             if new_list is not old_list:
@@ -61,12 +62,19 @@ def filter_block(node_list):
 class _find_jumps:
 
     @staticmethod
-    def handle_FunctionDef(node, skip_fields, **kwds):
+    def handle_FunctionDef(node, state, skip_fields, **kwds):
         skip_fields()
+        return state
 
     @staticmethod
-    def handle_ClassDef(node, skip_fields, **kwds):
+    def handle_AsyncFunctionDef(node, state, skip_fields, **kwds):
         skip_fields()
+        return state
+
+    @staticmethod
+    def handle_ClassDef(node, state, skip_fields, **kwds):
+        skip_fields()
+        return state
 
     @staticmethod
     def handle_Break(node, state, **kwds):
@@ -85,22 +93,134 @@ def find_jumps(node):
     return _find_jumps(node, state=dict(jumps_counter=0)).jumps_counter
 
 
+@ast_inspector
+class _find_loop_jumps:
+    """
+    Counts the ``break`` and ``continue`` statements belonging to the enclosing loop
+    (that is, not the ones in the bodies of nested loops).
+    """
+
+    @staticmethod
+    def handle_FunctionDef(node, state, skip_fields, **kwds):
+        skip_fields()
+        return state
+
+    @staticmethod
+    def handle_AsyncFunctionDef(node, state, skip_fields, **kwds):
+        skip_fields()
+        return state
+
+    @staticmethod
+    def handle_ClassDef(node, state, skip_fields, **kwds):
+        skip_fields()
+        return state
+
+    @staticmethod
+    def handle_Lambda(node, state, skip_fields, **kwds):
+        skip_fields()
+        return state
+
+    @staticmethod
+    def handle_For(node, state, skip_fields, walk_field, **kwds):
+        # The jumps in ``orelse`` belong to the enclosing loop
+        state = walk_field(node.orelse, state, block_context=True)
+        skip_fields()
+        return state
+
+    handle_AsyncFor = handle_For
+    handle_While = handle_For
+
+    @staticmethod
+    def handle_Break(node, state, **kwds):
+        return state.update(jumps_counter=state.jumps_counter + 1)
+
+    @staticmethod
+    def handle_Continue(node, state, **kwds):
+        return state.update(jumps_counter=state.jumps_counter + 1)
+
+
+def find_loop_jumps(node):
+    return _find_loop_jumps(node, state=dict(jumps_counter=0)).jumps_counter
+
+
+def always_jumps(node_list):
+    """
+    Returns ``True`` if the execution of the statements always ends with a jump
+    (``return``, ``break``, ``continue``, or ``raise``).
+    """
+    if len(node_list) == 0:
+        return False
+    last_node = node_list[-1]
+    if type(last_node) in (ast.Break, ast.Continue, ast.Return, ast.Raise):
+        return True
+    elif type(last_node) == ast.If:
+        return always_jumps(last_node.body) and always_jumps(last_node.orelse)
+    else:
+        return False
+
+
+class _CannotFlatten(Exception):
+    pass
+
+
+def _flatten_loop_body(node_list):
+    """
+    Returns the statements equivalent to ``node_list`` (which are the remaining statements
+    of a loop body executed at most once), with ``break`` statements removed
+    by moving the statements following the conditional jumps into ``else`` branches.
+    Raises ``_CannotFlatten`` if there is a ``continue``, a ``break``
+    inside a statement other than ``if``, or if some statements would have to be duplicated.
+    """
+    new_list = []
+    for i, node in enumerate(node_list):
+        if type(node) == ast.Break:
+            return new_list
+        if find_loop_jumps(node) == 0:
+            new_list.append(node)
+            continue
+        if type(node) != ast.If:
+            raise _CannotFlatten()
+
+        rest = node_list[i+1:]
+        body_jumps = always_jumps(node.body)
+        orelse_jumps = always_jumps(node.orelse)
+        if len(rest) > 0 and not body_jumps and not orelse_jumps:
+            raise _CannotFlatten()
+
+        new_body = _flatten_loop_body(node.body if body_jumps else node.body + rest)
+        new_orelse = _flatten_loop_body(node.orelse if orelse_jumps else node.orelse + rest)
+        if len(new_body) == 0 and len(new_orelse) > 0:
+            new_list.append(ast.If(
+                test=ast.UnaryOp(op=ast.Not(), operand=node.test), body=new_orelse, orelse=[]))
+        else:
+            new_list.append(ast.If(
+                test=node.test, body=new_body if len(new_body) > 0 else [ast.Pass()],
+                orelse=new_orelse))
+        return new_list
+
+    return new_list
+
+
 @ast_transformer
 class simplify_loops:
 
     @staticmethod
     def handle_While(node, **kwds):
-        last_node = node.body[-1]
-        unconditional_jump = type(last_node) in (ast.Break, ast.Raise, ast.Return)
-        if unconditional_jump and find_jumps(node.body) == 1:
-            if type(last_node) == ast.Break:
-                new_body = node.body[:-1]
-            else:
-                new_body = node.body
-            return ast.If(test=node.test, body=new_body, orelse=node.orelse)
-        else:
+        # If the body never reaches its end (and has no ``continue``),
+        # the loop is executed at most once, and can be replaced by an ``if``
+        # (e.g. the loops created for the functions with several returns during inlining).
+        if not always_jumps(node.body):
             return node
 
+        try:
+            new_body = _flatten_loop_body(node.body)
+        except _CannotFlatten:
+            return node
+
+        if len(new_body) == 0:
+            new_body = [ast.Pass()]
+        return ast.If(test=node.test, body=new_body, orelse=node.orelse)
+
 
 @ast_transformer
 class remove_unreachable_branches:
@@ -0,0 +1,195 @@
+"""
+Replacement of self tail calls with loops.
+"""
+
+import ast
+import inspect
+import sys
+
+import funcsigs
+
+from peval.wisdom import is_resumable
+from peval.core.value import value_to_node
+from peval.core.expression import try_peval_expression
+from peval.core.function import Function
+from peval.core.gensym import GenSym
+from peval.core.symbol_finder import (
+    find_symbol_creations, find_symbol_usages, find_unassigned_usages)
+from peval.components.inline import _build_parameter_assignments
+from peval.components.prune_cfg import always_jumps
+from peval.tools import ast_walker, get_fn_arg_id, replace_fields
+
+
+# Nested scopes could capture the parameters, which are reassigned in the loop,
+# and generators are not executed at the time of the call.
+_FORBIDDEN_NODES = (
+    ast.FunctionDef, ast.ClassDef, ast.Lambda, ast.GeneratorExp, ast.Yield)
+if sys.version_info >= (3,):
+    _FORBIDDEN_NODES += (ast.YieldFrom,)
+if sys.version_info >= (3, 5):
+    _FORBIDDEN_NODES += (ast.AsyncFunctionDef, ast.Await)
+
+
+def eliminate_tail_calls(tree, constants):
+    """
+    Replaces the tail calls of a function to itself (``return f(...)`` in the body of ``f``)
+    with the reassignment of its parameters and a jump to the beginning of the body,
+    which is wrapped in a ``while`` loop.
+    The calls in loops, ``try`` and ``with`` blocks are not replaced,
+    and neither are the calls in a function with local variables
+    that can be used before being assigned (they would keep the values
+    from the previous iteration instead of raising ``UnboundLocalError``).
+
+    If some of the parameters were bound by :py:meth:`~peval.core.function.Function.bind_partial`
+    (that is, assigned at the start of the body), the loop is placed after their assignments,
+    so that they become the state of the loop.
+    """
+    if type(tree) != ast.FunctionDef:
+        return tree, constants
+
+    fn = constants.get(tree.name)
+    if (not inspect.isfunction(fn) or is_resumable(fn)
+            or tree.name in find_symbol_creations(tree)):
+        return tree, constants
+
+    for statement in tree.body:
+        for node in ast.walk(statement):
+            if isinstance(node, _FORBIDDEN_NODES):
+                return tree, constants
+
+    fn_params = _parameter_names(funcsigs.signature(fn))
+    params = _definition_parameter_names(tree)
+    if not set(params).issubset(fn_params):
+        return tree, constants
+
+    # The statements before the loop: the docstring,
+    # and the assignments of the bound parameters.
+    bound_params = set(fn_params) - set(params)
+    prelude_length = 0
+    if ast.get_docstring(tree) is not None:
+        prelude_length += 1
+    for statement in tree.body[prelude_length:]:
+        if len(bound_params) == 0:
+            break
+        if (type(statement) != ast.Assign or len(statement.targets) != 1
+                or type(statement.targets[0]) != ast.Name
+                or statement.targets[0].id not in bound_params):
+            return tree, constants
+        bound_params.remove(statement.targets[0].id)
+        prelude_length += 1
+
+    prelude = tree.body[:prelude_length]
+    body = tree.body[prelude_length:]
+
+    gen_sym = GenSym.for_tree(tree)
+    new_body, state = _replace_tail_calls(
+        body,
+        state=dict(gen_sym=gen_sym, new_bindings={}),
+        ctx=dict(
+            fn=fn, fn_def=Function.from_object(fn).tree, fn_params=fn_params,
+            constants=constants))
+
+    if new_body is body:
+        return tree, constants
+
+    # The local variables keep their values between the iterations of the loop,
+    # while every call starts with only the parameters assigned.
+    # So if a variable can be used before being assigned (and raise ``UnboundLocalError``),
+    # it could get the value from the previous iteration instead.
+    if len(find_unassigned_usages(body, fn_params)) > 0:
+        return tree, constants
+
+    if not always_jumps(new_body):
+        new_body = new_body + [ast.Return(value=None)]
+
+    true_node, gen_sym, true_binding = value_to_node(True, state.gen_sym)
+    new_bindings = dict(state.new_bindings)
+    new_bindings.update(true_binding)
+
+    new_tree = replace_fields(
+        tree, body=prelude + [ast.While(test=true_node, body=new_body, orelse=[])])
+    return new_tree, constants.update(new_bindings)
+
+
+def _parameter_names(signature):
+    return [param.name for param in signature.parameters.values()]
+
+
+def _definition_parameter_names(function_def):
+    args = function_def.args
+    names = [get_fn_arg_id(arg) for arg in getattr(args, 'posonlyargs', []) + args.args]
+    for arg in (args.vararg, args.kwarg) + tuple(getattr(args, 'kwonlyargs', [])):
+        if arg is None:
+            continue
+        # Before Py3.4 ``vararg`` and ``kwarg`` are strings
+        names.append(arg if isinstance(arg, str) else get_fn_arg_id(arg))
+    return names
+
+
+@ast_walker
+class _replace_tail_calls:
+
+    @staticmethod
+    def handle_Return(node, state, ctx, **kwds):
+        call = node.value
+        if type(call) != ast.Call:
+            return node, state
+
+        evaluated, fn = try_peval_expression(call.func, ctx.constants)
+        if not evaluated or fn is not ctx.fn:
+            return node, state
+
+        result = _build_parameter_assignments(
+            state.gen_sym, call, ctx.fn_def, ctx.fn, ctx.constants)
+        if result is None:
+            return node, state
+        assignments, gen_sym, binding = result
+
+        if any(assignment.targets[0].id not in ctx.fn_params for assignment in assignments):
+            # Temporary variables for packed arguments
+            return node, state
+
+        # The parameters passed unchanged do not need to be reassigned
+        assignments = [
+            assignment for assignment in assignments
+            if not (type(assignment.value) == ast.Name
+                and assignment.value.id == assignment.targets[0].id)]
+
+        # All the arguments must be evaluated before the parameters are reassigned,
+        # so if some of them use the parameters assigned before,
+        # the assignments are merged into a single one.
+        assigned = set()
+        for assignment in assignments:
+            if not assigned.isdisjoint(find_symbol_usages(assignment.value)):
+                assignments = [ast.Assign(
+                    targets=[ast.Tuple(
+                        elts=[assignment.targets[0] for assignment in assignments],
+                        ctx=ast.Store())],
+                    value=ast.Tuple(
+                        elts=[assignment.value for assignment in assignments],
+                        ctx=ast.Load()))]
+                break
+            assigned.add(assignment.targets[0].id)
+
+        new_bindings = dict(state.new_bindings)
+        new_bindings.update(binding)
+        return (
+            assignments + [ast.Continue()],
+            state.update(gen_sym=gen_sym, new_bindings=new_bindings))
+
+    # The ``continue`` would refer to a different loop, or skip the cleanup code
+    # (which must be executed after the call).
+
+    @staticmethod
+    def handle_For(node, state, skip_fields, **kwds):
+        skip_fields()
+        return node, state
+
+    handle_AsyncFor = handle_For
+    handle_While = handle_For
+    handle_Try = handle_For
+    handle_TryExcept = handle_For
+    handle_TryFinally = handle_For
+    handle_TryStar = handle_For
+    handle_With = handle_For
+    handle_AsyncWith = handle_For
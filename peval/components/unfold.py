@@ -0,0 +1,701 @@
+"""
+Polyvariant specialization of ``while`` loops with static state
+(e.g. the main loop of an interpreter, where the program and the program counter are known,
+but the data is not).
+"""
+
+import ast
+import sys
+
+from peval.core.gensym import GenSym
+from peval.core.value import value_to_node
+from peval.core.expression import peval_expression, try_peval_expression, find_mutated_names
+from peval.core.symbol_finder import find_symbol_creations, find_symbol_usages
+from peval.components.unroll import has_loop_jumps
+from peval.tools import ast_walker, ast_inspector, replace_fields, immutablechainmap
+from peval.wisdom import is_immutable_value
+
+
+# The maximum number of distinct static states at the loop head.
+DEFAULT_MAX_STATES = 64
+
+# The maximum number of statements in the residual code of a loop.
+DEFAULT_MAX_SIZE = 2000
+
+# The types of values a variable assigned in the loop can have to be treated as static.
+# The values are substituted into the residual code and are used as parts of state keys,
+# so they must be immutable and hashable.
+STATIC_TYPES = (bool, int, float, complex, str, bytes, tuple, frozenset, type(None))
+if sys.version_info < (3,):
+    STATIC_TYPES += (long, unicode)
+
+# The ``GenSym`` tag of the state variables of dispatching loops.
+STATE_TAG = 'state'
+STATE_PREFIX = '__peval_' + STATE_TAG + '_'
+
+
+class _CannotUnfold(Exception):
+    pass
+
+
+class _TooLarge(Exception):
+    pass
+
+
+def unfold_loops(tree, constants,
+        max_states=DEFAULT_MAX_STATES, max_size=DEFAULT_MAX_SIZE, static_names=None):
+    """
+    Specializes ``while`` loops for every distinct combination of the values
+    of the static variables (the ones whose values are known at the entry to the loop,
+    and can be calculated at compile time within it) at the loop head.
+
+    The known iterations are unfolded into straight-line code;
+    if the loop head can be reached with the same static state from several places
+    (e.g. because of a jump depending on dynamic data), the residual code is a single
+    ``while True`` loop dispatching on the static state.
+
+    The generalization policy guarantees termination:
+    if the specialization results in more than ``max_states`` static states
+    or more than ``max_size`` residual statements,
+    the variable with the most distinct values is made dynamic, and the loop is specialized again.
+    If ``static_names`` is given, only the variables from it can be static.
+    Loops with no static variables, or the ones where the static variables
+    do not decide the control flow (see ``_controls_flow()``), are left unchanged.
+
+    Only loops in a function without nested functions, classes, lambdas,
+    ``global`` or ``nonlocal`` declarations are processed.
+    """
+
+    if _has_unsupported_scopes(tree):
+        return tree, constants
+
+    # Local variables shadow the globals with the same names,
+    # so their values are not known in general.
+    external_constants = constants
+    for name in find_symbol_creations(tree):
+        external_constants = external_constants.del_(name)
+
+    # Neither are the values of mutable objects the function can change,
+    # since the changes are not tracked.
+    mutated_names = find_mutated_names(tree, constants)
+    for name in mutated_names:
+        if name in external_constants and not is_immutable_value(external_constants[name]):
+            external_constants = external_constants.del_(name)
+
+    prefixes = {}
+    find_loop_prefixes(tree.body, prefixes)
+
+    gen_sym = GenSym.for_tree(tree)
+    new_tree, state = _unfold_loops_walker(
+        tree,
+        state=dict(gen_sym=gen_sym, new_bindings={}),
+        ctx=dict(
+            tree=tree, prefixes=prefixes, external_constants=external_constants,
+            mutated_names=mutated_names,
+            max_states=max_states, max_size=max_size, static_names=static_names))
+
+    if new_tree is tree:
+        return tree, constants
+    else:
+        return new_tree, constants.update(state.new_bindings)
+
+
+@ast_inspector
+class _find_unsupported_scopes:
+
+    @staticmethod
+    def handle_FunctionDef(node, state, **kwds):
+        return state.update(found=True)
+
+    @staticmethod
+    def handle_AsyncFunctionDef(node, state, **kwds):
+        return state.update(found=True)
+
+    @staticmethod
+    def handle_ClassDef(node, state, **kwds):
+        return state.update(found=True)
+
+    @staticmethod
+    def handle_Lambda(node, state, **kwds):
+        return state.update(found=True)
+
+    @staticmethod
+    def handle_Global(node, state, **kwds):
+        return state.update(found=True)
+
+    @staticmethod
+    def handle_Nonlocal(node, state, **kwds):
+        return state.update(found=True)
+
+
+def _has_unsupported_scopes(tree):
+    # Nested scopes can refer to the static variables,
+    # which are not updated in the residual code.
+    return _find_unsupported_scopes(tree.body, state=dict(found=False)).found
+
+
+def find_loop_prefixes(statements, prefixes):
+    """
+    Saves the statements preceding every ``while`` loop in the same block
+    (which are executed before every entry to the loop) to ``prefixes``,
+    with the ``id()`` of the loop node as the key.
+    """
+    for i, statement in enumerate(statements):
+        if type(statement) == ast.While:
+            prefixes[id(statement)] = statements[:i]
+
+        for field in ('body', 'orelse', 'finalbody'):
+            block = getattr(statement, field, None)
+            if type(block) == list:
+                find_loop_prefixes(block, prefixes)
+        for handler in getattr(statement, 'handlers', []):
+            find_loop_prefixes(handler.body, prefixes)
+        for match_case in getattr(statement, 'cases', []):
+            find_loop_prefixes(match_case.body, prefixes)
+
+
+def _controls_flow(loop, static_env, static_loop_names, external_constants):
+    """
+    Returns ``True`` if the static state decides the control flow of the loop,
+    that is, if the loop condition, the condition of an ``if`` in its body,
+    or a subscript in its body (e.g. fetching an instruction of an interpreted program)
+    uses the static variables and can be evaluated at the entry to the loop.
+    Other loops (e.g. accumulating over a dynamic sequence with a known initial counter)
+    would only be duplicated by the specialization.
+    """
+    env = immutablechainmap(static_env, external_constants)
+    expressions = [loop.test]
+    for statement in loop.body:
+        for node in ast.walk(statement):
+            if type(node) == ast.If:
+                expressions.append(node.test)
+            elif type(node) == ast.Subscript:
+                expressions.append(node)
+
+    for expression in expressions:
+        if set(find_symbol_usages(expression)).isdisjoint(static_loop_names):
+            continue
+        evaluated, _ = try_peval_expression(expression, env)
+        if evaluated:
+            return True
+    return False
+
+
+def _is_static_value(value):
+    if type(value) not in STATIC_TYPES:
+        return False
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def _assigned_names(statement):
+    # ``except ... as name`` only binds a string (since Py3),
+    # which is not reported by ``find_symbol_creations()``.
+    names = set(find_symbol_creations(statement))
+    for node in ast.walk(statement):
+        if type(node) == ast.ExceptHandler and node.name is not None:
+            names.add(node.name if isinstance(node.name, str) else node.name.id)
+    return names
+
+
+def _dead_at_head(loop, tree):
+    """
+    Returns the names of variables assigned at the beginning of the loop body
+    before being read, and not used outside of the loop.
+    Their values at the loop head are never used.
+    """
+    loop_nodes = set(id(node) for node in ast.walk(loop))
+    used_outside = set(
+        node.id for node in ast.walk(tree)
+        if type(node) == ast.Name and type(node.ctx) == ast.Load and id(node) not in loop_nodes)
+
+    # The ``else`` clause is executed right after the loop head
+    read = set(find_symbol_usages(loop.test)) | set(find_symbol_usages(loop.orelse))
+    dead = set()
+    for statement in loop.body:
+        if type(statement) != ast.Assign:
+            break
+        read.update(find_symbol_usages(statement.value))
+        for target in statement.targets:
+            elts = target.elts if type(target) == ast.Tuple else [target]
+            if not all(type(elt) == ast.Name for elt in elts):
+                return dead
+            dead.update(
+                elt.id for elt in elts if elt.id not in read and elt.id not in used_outside)
+
+    return dead
+
+
+def _entry_values(prefix, external_constants, mutated_names):
+    """
+    Returns a dictionary of values of the local variables known after executing
+    the list of statements ``prefix``
+    (except for the mutable values of the variables from ``mutated_names``).
+    """
+    env = {}
+    for statement in prefix:
+        if (type(statement) == ast.Assign and len(statement.targets) == 1
+                and type(statement.targets[0]) == ast.Name):
+            name = statement.targets[0].id
+            evaluated, value = try_peval_expression(
+                statement.value, immutablechainmap(env, external_constants))
+            if evaluated and (name not in mutated_names or is_immutable_value(value)):
+                env[name] = value
+                continue
+
+        for name in _assigned_names(statement):
+            env.pop(name, None)
+
+    return env
+
+
+class _Jump(object):
+    """
+    A placeholder in the residual code for a jump to the loop head with the given static state.
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+
+class _Exit(object):
+    """
+    A placeholder in the residual code for an exit from the loop,
+    with the assignments of the final values of the static variables.
+    """
+
+    def __init__(self, assignments):
+        self.assignments = assignments
+
+
+class _LoopSpecializer(object):
+    """
+    Specializes the iterations of the ``loop`` for every static state reachable
+    from the entry state ``entry_env`` (a dictionary of the known values of local variables).
+    ``loop_names`` are the names of variables assigned in the loop,
+    ``dynamic_names`` are the ones that cannot be static,
+    and ``dead_names`` are the ones whose values at the loop head are never used
+    (and therefore are not a part of the static state).
+    """
+
+    def __init__(self, loop, entry_env, external_constants, loop_names, dynamic_names,
+            dead_names, gen_sym, max_states, max_size):
+        self.loop = loop
+        self.external_constants = external_constants
+        self.loop_names = loop_names
+        self.dynamic_names = dynamic_names
+        self.state_names = loop_names - dead_names
+        self.gen_sym = gen_sym
+        self.max_states = max_states
+        self.max_size = max_size
+
+        self.new_bindings = {}
+        self.size = 0
+
+        # The keys of static states in the order of discovery,
+        # their environments, and the residual code of the corresponding iterations.
+        self.keys = []
+        self.envs = {}
+        self.blocks = {}
+
+        self.entry_env = dict(
+            (name, value) for name, value in entry_env.items()
+            if name not in dynamic_names
+            and (name not in loop_names or _is_static_value(value)))
+
+    def specialize(self):
+        """
+        Specializes the loop body for all the reachable static states.
+        Raises ``_TooLarge`` if the limits are exceeded.
+        """
+        self.entry_key = self._request(self.entry_env)
+        while len(self.blocks) < len(self.keys):
+            key = self.keys[len(self.blocks)]
+            self.blocks[key] = self._specialize_iteration(dict(self.envs[key]))
+
+    def _state_key(self, env):
+        return tuple(
+            (name, type(env[name]), env[name])
+            for name in sorted(env) if name in self.state_names)
+
+    def _request(self, env):
+        env = dict(
+            (name, value) for name, value in env.items()
+            if name in self.state_names or name not in self.loop_names)
+        key = self._state_key(env)
+        if key not in self.envs:
+            if len(self.keys) >= self.max_states:
+                raise _TooLarge()
+            self.keys.append(key)
+            self.envs[key] = env
+        return key
+
+    def _add(self, statements, new_statements):
+        self.size += len(new_statements)
+        if self.size > self.max_size:
+            raise _TooLarge()
+        statements.extend(new_statements)
+
+    def _peval(self, node, env):
+        result, self.gen_sym = peval_expression(
+            node, self.gen_sym, immutablechainmap(env, self.external_constants))
+        self.new_bindings.update(result.temp_bindings)
+        for name in result.mutated_bindings:
+            env.pop(name, None)
+        return result
+
+    def _test(self, node, env):
+        # Returns ``(True, value)`` if the truth value of the condition is known,
+        # and ``(False, new_node)`` otherwise.
+        result = self._peval(node, env)
+        if result.fully_evaluated:
+            try:
+                return True, bool(result.value)
+            except Exception:
+                pass
+        return False, result.node
+
+    def _value_node(self, value):
+        node, self.gen_sym, binding = value_to_node(value, self.gen_sym)
+        self.new_bindings.update(binding)
+        return node
+
+    def _jump(self, env):
+        return _Jump(self._request(env))
+
+    def _exit(self, env):
+        # The static variables are not assigned in the residual code,
+        # so their final values are assigned at the exit from the loop.
+        return _Exit([
+            ast.Assign(
+                targets=[ast.Name(id=name, ctx=ast.Store())],
+                value=self._value_node(env[name]))
+            for name in sorted(env) if name in self.state_names])
+
+    def _substitute(self, node, env, exclude):
+        # Substitutes the values of static variables in an arbitrary node,
+        # except for the ones in ``exclude``.
+        names = dict(
+            (name, value) for name, value in env.items()
+            if name not in exclude and name in self.loop_names)
+        if len(names) == 0:
+            return node
+        new_node, state = _substitute_names(
+            node, state=dict(gen_sym=self.gen_sym, new_bindings={}),
+            ctx=dict(substitutions=names))
+        self.gen_sym = state.gen_sym
+        self.new_bindings.update(state.new_bindings)
+        return new_node
+
+    def _specialize_iteration(self, env):
+        known, test = self._test(self.loop.test, env)
+        if known:
+            if test:
+                return self._specialize_block(self.loop.body, env, True)
+            else:
+                return self._specialize_block(self.loop.orelse, env, False)
+        else:
+            return [ast.If(
+                test=test,
+                body=self._specialize_block(self.loop.body, dict(env), True),
+                orelse=self._specialize_block(self.loop.orelse, dict(env), False))]
+
+    def _specialize_block(self, statements, env, to_head):
+        """
+        Specializes the list of ``statements`` followed by a jump to the loop head
+        (if ``to_head`` is ``True``) or an exit from the loop (otherwise).
+        Every path in the returned residual code ends with a jump placeholder,
+        an exit placeholder, ``return`` or ``raise``.
+        """
+        residual = []
+
+        for i, statement in enumerate(statements):
+            stmt_type = type(statement)
+
+            if stmt_type == ast.If:
+                rest = statements[i+1:]
+                known, test = self._test(statement.test, env)
+                if known:
+                    taken = statement.body if test else statement.orelse
+                    self._add(residual, self._specialize_block(taken + rest, env, to_head))
+                else:
+                    # The rest of the block is specialized separately for every branch,
+                    # since the static states at the end of the branches can be different.
+                    self._add(residual, [ast.If(
+                        test=test,
+                        body=self._specialize_block(statement.body + rest, dict(env), to_head),
+                        orelse=self._specialize_block(
+                            statement.orelse + rest, dict(env), to_head))])
+                return residual
+
+            elif stmt_type == ast.Break:
+                residual.append(self._exit(env))
+                return residual
+
+            elif stmt_type == ast.Continue:
+                residual.append(self._jump(env))
+                return residual
+
+            elif stmt_type == ast.Return:
+                if statement.value is not None:
+                    statement = replace_fields(
+                        statement, value=self._peval(statement.value, env).node)
+                self._add(residual, [statement])
+                return residual
+
+            elif stmt_type == ast.Raise:
+                self._add(residual, [self._substitute(statement, env, set())])
+                return residual
+
+            elif stmt_type == ast.Pass:
+                continue
+
+            elif stmt_type == ast.Expr:
+                result = self._peval(statement.value, env)
+                # A fully evaluated expression does not have side effects
+                if not result.fully_evaluated:
+                    self._add(residual, [replace_fields(statement, value=result.node)])
+
+            elif stmt_type == ast.Assign:
+                self._add(residual, self._specialize_assign(statement, env))
+
+            elif stmt_type == ast.AugAssign and type(statement.target) == ast.Name:
+                self._add(residual, self._specialize_augassign(statement, env))
+
+            else:
+                # Any other statement is left as is, with the static values substituted,
+                # and the variables assigned in it become dynamic.
+                if has_loop_jumps([statement]):
+                    raise _CannotUnfold()
+                assigned = _assigned_names(statement)
+                self._add(residual, [self._substitute(statement, env, assigned)])
+                for name in assigned:
+                    env.pop(name, None)
+
+        residual.append(self._jump(env) if to_head else self._exit(env))
+        return residual
+
+    def _can_be_static(self, name, result):
+        return (
+            result.fully_evaluated and name not in self.dynamic_names
+            and _is_static_value(result.value))
+
+    def _specialize_assign(self, statement, env):
+        result = self._peval(statement.value, env)
+
+        if all(type(target) == ast.Name for target in statement.targets):
+            if all(self._can_be_static(target.id, result) for target in statement.targets):
+                for target in statement.targets:
+                    env[target.id] = result.value
+                return []
+
+            for target in statement.targets:
+                env.pop(target.id, None)
+            return [replace_fields(statement, value=result.node)]
+
+        if (len(statement.targets) == 1 and type(statement.targets[0]) == ast.Tuple
+                and all(type(elt) == ast.Name for elt in statement.targets[0].elts)
+                and result.fully_evaluated and type(result.value) == tuple
+                and len(result.value) == len(statement.targets[0].elts)):
+            names = [elt.id for elt in statement.targets[0].elts]
+            static = [
+                (name, value) for name, value in zip(names, result.value)
+                if self._can_be_static(name, result) and _is_static_value(value)]
+            if len(set(names)) == len(names) and len(static) == len(names):
+                env.update(static)
+                return []
+
+        assigned = _assigned_names(statement)
+        new_targets = [self._substitute(target, env, assigned) for target in statement.targets]
+        for name in assigned:
+            env.pop(name, None)
+        return [replace_fields(statement, targets=new_targets, value=result.node)]
+
+    def _specialize_augassign(self, statement, env):
+        name = statement.target.id
+
+        if name not in env:
+            result = self._peval(statement.value, env)
+            return [replace_fields(statement, value=result.node)]
+
+        # The static values are immutable, so ``x op= y`` is the same as ``x = x op y``
+        binop = ast.BinOp(
+            left=ast.Name(id=name, ctx=ast.Load()), op=statement.op, right=statement.value)
+        result = self._peval(binop, env)
+        if self._can_be_static(name, result):
+            env[name] = result.value
+            return []
+
+        env.pop(name, None)
+        return [ast.Assign(targets=[ast.Name(id=name, ctx=ast.Store())], value=result.node)]
+
+    def _count_jumps(self, statements, counts):
+        for statement in statements:
+            if type(statement) == _Jump:
+                counts[statement.key] = counts.get(statement.key, 0) + 1
+            elif type(statement) == ast.If:
+                self._count_jumps(statement.body, counts)
+                self._count_jumps(statement.orelse, counts)
+
+    def residual_code(self):
+        """
+        Returns the list of statements replacing the loop.
+        """
+
+        # The blocks reached only once are inlined at the jump site,
+        # the rest become branches of a dispatching loop.
+        counts = {self.entry_key: 1}
+        for key in self.keys:
+            self._count_jumps(self.blocks[key], counts)
+        dispatched = [key for key in self.keys if counts.get(key, 0) > 1]
+        if len(dispatched) > 0 and self.entry_key not in dispatched:
+            # Jumps are only valid inside the dispatching loop
+            dispatched.insert(0, self.entry_key)
+
+        if len(dispatched) == 0:
+            return self._resolve(self.blocks[self.entry_key], counts, None, None)
+
+        state_name, self.gen_sym = self.gen_sym(STATE_TAG)
+        state_ids = dict((key, i) for i, key in enumerate(dispatched))
+
+        branches = None
+        for key in reversed(dispatched):
+            test = ast.Compare(
+                left=ast.Name(id=state_name, ctx=ast.Load()),
+                ops=[ast.Eq()],
+                comparators=[self._value_node(state_ids[key])])
+            body = self._resolve(self.blocks[key], counts, state_name, state_ids)
+            branches = [ast.If(test=test, body=body, orelse=[] if branches is None else branches)]
+
+        return [
+            ast.Assign(
+                targets=[ast.Name(id=state_name, ctx=ast.Store())],
+                value=self._value_node(state_ids[self.entry_key])),
+            ast.While(test=self._value_node(True), body=branches, orelse=[])]
+
+    def _resolve(self, statements, counts, state_name, state_ids):
+        # Replaces the placeholders with the actual code.
+        new_statements = []
+        for statement in statements:
+            if type(statement) == _Jump:
+                if counts[statement.key] > 1:
+                    new_statements.append(ast.Assign(
+                        targets=[ast.Name(id=state_name, ctx=ast.Store())],
+                        value=self._value_node(state_ids[statement.key])))
+                    new_statements.append(ast.Continue())
+                else:
+                    new_statements.extend(self._resolve(
+                        self.blocks[statement.key], counts, state_name, state_ids))
+            elif type(statement) == _Exit:
+                new_statements.extend(statement.assignments)
+                # Without a dispatching loop the exit is always in the tail position,
+                # so the control just falls through to the code after the loop.
+                if state_name is not None:
+                    new_statements.append(ast.Break())
+            elif type(statement) == ast.If:
+                new_statements.append(replace_fields(
+                    statement,
+                    body=self._resolve(statement.body, counts, state_name, state_ids),
+                    orelse=self._resolve(statement.orelse, counts, state_name, state_ids)))
+            else:
+                new_statements.append(statement)
+
+        if len(new_statements) == 0:
+            new_statements = [ast.Pass()]
+        return new_statements
+
+
+def _unfold_loop(loop, prefix, gen_sym, ctx):
+    """
+    Returns a tuple ``(new_statements, gen_sym, new_bindings)``,
+    or ``None`` if the loop cannot be unfolded.
+    """
+
+    if has_loop_jumps(loop.orelse):
+        # Jumps belonging to an outer loop
+        return None
+
+    loop_names = _assigned_names(loop)
+    if any(name.startswith(STATE_PREFIX) for name in loop_names):
+        # A dispatching loop created by an earlier run of this component.
+        # Specializing it again would just recreate it with a new state variable.
+        return None
+
+    entry_env = _entry_values(prefix, ctx.external_constants, ctx.mutated_names)
+    dead_names = _dead_at_head(loop, ctx.tree)
+
+    if ctx.static_names is None:
+        dynamic_names = set()
+    else:
+        dynamic_names = set(name for name in loop_names if name not in ctx.static_names)
+
+    while True:
+        static_loop_names = [
+            name for name in loop_names - dead_names
+            if name not in dynamic_names and _is_static_value(entry_env.get(name, []))]
+        if len(static_loop_names) == 0:
+            return None
+
+        static_env = dict(
+            (name, value) for name, value in entry_env.items()
+            if name in static_loop_names or name not in loop_names)
+        if not _controls_flow(loop, static_env, static_loop_names, ctx.external_constants):
+            return None
+
+        specializer = _LoopSpecializer(
+            loop, entry_env, ctx.external_constants, loop_names, dynamic_names, dead_names,
+            gen_sym, ctx.max_states, ctx.max_size)
+        try:
+            specializer.specialize()
+            new_statements = specializer.residual_code()
+        except _CannotUnfold:
+            return None
+        except _TooLarge:
+            # Generalizing the variable with the most distinct values
+            values = dict((name, set()) for name in static_loop_names)
+            for key in specializer.keys:
+                for name, _, value in key:
+                    if name in values:
+                        values[name].add(value)
+            dynamic_names.add(max(
+                static_loop_names, key=lambda name: (len(values[name]), name)))
+            continue
+
+        return new_statements, specializer.gen_sym, specializer.new_bindings
+
+
+@ast_walker
+class _unfold_loops_walker:
+
+    @staticmethod
+    def handle_While(node, state, ctx, **kwds):
+        prefix = ctx.prefixes.get(id(node))
+        if prefix is None:
+            return node, state
+
+        result = _unfold_loop(node, prefix, state.gen_sym, ctx)
+        if result is None:
+            return node, state
+
+        new_statements, gen_sym, new_bindings = result
+        new_state = state.update(
+            gen_sym=gen_sym, new_bindings=dict(state.new_bindings, **new_bindings))
+        return new_statements, new_state
+
+
+@ast_walker
+class _substitute_names:
+
+    @staticmethod
+    def handle_Name(node, state, ctx, **kwds):
+        if type(node.ctx) == ast.Load and node.id in ctx.substitutions:
+            new_node, gen_sym, binding = value_to_node(
+                ctx.substitutions[node.id], state.gen_sym)
+            new_bindings = dict(state.new_bindings)
+            new_bindings.update(binding)
+            return new_node, state.update(gen_sym=gen_sym, new_bindings=new_bindings)
+        else:
+            return node, state
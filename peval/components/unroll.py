@@ -0,0 +1,243 @@
+"""
+Unrolling of ``for`` loops over known finite iterables.
+"""
+
+import ast
+import copy
+import sys
+
+from peval.tags import unroll
+from peval.core.gensym import GenSym
+from peval.core.value import value_to_node
+from peval.core.expression import try_peval_expression, find_mutated_names
+from peval.core.symbol_finder import find_symbol_creations, find_symbol_usages
+from peval.tools import ast_walker, ast_inspector, replace_fields
+from peval.wisdom import is_immutable_value
+
+
+# The maximum number of iterations of a loop that is unrolled
+# without being explicitly marked with ``unroll()``.
+DEFAULT_MAX_ITERATIONS = 8
+
+# The types of iterables that can be unrolled without being explicitly marked
+# (iterating over them is finite and does not have side effects).
+if sys.version_info >= (3,):
+    UNROLLABLE_TYPES = (range, tuple, list, dict)
+else:
+    UNROLLABLE_TYPES = (xrange, tuple, list, dict)
+
+# The mutable ones among the above, which are not unrolled implicitly
+# if the loop body refers to the variables the iterable is obtained from.
+MUTABLE_TYPES = (list, dict)
+
+
+def unroll_loops(tree, constants, max_iterations=DEFAULT_MAX_ITERATIONS, policy=None):
+    """
+    Replaces ``for`` loops over known iterables with a sequence of copies of the loop body,
+    each preceded by an assignment of the corresponding element to the loop target.
+
+    A loop is unrolled if its iterable is wrapped in :py:func:`~peval.tags.unroll`,
+    or if it is a ``range``, a tuple, a list or a dictionary
+    with at most ``max_iterations`` elements.
+    ``policy``, if given, is called as ``policy(loop_node, iterable)``
+    for loops not explicitly marked for unrolling,
+    and can return ``True`` or ``False`` to override the default decision
+    (or ``None`` to keep it).
+    Loops containing ``break`` or ``continue`` are not unrolled.
+
+    To use non-default parameters in a pass manager,
+    register ``functools.partial(unroll_loops, max_iterations=..., policy=...)``.
+    """
+
+    # Local variables shadow the globals with the same names,
+    # so their values are not known in general.
+    external_constants = constants
+    for name in find_symbol_creations(tree):
+        external_constants = external_constants.del_(name)
+
+    # Neither are the values of mutable objects the function can change,
+    # since the changes are not tracked.
+    for name in find_mutated_names(tree, constants):
+        if name in external_constants and not is_immutable_value(external_constants[name]):
+            external_constants = external_constants.del_(name)
+
+    gen_sym = GenSym.for_tree(tree)
+    new_tree, state = _unroll_loops_walker(
+        tree,
+        state=dict(gen_sym=gen_sym, constants=constants),
+        ctx=dict(
+            external_constants=external_constants,
+            max_iterations=max_iterations, policy=policy))
+
+    if new_tree is tree:
+        return tree, constants
+    else:
+        return new_tree, state.constants
+
+
+@ast_inspector
+class _find_loop_jumps:
+    """
+    Counts ``break`` and ``continue`` statements belonging to the loop
+    whose body is being traversed.
+    """
+
+    @staticmethod
+    def handle_For(node, state, skip_fields, walk_field, **kwds):
+        # Jumps in the body of a nested loop belong to it,
+        # but the ones in its ``else`` clause belong to the outer loop.
+        skip_fields()
+        return walk_field(node.orelse, state, block_context=True)
+
+    @staticmethod
+    def handle_While(node, state, skip_fields, walk_field, **kwds):
+        skip_fields()
+        return walk_field(node.orelse, state, block_context=True)
+
+    @staticmethod
+    def handle_AsyncFor(node, state, skip_fields, walk_field, **kwds):
+        skip_fields()
+        return walk_field(node.orelse, state, block_context=True)
+
+    @staticmethod
+    def handle_FunctionDef(node, state, skip_fields, **kwds):
+        skip_fields()
+        return state
+
+    @staticmethod
+    def handle_AsyncFunctionDef(node, state, skip_fields, **kwds):
+        skip_fields()
+        return state
+
+    @staticmethod
+    def handle_ClassDef(node, state, skip_fields, **kwds):
+        skip_fields()
+        return state
+
+    @staticmethod
+    def handle_Break(node, state, **kwds):
+        return state.update(jumps_counter=state.jumps_counter + 1)
+
+    @staticmethod
+    def handle_Continue(node, state, **kwds):
+        return state.update(jumps_counter=state.jumps_counter + 1)
+
+
+def has_loop_jumps(body):
+    """
+    Returns ``True`` if the list of statements ``body`` (a body of a loop)
+    contains ``break`` or ``continue`` statements belonging to the loop.
+    """
+    return _find_loop_jumps(body, state=dict(jumps_counter=0)).jumps_counter > 0
+
+
+def _get_unroll_argument(iter_node, constants):
+    # Returns the argument of ``unroll()`` if ``iter_node`` is a call to it.
+    if (type(iter_node) != ast.Call or len(iter_node.args) != 1
+            or len(iter_node.keywords) > 0
+            or getattr(iter_node, 'starargs', None) is not None
+            or getattr(iter_node, 'kwargs', None) is not None
+            or (sys.version_info >= (3, 5) and type(iter_node.args[0]) == ast.Starred)):
+        return None
+
+    evaluated, func = try_peval_expression(iter_node.func, constants)
+    if evaluated and func is unroll:
+        return iter_node.args[0]
+    else:
+        return None
+
+
+def _list_elements(iterable):
+    # Returns the list of elements of ``iterable``,
+    # or ``None`` if iterating over it is not safe.
+    try:
+        iterator = iter(iterable)
+    except Exception:
+        return None
+
+    # An iterator would be exhausted during unrolling,
+    # and it may be used elsewhere.
+    if iterator is iterable:
+        return None
+
+    try:
+        return list(iterator)
+    except Exception:
+        return None
+
+
+def _get_unrolled_elements(node, ctx):
+    """
+    Returns the list of elements the loop iterates over, if it should be unrolled,
+    or ``None`` otherwise.
+    """
+    constants = ctx.external_constants
+
+    unroll_argument = _get_unroll_argument(node.iter, constants)
+    explicit = unroll_argument is not None
+    iter_node = unroll_argument if explicit else node.iter
+
+    if has_loop_jumps(node.body):
+        return None
+
+    evaluated, iterable = try_peval_expression(iter_node, constants)
+    if not evaluated:
+        # The iterable is only iterated over at compile time, so it can be a new container.
+        # But its elements are bound to the loop target in every call of the function,
+        # so the new ones (e.g. the lists in ``[[], []]``) must be immutable.
+        evaluated, iterable = try_peval_expression(iter_node, constants, create_containers=True)
+        if not evaluated:
+            return None
+        elements = _list_elements(iterable)
+        if elements is None or not all(is_immutable_value(element) for element in elements):
+            return None
+
+    if not explicit:
+        decision = None if ctx.policy is None else ctx.policy(node, iterable)
+        if decision is None:
+            decision = (
+                type(iterable) in UNROLLABLE_TYPES
+                and len(iterable) <= ctx.max_iterations
+                and not (
+                    type(iterable) in MUTABLE_TYPES
+                    and not find_symbol_usages(iter_node).isdisjoint(
+                        find_symbol_usages(node.body))))
+        if not decision:
+            return None
+
+    return _list_elements(iterable)
+
+
+@ast_walker
+class _unroll_loops_walker:
+
+    @staticmethod
+    def handle_For(node, state, ctx, skip_fields, walk_field, **kwds):
+
+        # Unrolling the nested loops first,
+        # so that they do not have to be processed in every copy of the body.
+        new_body, state = walk_field(node.body, state, block_context=True)
+        new_orelse, state = walk_field(node.orelse, state, block_context=True)
+        skip_fields()
+        node = replace_fields(node, body=new_body, orelse=new_orelse)
+
+        elements = _get_unrolled_elements(node, ctx)
+        if elements is None:
+            return node, state
+
+        gen_sym = state.gen_sym
+        new_bindings = {}
+        new_nodes = []
+        for element in elements:
+            element_node, gen_sym, binding = value_to_node(element, gen_sym)
+            new_bindings.update(binding)
+            new_nodes.append(ast.Assign(targets=[copy.deepcopy(node.target)], value=element_node))
+            # Every copy of the body must consist of distinct node objects,
+            # since some components identify nodes by ``id()``.
+            new_nodes.extend(copy.deepcopy(node.body))
+
+        # Without ``break`` statements the ``else`` clause is always executed.
+        new_nodes.extend(node.orelse)
+
+        new_state = state.update(gen_sym=gen_sym, constants=state.constants.update(new_bindings))
+        return new_nodes, new_state
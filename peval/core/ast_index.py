@@ -0,0 +1,99 @@
+"""
+A cache of parsed source modules, so that creating ``Function`` objects
+for many functions from the same module only parses the module once.
+"""
+
+import os
+import ast
+import linecache
+
+
+def _first_line(function_def):
+    # In Py3.8+ the line number of a decorated function definition
+    # points to the ``def`` keyword, while ``co_firstlineno`` of the compiled function
+    # points to the first decorator.
+    return min([function_def.lineno] + [dec.lineno for dec in function_def.decorator_list])
+
+
+def _function_def_types():
+    types = [ast.FunctionDef]
+    if hasattr(ast, 'AsyncFunctionDef'):
+        types.append(ast.AsyncFunctionDef)
+    return tuple(types)
+
+
+_FUNCTION_DEF_TYPES = _function_def_types()
+
+
+class ASTIndex(object):
+    """
+    Parses source files and indexes all the function definitions in them
+    (including nested ones) by their first line.
+    A file is parsed again if its modification time changes.
+
+    The returned trees are shared between the callers, and must not be modified
+    (which none of the ``peval`` components do).
+    """
+
+    def __init__(self):
+        # filename -> (mtime, {first line: function definition node})
+        self._files = {}
+        self.parses = 0
+
+    def _get_mtime(self, filename):
+        try:
+            return os.stat(filename).st_mtime
+        except (OSError, IOError):
+            return None
+
+    def _index_file(self, filename, module_globals):
+        lines = linecache.getlines(filename, module_globals)
+        if len(lines) == 0:
+            return None
+
+        try:
+            module = ast.parse(''.join(lines), filename)
+        except SyntaxError:
+            return None
+        self.parses += 1
+
+        return dict(
+            (_first_line(node), node) for node in ast.walk(module)
+            if isinstance(node, _FUNCTION_DEF_TYPES))
+
+    def get_function_def(self, function):
+        """
+        Returns the AST of the definition of ``function``,
+        or ``None`` if it cannot be found in the source file.
+        """
+        code = function.__code__
+        filename = code.co_filename
+
+        mtime = self._get_mtime(filename)
+        if mtime is None:
+            return None
+
+        entry = self._files.get(filename)
+        if entry is None or entry[0] != mtime:
+            # Make sure ``linecache`` does not return the old contents.
+            linecache.checkcache(filename)
+            index = self._index_file(filename, function.__globals__)
+            if index is None:
+                return None
+            entry = (mtime, index)
+            self._files[filename] = entry
+
+        function_def = entry[1].get(code.co_firstlineno)
+        if function_def is None or function_def.name != code.co_name:
+            return None
+
+        return function_def
+
+    def clear(self):
+        """
+        Removes all the cached modules.
+        """
+        self._files.clear()
+
+
+ast_index = ASTIndex()
@@ -0,0 +1,235 @@
+"""
+A cache for specialized functions, so that repeated partial applications
+of the same function with the same static arguments do not have to go
+through the parse-optimize-compile cycle again.
+"""
+
+import sys
+import types
+from collections import OrderedDict, namedtuple
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'uncacheable', 'evictions',
+    'entries', 'bytes', 'max_entries', 'max_bytes'])
+
+
+class _Identity(object):
+    """
+    A hashable wrapper comparing the wrapped object by identity.
+    Keeps a reference to the object, so its ``id()`` cannot be reused
+    while the wrapper is alive.
+    """
+
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __eq__(self, other):
+        return type(other) == _Identity and self.obj is other.obj
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return id(self.obj)
+
+
+_MISSING = object()
+
+
+def _referenced_names(code):
+    """
+    Returns a set of global names referenced by a code object
+    and all the code objects nested in it.
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(_referenced_names(const))
+    return names
+
+
+def _cell_contents(cell):
+    # The cells of the variables not assigned yet are empty
+    try:
+        return cell.cell_contents
+    except ValueError:
+        return _MISSING
+
+
+def _globals_version(function):
+    """
+    Returns a hashable fingerprint of the external variables the function refers to
+    (both globals and closure variables).
+    The values are compared by identity, so rebinding a global or a closure variable
+    produces a different fingerprint, while mutating the referenced object does not.
+    """
+    globals_ = function.__globals__
+    code = function.__code__
+
+    global_values = tuple(
+        (name, _Identity(globals_.get(name, _MISSING)))
+        for name in sorted(_referenced_names(code)))
+
+    cells = function.__closure__ if function.__closure__ is not None else ()
+    closure_values = tuple(_Identity(_cell_contents(cell)) for cell in cells)
+
+    return _Identity(globals_), global_values, closure_values
+
+
+def _typed_value(value):
+    # ``1``, ``1.0`` and ``True`` are equal and have the same hash,
+    # but lead to different specializations.
+    return type(value), value
+
+
+def specialization_key(function, args, kwds, options=()):
+    """
+    Builds a cache key for the partial application of ``function``
+    to positional arguments ``args`` and keyword arguments ``kwds``.
+    ``options`` is a hashable object with any additional parameters
+    affecting the specialization.
+    Returns ``None`` if some of the arguments are not hashable
+    (and therefore the specialization cannot be cached).
+
+    .. note::
+
+        The arguments are compared by equality, so a hashable mutable object
+        (e.g. an instance of a user class with the default identity-based hash)
+        mutated after the specialization will still produce the same key,
+        and the cached specialization for its old state will be reused.
+        Pass immutable values, or clear the cache after mutating such an object.
+    """
+    key = (
+        _Identity(function.__code__),
+        tuple(_typed_value(arg) for arg in args),
+        tuple(sorted((name, _typed_value(value)) for name, value in kwds.items())),
+        _globals_version(function),
+        options)
+
+    try:
+        hash(key)
+    except TypeError:
+        return None
+
+    return key
+
+
+def estimate_size(function):
+    """
+    Returns an approximate size (in bytes) of a specialized function,
+    taking into account its source and its bytecode.
+    """
+    size = sys.getsizeof(function.__code__.co_code)
+    source = vars(function).get('_peval_source')
+    if source is not None:
+        size += sys.getsizeof(source)
+    return size
+
+
+class SpecializationCache(object):
+    """
+    An LRU cache for specialized functions.
+
+    :param max_entries: the maximum number of stored specializations
+        (``None`` for no limit).
+    :param max_bytes: the maximum total estimated size of stored specializations
+        (``None`` for no limit).
+
+    When either of the limits is exceeded, the least recently used entries are evicted.
+    """
+
+    def __init__(self, max_entries=128, max_bytes=None):
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._uncacheable = 0
+        self._evictions = 0
+        self.configure(max_entries=max_entries, max_bytes=max_bytes)
+
+    def configure(self, max_entries=_MISSING, max_bytes=_MISSING):
+        """
+        Changes the limits of the cache, evicting entries if necessary.
+        """
+        if max_entries is not _MISSING:
+            if max_entries is not None and max_entries < 0:
+                raise ValueError("`max_entries` must be non-negative or None")
+            self.max_entries = max_entries
+        if max_bytes is not _MISSING:
+            if max_bytes is not None and max_bytes < 0:
+                raise ValueError("`max_bytes` must be non-negative or None")
+            self.max_bytes = max_bytes
+        self._evict()
+
+    def _over_budget(self):
+        return (
+            (self.max_entries is not None and len(self._entries) > self.max_entries)
+            or (self.max_bytes is not None and self._bytes > self.max_bytes))
+
+    def _evict(self):
+        while len(self._entries) > 0 and self._over_budget():
+            _, (_, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self._evictions += 1
+
+    def get(self, key):
+        """
+        Returns the specialized function stored for ``key``,
+        or ``None`` if there is none (``key`` can be ``None`` itself,
+        meaning that the specialization cannot be cached).
+        Updates hit/miss counters.
+        """
+        if key is None:
+            self._uncacheable += 1
+            return None
+
+        entry = self._entries.get(key)
+        if entry is None:
+            self._misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return entry[0]
+
+    def put(self, key, function):
+        """
+        Stores the specialized function for ``key``.
+        Does nothing if ``key`` is ``None``.
+        """
+        if key is None:
+            return
+
+        old_entry = self._entries.pop(key, None)
+        if old_entry is not None:
+            self._bytes -= old_entry[1]
+
+        size = estimate_size(function)
+        self._entries[key] = (function, size)
+        self._bytes += size
+        self._evict()
+
+    def clear(self):
+        """
+        Removes all the stored specializations and resets the counters.
+        """
+        self._entries.clear()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._uncacheable = 0
+        self._evictions = 0
+
+    def info(self):
+        """
+        Returns a :py:class:`CacheInfo` tuple with the cache statistics.
+        """
+        return CacheInfo(
+            hits=self._hits, misses=self._misses, uncacheable=self._uncacheable,
+            evictions=self._evictions, entries=len(self._entries), bytes=self._bytes,
+            max_entries=self.max_entries, max_bytes=self.max_bytes)
+
+    def __len__(self):
+        return len(self._entries)
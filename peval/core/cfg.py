@@ -6,30 +6,59 @@ import copy
 class Node:
     def __init__(self, ast_node):
         self.ast_node = ast_node
-        self.parents = set()
-        self.children = set()
+        self.parents = []
+        self.children = []
+
+
+def _reverse_postorder(children_of, enter):
+    postorder = []
+    visited = set([enter])
+    # Visiting children in the order of their ids (that is, in the order of creation)
+    # to make the result deterministic.
+    stack = [(enter, iter(sorted(children_of(enter))))]
+
+    while len(stack) > 0:
+        node_id, children = stack[-1]
+        for child_id in children:
+            if child_id not in visited:
+                visited.add(child_id)
+                stack.append((child_id, iter(sorted(children_of(child_id)))))
+                break
+        else:
+            stack.pop()
+            postorder.append(node_id)
+
+    return postorder[::-1]
 
 
 class Graph:
+    """
+    A graph of statements.
+    Node ids are consecutive integers starting from 0, assigned in the order of creation.
+    """
 
     def __init__(self):
-        self._nodes = {}
+        self._nodes = []
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def node_ids(self):
+        return range(len(self._nodes))
 
     def add_node(self, ast_node):
-        node_id = id(ast_node)
-        self._nodes[node_id] = Node(ast_node)
-        return node_id
+        self._nodes.append(Node(ast_node))
+        return len(self._nodes) - 1
 
     def add_edge(self, src, dest):
 
-        assert src in self._nodes
-        assert dest in self._nodes
-
-        #assert dest not in self.children_of(src)
-        #assert src not in self.parents_of(dest)
+        assert 0 <= src < len(self._nodes)
+        assert 0 <= dest < len(self._nodes)
 
-        self._nodes[src].children.add(dest)
-        self._nodes[dest].parents.add(src)
+        children = self._nodes[src].children
+        if dest not in children:
+            children.append(dest)
+            self._nodes[dest].parents.append(src)
 
     def children_of(self, node):
         return self._nodes[node].children
@@ -37,10 +66,211 @@ class Graph:
     def parents_of(self, node):
         return self._nodes[node].parents
 
-    def update(self, other):
-        for node in other._nodes:
-            assert node not in self._nodes
-        self._nodes.update(other._nodes)
+    def reverse_postorder(self, enter):
+        """
+        Returns a list of ids of the nodes reachable from ``enter`` in reverse postorder
+        (so that every node precedes its children, except for the targets of back edges).
+        """
+        return _reverse_postorder(self.children_of, enter)
+
+    def dominators(self, enter):
+        """
+        Returns the :py:class:`Dominators` of the nodes reachable from ``enter``.
+        """
+        order = self.reverse_postorder(enter)
+        return Dominators(_immediate_dominators(self.parents_of, enter, order))
+
+    def natural_loops(self, enter, dominators=None):
+        """
+        Returns a list of the natural loops (see :py:class:`Loop`) of the nodes
+        reachable from ``enter``, ordered so that outer loops precede the nested ones.
+        The back edges with the same target are merged into a single loop.
+        """
+        if dominators is None:
+            dominators = self.dominators(enter)
+        order = self.reverse_postorder(enter)
+
+        loops = []
+        for header in order:
+            latches = [
+                parent_id for parent_id in self.parents_of(header)
+                if parent_id in dominators.idoms and dominators.dominates(header, parent_id)]
+            if len(latches) == 0:
+                continue
+
+            # The nodes from which a latch is reachable without passing through the header
+            nodes = set([header])
+            stack = list(latches)
+            while len(stack) > 0:
+                node_id = stack.pop()
+                if node_id not in nodes and node_id in dominators.idoms:
+                    nodes.add(node_id)
+                    stack.extend(self.parents_of(node_id))
+            loops.append(Loop(header, sorted(latches), nodes))
+
+        # Headers of outer loops precede the headers of the nested ones in reverse postorder,
+        # so the innermost containing loop is the last one found.
+        for i, loop in enumerate(loops):
+            for outer_loop in loops[:i]:
+                if loop.header in outer_loop.nodes:
+                    loop.parent = outer_loop
+
+        return loops
+
+
+def _immediate_dominators(parents_of, enter, order):
+    """
+    Returns a dictionary of immediate dominators of the nodes in ``order``
+    (a reverse postorder starting from ``enter``, which is mapped to ``None``).
+    Uses the iterative algorithm by Cooper, Harvey and Kennedy.
+    """
+    index = dict((node_id, i) for i, node_id in enumerate(order))
+    idoms = {enter: enter}
+
+    def intersect(node1, node2):
+        while node1 != node2:
+            while index[node1] > index[node2]:
+                node1 = idoms[node1]
+            while index[node2] > index[node1]:
+                node2 = idoms[node2]
+        return node1
+
+    changed = True
+    while changed:
+        changed = False
+        for node_id in order[1:]:
+            new_idom = None
+            for parent_id in parents_of(node_id):
+                if parent_id not in idoms:
+                    # Unreachable, or not processed yet
+                    continue
+                new_idom = parent_id if new_idom is None else intersect(parent_id, new_idom)
+            if idoms.get(node_id) != new_idom:
+                idoms[node_id] = new_idom
+                changed = True
+
+    idoms[enter] = None
+    return idoms
+
+
+class Dominators:
+    """
+    The dominator tree of the nodes of a :py:class:`Graph` reachable from the enter node
+    (a node ``a`` dominates a node ``b`` if every path from the enter node to ``b`` goes through ``a``).
+
+    :ivar idoms: a dictionary mapping node ids to the ids of their immediate dominators
+        (``None`` for the enter node).
+    """
+
+    def __init__(self, idoms):
+        self.idoms = idoms
+
+    def dominates(self, node1, node2):
+        """
+        Returns ``True`` if ``node1`` dominates ``node2`` (every node dominates itself).
+        """
+        while node2 is not None:
+            if node2 == node1:
+                return True
+            node2 = self.idoms[node2]
+        return False
+
+
+class Loop:
+    """
+    A natural loop in a :py:class:`Graph`.
+
+    :ivar header: the id of the header node (the target of the back edges,
+        dominating all the nodes of the loop).
+    :ivar latches: a list of ids of the sources of the back edges.
+    :ivar nodes: a set of ids of the nodes of the loop (including the header).
+    :ivar parent: the innermost loop containing this one, or ``None``.
+    """
+
+    def __init__(self, header, latches, nodes):
+        self.header = header
+        self.latches = latches
+        self.nodes = nodes
+        self.parent = None
+
+    def exiting_nodes(self, graph):
+        """
+        Returns a list of ids of the nodes of the loop from which the control
+        can leave the loop (including the nodes without successors, e.g. ``return``).
+        """
+        return [
+            node_id for node_id in sorted(self.nodes)
+            if len(graph.children_of(node_id)) == 0
+            or any(child_id not in self.nodes for child_id in graph.children_of(node_id))]
+
+
+class BasicBlocks:
+    """
+    Statements of a :py:class:`Graph` grouped into basic blocks
+    (maximal straight-line sequences with no branches in or out except at the ends).
+    Block ids are consecutive integers starting from 0.
+
+    :ivar statements: a list of lists of node ids of the statements in each block.
+    :ivar successors: a list of lists of ids of successor blocks.
+    :ivar predecessors: a list of lists of ids of predecessor blocks.
+    :ivar block_of: a list with the id of the block for each node id.
+    :ivar enter: the id of the block containing the enter node.
+    """
+
+    def __init__(self, graph, enter):
+        num_nodes = len(graph)
+        parents = [graph.parents_of(node_id) for node_id in graph.node_ids()]
+        children = [graph.children_of(node_id) for node_id in graph.node_ids()]
+
+        def is_leader(node_id):
+            if node_id == enter or len(parents[node_id]) != 1:
+                return True
+            return len(children[parents[node_id][0]]) != 1
+
+        self.statements = []
+        self.block_of = [None] * num_nodes
+
+        def add_block(leader):
+            block_id = len(self.statements)
+            block = [leader]
+            self.block_of[leader] = block_id
+            node_id = leader
+            while len(children[node_id]) == 1:
+                node_id = children[node_id][0]
+                if self.block_of[node_id] is not None or is_leader(node_id):
+                    break
+                block.append(node_id)
+                self.block_of[node_id] = block_id
+            self.statements.append(block)
+
+        for node_id in range(num_nodes):
+            if self.block_of[node_id] is None and is_leader(node_id):
+                add_block(node_id)
+
+        # Unreachable cycles without leaders
+        for node_id in range(num_nodes):
+            if self.block_of[node_id] is None:
+                add_block(node_id)
+
+        self.successors = [
+            [self.block_of[child_id] for child_id in children[block[-1]]]
+            for block in self.statements]
+        self.predecessors = [[] for _ in self.statements]
+        for block_id, successors in enumerate(self.successors):
+            for successor_id in successors:
+                self.predecessors[successor_id].append(block_id)
+
+        self.enter = self.block_of[enter]
+
+    def __len__(self):
+        return len(self.statements)
+
+    def reverse_postorder(self):
+        """
+        Returns a list of ids of the blocks reachable from the enter block
+        in reverse postorder.
+        """
+        return _reverse_postorder(self.successors.__getitem__, self.enter)
 
 
 class Jumps:
@@ -58,6 +288,14 @@ class Jumps:
             continues=self.continues + other.continues,
             raises=self.raises + other.raises)
 
+    def extend(self, other):
+        # An in-place version of ``join()``, to avoid copying the lists
+        # for every statement in a long sequence.
+        self.returns.extend(other.returns)
+        self.breaks.extend(other.breaks)
+        self.continues.extend(other.continues)
+        self.raises.extend(other.raises)
+
 
 class ControlFlowSubgraph:
     def __init__(self, graph, enter, exits=None, jumps=None):
@@ -75,22 +313,20 @@ class ControlFlowGraph:
         self.raises = [] if raises is None else raises
 
 
-def _build_if_cfg(node):
+def _build_if_cfg(graph, node):
+
+    node_id = graph.add_node(node)
 
-    cfg_true = _build_cfg(node.body)
+    cfg_true = _build_cfg(graph, node.body)
     exits = cfg_true.exits
     jumps = cfg_true.jumps
-    graph = cfg_true.graph
-
-    node_id = graph.add_node(node)
 
     graph.add_edge(node_id, cfg_true.enter)
 
     if len(node.orelse) > 0:
-        cfg_false = _build_cfg(node.orelse)
+        cfg_false = _build_cfg(graph, node.orelse)
         exits += cfg_false.exits
         jumps = jumps.join(cfg_false.jumps)
-        graph.update(cfg_false.graph)
         graph.add_edge(node_id, cfg_false.enter)
     else:
         exits.append(node_id)
@@ -98,13 +334,12 @@ def _build_if_cfg(node):
     return ControlFlowSubgraph(graph, node_id, exits=exits, jumps=jumps)
 
 
-def _build_loop_cfg(node):
-
-    cfg = _build_cfg(node.body)
-    graph = cfg.graph
+def _build_loop_cfg(graph, node):
 
     node_id = graph.add_node(node)
 
+    cfg = _build_cfg(graph, node.body)
+
     graph.add_edge(node_id, cfg.enter)
 
     for c_id in cfg.jumps.continues:
@@ -115,55 +350,91 @@ def _build_loop_cfg(node):
     for exit in cfg.exits:
         graph.add_edge(exit, node_id)
 
+    # The loop is left from its header, when the iterator is exhausted
+    # or the condition is false (possibly before the first iteration).
     if len(node.orelse) == 0:
-        exits += cfg.exits
+        exits.append(node_id)
     else:
-        cfg_orelse = _build_cfg(node.orelse)
+        cfg_orelse = _build_cfg(graph, node.orelse)
 
-        graph.update(cfg_orelse.graph)
         exits += cfg_orelse.exits
         jumps = jumps.join(Jumps(raises=cfg_orelse.jumps.raises))
-        for exit in cfg.exits:
-            graph.add_edge(exit, cfg_orelse.enter)
+        graph.add_edge(node_id, cfg_orelse.enter)
 
     return ControlFlowSubgraph(graph, node_id, exits=exits, jumps=jumps)
 
 
-def _build_with_cfg(node):
-    cfg = _build_cfg(node.body)
-    graph = cfg.graph
+def _build_with_cfg(graph, node):
 
     node_id = graph.add_node(node)
 
+    cfg = _build_cfg(graph, node.body)
+
     graph.add_edge(node_id, cfg.enter)
     return ControlFlowSubgraph(graph, node_id, exits=cfg.exits, jumps=cfg.jumps)
 
 
-def _build_break_cfg(node):
-    graph = Graph()
+def _is_irrefutable(match_case):
+    # A wildcard or a capture pattern without a guard matches any subject.
+    pattern = match_case.pattern
+    while type(pattern) == ast.MatchOr and len(pattern.patterns) > 0:
+        pattern = pattern.patterns[-1]
+    return (
+        match_case.guard is None
+        and type(pattern) == ast.MatchAs and pattern.pattern is None)
+
+
+def _build_match_cfg(graph, node):
+
+    node_id = graph.add_node(node)
+
+    exits = []
+    jumps = Jumps()
+
+    # The cases are tried one after another,
+    # and each of them either transfers control to its body, or to the next case.
+    prev_id = node_id
+    for match_case in node.cases:
+        case_id = graph.add_node(match_case)
+        graph.add_edge(prev_id, case_id)
+
+        cfg_case = _build_cfg(graph, match_case.body)
+        graph.add_edge(case_id, cfg_case.enter)
+        exits += cfg_case.exits
+        jumps.extend(cfg_case.jumps)
+
+        prev_id = case_id
+
+        if _is_irrefutable(match_case):
+            break
+    else:
+        # None of the cases matched
+        exits.append(prev_id)
+
+    return ControlFlowSubgraph(graph, node_id, exits=exits, jumps=jumps)
+
+
+def _build_break_cfg(graph, node):
     node_id = graph.add_node(node)
     return ControlFlowSubgraph(graph, node_id, jumps=Jumps(breaks=[node_id]))
 
 
-def _build_continue_cfg(node):
-    graph = Graph()
+def _build_continue_cfg(graph, node):
     node_id = graph.add_node(node)
     return ControlFlowSubgraph(graph, node_id, jumps=Jumps(continues=[node_id]))
 
 
-def _build_return_cfg(node):
-    graph = Graph()
+def _build_return_cfg(graph, node):
     node_id = graph.add_node(node)
     return ControlFlowSubgraph(graph, node_id, jumps=Jumps(returns=[node_id]))
 
 
-def _build_statement_cfg(node):
-    graph = Graph()
+def _build_statement_cfg(graph, node):
     node_id = graph.add_node(node)
     return ControlFlowSubgraph(graph, node_id, exits=[node_id])
 
 
-def get_nontrivial_nodes(graph):
+def get_nontrivial_nodes(graph, node_ids):
     # returns ids of nodes that can possibly raise an exception
     nodes = []
     if sys.version_info >= (3, 3):
@@ -171,44 +442,43 @@ def get_nontrivial_nodes(graph):
     else:
         try_cls = (ast.TryExcept, ast.TryFinally)
 
-    for node_id, node_obj in graph._nodes.items():
-        node = node_obj.ast_node
+    for node_id in node_ids:
+        node = graph._nodes[node_id].ast_node
         if type(node) not in ((ast.Break, ast.Continue, ast.Pass) + try_cls):
             nodes.append(node_id)
     return nodes
 
 
-def _build_excepthandler_cfg(node):
-    graph = Graph()
+def _build_excepthandler_cfg(graph, node):
     enter = graph.add_node(node)
 
-    cfg = _build_cfg(node.body)
-    graph.update(cfg.graph)
+    cfg = _build_cfg(graph, node.body)
     graph.add_edge(enter, cfg.enter)
 
     return ControlFlowSubgraph(graph, enter, exits=cfg.exits, jumps=cfg.jumps)
 
 
-def _build_try_block_cfg(try_node, body, handlers, orelse):
+def _build_try_block_cfg(graph, try_node, body, handlers, orelse):
 
-    graph = Graph()
     enter = graph.add_node(try_node)
 
-    body_cfg = _build_cfg(body)
+    # Since the nodes are numbered in the order of creation,
+    # the nodes of the body occupy a contiguous range of ids.
+    body_start = len(graph)
+    body_cfg = _build_cfg(graph, body)
+    body_end = len(graph)
 
     jumps = body_cfg.jumps
     jumps.raises = [] # raises will be connected to all the handlers anyway
 
-    graph.update(body_cfg.graph)
     graph.add_edge(enter, body_cfg.enter)
 
-    handler_cfgs = [_build_excepthandler_cfg(handler) for handler in handlers]
+    handler_cfgs = [_build_excepthandler_cfg(graph, handler) for handler in handlers]
     for handler_cfg in handler_cfgs:
-        graph.update(handler_cfg.graph)
         jumps = jumps.join(handler_cfg.jumps)
 
     # FIXME: is it correct in case of nested `try`s?
-    body_ids = get_nontrivial_nodes(body_cfg.graph)
+    body_ids = get_nontrivial_nodes(graph, range(body_start, body_end))
     if len(handler_cfgs) > 0:
         # FIXME: if there are exception handlers,
         # assuming that all the exceptions are caught by them
@@ -224,8 +494,7 @@ def _build_try_block_cfg(try_node, body, handlers, orelse):
 
     if len(orelse) > 0 and len(body_cfg.exits) > 0:
         # FIXME: show warning about unreachable code if there's `orelse`, but no exits from body?
-        orelse_cfg = _build_cfg(orelse)
-        graph.update(orelse_cfg.graph)
+        orelse_cfg = _build_cfg(graph, orelse)
         jumps = jumps.join(orelse_cfg.jumps)
         for exit in exits:
             graph.add_edge(exit, orelse_cfg.enter)
@@ -237,18 +506,16 @@ def _build_try_block_cfg(try_node, body, handlers, orelse):
     return ControlFlowSubgraph(graph, enter, exits=exits, jumps=jumps)
 
 
-def _build_try_finally_block_cfg(try_node, body, handlers, orelse, finalbody):
+def _build_try_finally_block_cfg(graph, try_node, body, handlers, orelse, finalbody):
 
-    try_cfg = _build_try_block_cfg(try_node, body, handlers, orelse)
+    try_cfg = _build_try_block_cfg(graph, try_node, body, handlers, orelse)
 
     if len(finalbody) == 0:
         return try_cfg
 
     # everything has to pass through finally
-    final_cfg = _build_cfg(finalbody)
-    graph = try_cfg.graph
+    final_cfg = _build_cfg(graph, finalbody)
     jumps = try_cfg.jumps
-    graph.update(final_cfg.graph)
 
     #if len(handlers) == 0:
         # FIXME: is it correct in case of nested `try`s?
@@ -277,74 +544,77 @@ def _build_try_finally_block_cfg(try_node, body, handlers, orelse, finalbody):
         jumps=Jumps(returns=returns, raises=raises, continues=continues, breaks=breaks))
 
 
-def _build_try_finally_cfg(node):
+def _build_try_finally_cfg(graph, node):
     # Pre-Py3.3 try block with the `finally` part
     if type(node.body[0]) == ast.TryExcept:
         # If there are exception handlers, the body consists of a single TryExcept node
         return _build_try_finally_block_cfg(
-            node, node.body[0].body, node.body[0].handlers, node.body[0].orelse, node.finalbody)
+            graph, node, node.body[0].body, node.body[0].handlers, node.body[0].orelse,
+            node.finalbody)
     else:
         # If there are no exception handlers, the body is just a sequence of statements
         return _build_try_finally_block_cfg(
-            node, node.body, [], [], node.finalbody)
+            graph, node, node.body, [], [], node.finalbody)
 
 
-def _build_try_except_cfg(node):
+def _build_try_except_cfg(graph, node):
     # Pre-Py3.3 try block without the `finally` part
-    return _build_try_finally_block_cfg(node, node.body, node.handlers, node.orelse, [])
+    return _build_try_finally_block_cfg(graph, node, node.body, node.handlers, node.orelse, [])
 
 
-def _build_try_cfg(node):
+def _build_try_cfg(graph, node):
     # Post-Py3.3 try block
-    return _build_try_finally_block_cfg(node, node.body, node.handlers, node.orelse, node.finalbody)
+    return _build_try_finally_block_cfg(
+        graph, node, node.body, node.handlers, node.orelse, node.finalbody)
 
 
-def _build_node_cfg(node):
-    handlers = {
-        ast.If: _build_if_cfg,
-        ast.For: _build_loop_cfg,
-        ast.While: _build_loop_cfg,
-        ast.With: _build_with_cfg,
-        ast.Break: _build_break_cfg,
-        ast.Continue: _build_continue_cfg,
-        ast.Return: _build_return_cfg,
-        }
+_HANDLERS = {
+    ast.If: _build_if_cfg,
+    ast.For: _build_loop_cfg,
+    ast.While: _build_loop_cfg,
+    ast.With: _build_with_cfg,
+    ast.Break: _build_break_cfg,
+    ast.Continue: _build_continue_cfg,
+    ast.Return: _build_return_cfg,
+    }
 
-    if sys.version_info >= (3, 3):
-        handlers[ast.Try] = _build_try_cfg
-    else:
-        handlers[ast.TryFinally] = _build_try_finally_cfg
-        handlers[ast.TryExcept] = _build_try_except_cfg
+if sys.version_info >= (3, 3):
+    _HANDLERS[ast.Try] = _build_try_cfg
+else:
+    _HANDLERS[ast.TryFinally] = _build_try_finally_cfg
+    _HANDLERS[ast.TryExcept] = _build_try_except_cfg
 
-    if type(node) in handlers:
-        handler = handlers[type(node)]
-    else:
-        handler = _build_statement_cfg
+if sys.version_info >= (3, 5):
+    _HANDLERS[ast.AsyncFor] = _build_loop_cfg
+    _HANDLERS[ast.AsyncWith] = _build_with_cfg
 
-    return handler(node)
+if sys.version_info >= (3, 10):
+    _HANDLERS[ast.Match] = _build_match_cfg
 
 
-def _build_cfg(statements):
+def _build_node_cfg(graph, node):
+    handler = _HANDLERS.get(type(node), _build_statement_cfg)
+    return handler(graph, node)
 
-    enter = id(statements[0])
 
-    exits = [enter]
-    graph = Graph()
+def _build_cfg(graph, statements):
 
+    enter = None
+    exits = []
     jumps = Jumps()
 
-    for i, node in enumerate(statements):
+    for node in statements:
 
-        cfg = _build_node_cfg(node)
+        cfg = _build_node_cfg(graph, node)
 
-        graph.update(cfg.graph)
-
-        if i > 0:
+        if enter is None:
+            enter = cfg.enter
+        else:
             for exit in exits:
                 graph.add_edge(exit, cfg.enter)
 
         exits = cfg.exits
-        jumps = jumps.join(cfg.jumps)
+        jumps.extend(cfg.jumps)
 
         if type(node) in (ast.Break, ast.Continue, ast.Return):
             # Issue a warning about unreachable code?
@@ -354,7 +624,12 @@ def _build_cfg(statements):
 
 
 def build_cfg(statements):
-    cfg = _build_cfg(statements)
+    """
+    Builds a control flow graph for a list of statements.
+    All the nodes are added to a single :py:class:`Graph`,
+    so the construction takes linear time in the number of statements.
+    """
+    cfg = _build_cfg(Graph(), statements)
     assert len(cfg.jumps.breaks) == 0
     assert len(cfg.jumps.continues) == 0
     return ControlFlowGraph(
@@ -1,14 +1,17 @@
 import sys
 import ast
 import operator
+import types
 
 import funcsigs
 
-from peval.tools import Dispatcher, immutableadict, ast_equal, replace_fields
+from peval.tools import (
+    Dispatcher, immutabledict, immutableadict, immutableset, immutablechainmap,
+    ast_equal, replace_fields)
 from peval.core.gensym import GenSym
 from peval.core.value import KnownValue, is_known_value, kvalue_to_node
-from peval.wisdom import get_mutation_info, get_signature
-from peval.core.callable import inspect_callable
+from peval.wisdom import get_mutation_info, get_signature, is_known_pure, is_immutable_value
+from peval.core.callable import inspect_callable, MethodWrapperType
 
 
 UNARY_OPS = {
@@ -42,6 +45,14 @@ def in_(x, y):
 def not_in(x, y):
     return not operator.contains(y, x)
 
+# Values of ``ast.FormattedValue.conversion``
+FORMAT_CONVERSIONS = {
+    ord('s'): str,
+    ord('r'): repr,
+    }
+if sys.version_info >= (3,):
+    FORMAT_CONVERSIONS[ord('a')] = ascii
+
 COMPARE_OPS = {
     ast.Eq: KnownValue(operator.eq),
     ast.NotEq: KnownValue(operator.ne),
@@ -56,6 +67,10 @@ COMPARE_OPS = {
     }
 
 
+# The types of methods bound to an object (available as their ``__self__`` attribute)
+BOUND_METHOD_TYPES = (types.MethodType, types.BuiltinMethodType, MethodWrapperType)
+
+
 # Some functions that map other functions over different containers,
 # passing through the given state object.
 # Since it is not Haskell, for performance reasons
@@ -197,47 +212,144 @@ def try_call_method(obj, name, args=(), kwds={}):
     return try_call(attr, args=args, kwds=kwds)
 
 
-def peval_call(state, ctx, func, args=[], keywords=[], starargs=None, kwargs=None):
+# The types of objects that can be safely unpacked in a call at compile time
+# (iterating over a generic iterable may have side effects, e.g. exhaust a generator).
+UNPACKABLE_TYPES = (tuple, list, range, str, bytes, frozenset, set, dict)
 
-    # ``keywords`` is a list of ``ast.keyword`` objects
-    keywords_order = [keyword.arg for keyword in keywords]
-    keywords = dict((keyword.arg, keyword) for keyword in keywords)
 
-    results, state = fmap_peval_expression(
-        dict(func=func, args=args, keywords=keywords, starargs=starargs, kwargs=kwargs),
-        state, ctx)
+def _peval_call_args(state, ctx, args):
+    # Returns a list of pairs ``(starred, result)``
+    results = []
+    for arg in args:
+        if type(arg) == ast.Starred:
+            result, state = _peval_expression(arg.value, state, ctx)
+            results.append((True, result))
+        else:
+            result, state = _peval_expression(arg, state, ctx)
+            results.append((False, result))
+    return results, state
+
+
+def _peval_call_keywords(state, ctx, keywords):
+    # Returns a list of pairs ``(name, result)``, where ``name`` is ``None``
+    # for ``**`` arguments (Py3.5+)
+    results = []
+    for keyword in keywords:
+        result, state = _peval_expression(keyword.value, state, ctx)
+        results.append((keyword.arg, result))
+    return results, state
+
+
+def _unpack_call_args(arg_values, keyword_values):
+    # Returns a tuple ``(success, args, kwds)``
+    args = []
+    for starred, value in arg_values:
+        if starred:
+            if type(value) not in UNPACKABLE_TYPES:
+                return False, None, None
+            args.extend(value)
+        else:
+            args.append(value)
+
+    kwds = {}
+    for name, value in keyword_values:
+        if name is None:
+            if type(value) != dict:
+                return False, None, None
+            new_kwds = value
+        else:
+            new_kwds = {name: value}
 
-    if fmap_is_known_value_or_none(results):
-        values = fmap_get_value_or_none(results)
-        success, value = try_eval_call(
-            values['func'], args=values['args'], keywords=values['keywords'],
-            starargs=values['starargs'], kwargs=values['kwargs'])
-        if success:
-            return KnownValue(value=value), state
+        if len(set(kwds).intersection(new_kwds)) > 0:
+            # Multiple values for some of the keyword arguments, will raise an exception on call.
+            return False, None, None
+        kwds.update(new_kwds)
 
-    nodes, state = fmap_kvalue_to_node(results, state)
+    return True, args, kwds
 
-    # restore the keyword list
-    keywords = nodes['keywords']
-    nodes['keywords'] = [ast.keyword(arg=key, value=keywords[key]) for key in keywords_order]
 
-    return ast.Call(**nodes), state
+def _root_name(node):
+    # Returns the name of the variable at the root of an attribute/subscript chain
+    # (e.g. ``a`` for ``a.b[1].c``), or ``None``.
+    while type(node) in (ast.Attribute, ast.Subscript, ast.Starred):
+        node = node.value
+    return node.id if type(node) == ast.Name else None
 
 
-def try_eval_call(function, args=[], keywords=[], starargs=None, kwargs=None):
+def _is_mutable_method(obj):
+    # A method bound to an object that it can change
+    return type(obj) in BOUND_METHOD_TYPES and not is_immutable_value(obj.__self__)
 
-    starargs = starargs if starargs is not None else []
-    kwargs = kwargs if kwargs is not None else {}
 
-    args = args + list(starargs)
-    kwds = dict(keywords)
-    intersection = set(kwds).intersection(set(kwargs))
-    if len(intersection) > 0:
-        # Multiple values for some of the keyword arguments, will raise an exception on call.
-        return False, None
+def _mark_mutated(state, ctx, nodes):
+    # Marks the variables with known mutable values referred to by ``nodes``
+    # (e.g. ``x`` for ``x.y[0]``) as changed.
+    mutated_bindings = state.mutated_bindings
+    for node in nodes:
+        name = _root_name(node)
+        if (name is not None and name in ctx.bindings
+                and not is_immutable_value(ctx.bindings[name])):
+            mutated_bindings = mutated_bindings.add(name)
+    return state.update(mutated_bindings=mutated_bindings)
 
-    kwds.update(kwargs)
-    return try_call(function, args=args, kwds=kwds)
+
+def peval_call(state, ctx, func, args=[], keywords=[], starargs=None, kwargs=None):
+    """
+    Partially evaluates a function call.
+    ``args`` can contain ``ast.Starred`` nodes, and ``keywords`` can contain
+    ``ast.keyword`` nodes with ``arg=None`` (for ``**`` arguments) in Py3.5+;
+    ``starargs`` and ``kwargs`` are the corresponding fields of ``ast.Call`` in earlier versions.
+    """
+
+    func_result, state = _peval_expression(func, state, ctx)
+
+    all_args = list(args)
+    if starargs is not None:
+        all_args.append(ast.Starred(value=starargs, ctx=ast.Load()))
+    arg_results, state = _peval_call_args(state, ctx, all_args)
+
+    all_keywords = list(keywords)
+    if kwargs is not None:
+        all_keywords.append(ast.keyword(arg=None, value=kwargs))
+    keyword_results, state = _peval_call_keywords(state, ctx, all_keywords)
+
+    results = [func_result] + [result for _, result in arg_results + keyword_results]
+    if fmap_is_known_value(results):
+        success, arg_values, kwd_values = _unpack_call_args(
+            [(starred, result.value) for starred, result in arg_results],
+            [(name, result.value) for name, result in keyword_results])
+        if success:
+            success, value = try_call(func_result.value, args=tuple(arg_values), kwds=kwd_values)
+            if success:
+                return KnownValue(value=value), state
+
+    if not (is_known_value(func_result) and is_known_pure(func_result.value)):
+        # The call is left for the runtime, and it can change the object whose method is called
+        # and the arguments, so their known values cannot be used after it.
+        state = _mark_mutated(
+            state, ctx, [func] + all_args + [keyword.value for keyword in all_keywords])
+
+    func_node, state = fmap_kvalue_to_node(func_result, state)
+
+    arg_nodes = []
+    for starred, result in arg_results:
+        node, state = fmap_kvalue_to_node(result, state)
+        arg_nodes.append(ast.Starred(value=node, ctx=ast.Load()) if starred else node)
+
+    keyword_nodes = []
+    for name, result in keyword_results:
+        node, state = fmap_kvalue_to_node(result, state)
+        keyword_nodes.append(ast.keyword(arg=name, value=node))
+
+    if starargs is None and kwargs is None:
+        return ast.Call(func=func_node, args=arg_nodes, keywords=keyword_nodes), state
+    else:
+        # Pre-Py3.5 call with ``*`` or ``**`` arguments
+        new_starargs = arg_nodes.pop().value if starargs is not None else None
+        new_kwargs = keyword_nodes.pop().value if kwargs is not None else None
+        return ast.Call(
+            func=func_node, args=arg_nodes, keywords=keyword_nodes,
+            starargs=new_starargs, kwargs=new_kwargs), state
 
 
 def peval_boolop(state, ctx, op, values):
@@ -427,10 +539,9 @@ def peval_comprehension(node, state, ctx):
             target_names.update([elt.id for elt in generator.target.elts])
 
     # pre-evaluate the expression
-    elt_bindings = dict(ctx.bindings)
+    elt_bindings = ctx.bindings
     for name in target_names:
-        if name in elt_bindings:
-            del elt_bindings[name]
+        elt_bindings = elt_bindings.del_(name)
     elt_ctx = ctx.update(bindings=elt_bindings)
 
     if sys.version_info >= (2, 7) and type(node) == ast.DictComp:
@@ -439,12 +550,18 @@ def peval_comprehension(node, state, ctx):
         elt = node.elt
     new_elt, state = _peval_expression(elt, state, elt_ctx)
 
-    try:
-        container, state = _peval_comprehension(
-            accum_cls[type(node)], new_elt, node.generators, state, ctx)
-        evaluated = True
-    except CannotEvaluateComprehension:
+    if not ctx.create_containers:
         evaluated = False
+    elif any(getattr(generator, 'is_async', False) for generator in node.generators):
+        # Asynchronous comprehensions can only be executed inside a coroutine
+        evaluated = False
+    else:
+        try:
+            container, state = _peval_comprehension(
+                accum_cls[type(node)], new_elt, node.generators, state, ctx)
+            evaluated = True
+        except CannotEvaluateComprehension:
+            evaluated = False
 
     if evaluated:
         return KnownValue(value=container), state
@@ -476,10 +593,9 @@ def _get_masked_bindings(target, bindings):
     else:
         target_names = [elt.id for elt in target.elts]
 
-    new_bindings = dict(bindings)
+    new_bindings = bindings
     for name in target_names:
-        if name in new_bindings:
-            del new_bindings[name]
+        new_bindings = new_bindings.del_(name)
 
     return new_bindings
 
@@ -505,7 +621,8 @@ def _peval_comprehension_generators(generators, state, ctx):
 
     new_generator_kwds, state = fmap_kvalue_to_node(
         dict(target=generator.target, iter=iter_result, ifs=ifs_result), state)
-    new_generator = ast.comprehension(**new_generator_kwds)
+    # Preserving the rest of the fields (e.g. ``is_async``)
+    new_generator = replace_fields(generator, **new_generator_kwds)
 
     new_generators, state = _peval_comprehension_generators(next_generators, state, ctx)
 
@@ -574,8 +691,7 @@ def _peval_comprehension(accum_cls, elt, generators, state, ctx):
         if not unpacked:
             raise CannotEvaluateComprehension
 
-        iter_bindings = dict(ctx.bindings)
-        iter_bindings.update(target_bindings)
+        iter_bindings = ctx.bindings.update(target_bindings)
         iter_ctx = ctx.set('bindings', iter_bindings)
 
         ifs_value, state = _peval_expression(ifs_result, state, iter_ctx)
@@ -611,11 +727,16 @@ class _peval_expression:
     @staticmethod
     def handle_Name(node, state, ctx):
         name = node.id
-        if name in ctx.bindings:
+        if name in ctx.bindings and name not in state.mutated_bindings:
             return KnownValue(ctx.bindings[name], preferred_name=name), state
         else:
             return node, state
 
+    @staticmethod
+    def handle_Constant(node, state, ctx):
+        # For Python >= 3.8
+        return KnownValue(node.value), state
+
     @staticmethod
     def handle_Num(node, state, ctx):
         return KnownValue(node.n), state
@@ -678,7 +799,7 @@ class _peval_expression:
         pairs, state = fmap_peval_expression(zip(node.keys, node.values), state, ctx)
         can_eval = fmap_is_known_value(pairs)
 
-        if can_eval:
+        if can_eval and ctx.create_containers:
             new_dict = dict((key.value, value.value) for key, value in pairs)
             return KnownValue(value=new_dict), state
         else:
@@ -692,7 +813,7 @@ class _peval_expression:
         elts, state = fmap_peval_expression(node.elts, state, ctx)
         can_eval = fmap_is_known_value(elts)
 
-        if can_eval:
+        if can_eval and ctx.create_containers:
             new_list = [elt.value for elt in elts]
             return KnownValue(value=new_list), state
         else:
@@ -718,7 +839,7 @@ class _peval_expression:
         elts, state = fmap_peval_expression(node.elts, state, ctx)
         can_eval = fmap_is_known_value(elts)
 
-        if can_eval:
+        if can_eval and ctx.create_containers:
             new_set = set(elt.value for elt in elts)
             return KnownValue(value=new_set), state
         else:
@@ -759,25 +880,84 @@ class _peval_expression:
         new_value, state = fmap_kvalue_to_node(result, state)
         return replace_fields(node, value=new_value), state
 
+    @staticmethod
+    def handle_Await(node, state, ctx):
+        result, state = _peval_expression(node.value, state, ctx)
+
+        # An ``await`` can only be executed by the event loop at runtime,
+        # so only the awaitable expression is evaluated.
+        new_value, state = fmap_kvalue_to_node(result, state)
+        return replace_fields(node, value=new_value), state
+
     @staticmethod
     def handle_Compare(node, state, ctx):
         return peval_compare(state, ctx, node)
 
     @staticmethod
     def handle_Call(node, state, ctx):
+        # ``starargs`` and ``kwargs`` fields only exist before Py3.5
         return peval_call(
             state, ctx, node.func, args=node.args, keywords=node.keywords,
-            starargs=node.starargs, kwargs=node.kwargs)
+            starargs=getattr(node, 'starargs', None), kwargs=getattr(node, 'kwargs', None))
+
+    @staticmethod
+    def handle_JoinedStr(node, state, ctx):
+        # For Python >= 3.6
+        results, state = fmap_peval_expression(node.values, state, ctx)
+
+        if fmap_is_known_value(results):
+            return KnownValue(value="".join(result.value for result in results)), state
+
+        # Merging adjacent evaluated parts
+        new_values = []
+        for result in results:
+            if is_known_value(result):
+                if len(new_values) > 0 and is_known_value(new_values[-1]):
+                    new_values[-1] = KnownValue(value=new_values[-1].value + result.value)
+                else:
+                    new_values.append(result)
+            else:
+                new_values.append(result)
+
+        new_values, state = fmap_kvalue_to_node(new_values, state)
+        return replace_fields(node, values=new_values), state
 
     @staticmethod
-    def handle_keyword(node, state, ctx):
+    def handle_FormattedValue(node, state, ctx):
+        # For Python >= 3.6
+        value_result, state = _peval_expression(node.value, state, ctx)
+        spec_result, state = fmap_peval_expression(node.format_spec, state, ctx)
+
+        if is_known_value(value_result) and fmap_is_known_value_or_none(spec_result):
+            value = value_result.value
+            converter = FORMAT_CONVERSIONS.get(node.conversion)
+            success = True
+            if converter is not None:
+                success, value = try_call(converter, args=(value,))
+            if success:
+                spec = spec_result.value if spec_result is not None else ''
+                success, formatted = try_call(format, args=(value, spec))
+                if success and type(formatted) == str:
+                    return KnownValue(value=formatted), state
+
+        new_value, state = fmap_kvalue_to_node(value_result, state)
+        new_spec, state = fmap_kvalue_to_node(spec_result, state)
+        if is_known_value(spec_result):
+            # ``format_spec`` must be a ``JoinedStr``
+            new_spec = ast.JoinedStr(values=[new_spec])
+        return replace_fields(node, value=new_value, format_spec=new_spec), state
+
+    @staticmethod
+    def handle_NamedExpr(node, state, ctx):
+        # For Python >= 3.8
         result, state = _peval_expression(node.value, state, ctx)
-        if is_known_value(result):
-            # The handler for ast.Call will take care of preserving this keyword's name;
-            # this method's task is to try and calculate the value.
-            return KnownValue(value=result.value), state
-        else:
-            return node, state
+
+        # The assignment cannot be removed, so the expression is never fully evaluated;
+        # the target variable is marked as changed, so that its old value is not used
+        # in the rest of the expression (and by the callers).
+        new_value, state = fmap_kvalue_to_node(result, state)
+        state = state.update(mutated_bindings=state.mutated_bindings.add(node.target.id))
+        return replace_fields(node, value=new_value), state
 
     @staticmethod
     def handle_Repr(node, state, ctx):
@@ -795,7 +975,9 @@ class _peval_expression:
         result, state = _peval_expression(node.value, state, ctx)
         if is_known_value(result):
             success, attr = try_get_attribute(result.value, node.attr)
-            if success:
+            # A method that can change its object is left as is,
+            # so that the call marks the object as changed.
+            if success and not _is_mutable_method(attr):
                 return KnownValue(value=attr), state
 
         new_value, state = fmap_kvalue_to_node(result, state)
@@ -847,48 +1029,162 @@ class _peval_expression:
 
 class EvaluationResult:
 
-    def __init__(self, fully_evaluated, node, temp_bindings, value=None):
+    def __init__(self, fully_evaluated, node, temp_bindings, value=None, mutated_bindings=None):
         self.fully_evaluated = fully_evaluated
         if fully_evaluated:
             self.value = value
         self.temp_bindings = temp_bindings
         self.node = node
-        self.mutated_bindings = set()
+        self.mutated_bindings = mutated_bindings if mutated_bindings is not None else set()
 
 
-def peval_expression(node, gen_sym, bindings, py2_division=False):
+def peval_expression(node, gen_sym, bindings, py2_division=False, create_containers=False):
+    """
+    Partially evaluates the expression ``node`` with the known values of variables ``bindings``.
+
+    The lists, dictionaries and sets created by displays and comprehensions
+    (and the generator expressions) are only evaluated if ``create_containers`` is ``True``.
+    Otherwise they are left in the code (with their elements evaluated),
+    since an object created at compile time would be shared by all the evaluations
+    of the expression, and could be changed by any of them.
+    """
 
     # We do not really need the Py2-style division in Py3,
     # since it never occurs in actual code.
     if py2_division and sys.version_info >= (3,):
         raise ValueError("`py2_division` is not supported on Python 3.x")
 
-    ctx = immutableadict(bindings=bindings, py2_division=py2_division)
-    state = immutableadict(gen_sym=gen_sym, temp_bindings=immutableadict())
+    # The bindings are modified with pure methods only,
+    # so a mutable mapping is wrapped (without copying) to provide them.
+    if not isinstance(bindings, (immutabledict, immutablechainmap)):
+        bindings = immutablechainmap(bindings)
+
+    ctx = immutableadict(
+        bindings=bindings, py2_division=py2_division, create_containers=create_containers)
+    state = immutableadict(
+        gen_sym=gen_sym, temp_bindings=immutableadict(), mutated_bindings=immutableset())
 
     result, state = _peval_expression(node, state, ctx)
     if is_known_value(result):
         result_node, state = fmap_kvalue_to_node(result, state)
+    else:
+        result_node = result
+
+    # The handlers create new nodes even if nothing has changed;
+    # returning the original one in this case, so that the callers
+    # could detect changes by identity.
+    if result_node is not node and ast_equal(result_node, node):
+        result_node = node
+
+    if is_known_value(result):
         eval_result = EvaluationResult(
             fully_evaluated=True,
             value=result.value,
             node=result_node,
-            temp_bindings=state.temp_bindings)
+            temp_bindings=state.temp_bindings,
+            mutated_bindings=state.mutated_bindings)
     else:
         eval_result = EvaluationResult(
             fully_evaluated=False,
-            node=result,
-            temp_bindings=state.temp_bindings)
+            node=result_node,
+            temp_bindings=state.temp_bindings,
+            mutated_bindings=state.mutated_bindings)
 
     return eval_result, state.gen_sym
 
 
-def try_peval_expression(node, bindings, py2_division=False):
+def try_peval_expression(node, bindings, py2_division=False, create_containers=False):
 
     gen_sym = GenSym()
-    eval_result, gen_sym = peval_expression(node, gen_sym, bindings, py2_division=py2_division)
+    eval_result, gen_sym = peval_expression(
+        node, gen_sym, bindings, py2_division=py2_division, create_containers=create_containers)
     if eval_result.fully_evaluated:
         return True, eval_result.value
     else:
         return False, node
 
+
+
+def _all_names(nodes):
+    # The names of all the variables mentioned in ``nodes`` (a node or a list of nodes)
+    names = set()
+    for node in (nodes if isinstance(nodes, list) else [nodes]):
+        for subnode in ast.walk(node):
+            if type(subnode) == ast.Name:
+                names.add(subnode.id)
+    return names
+
+
+def _call_arguments(node):
+    # All the expressions passed to the callee of an ``ast.Call`` node
+    args = list(node.args) + [keyword.value for keyword in node.keywords]
+    # Py<3.5
+    for field in ('starargs', 'kwargs'):
+        if getattr(node, field, None) is not None:
+            args.append(getattr(node, field))
+    return args
+
+
+_LINKING_NODES = tuple(getattr(ast, name) for name in (
+    'Assign', 'AnnAssign', 'AugAssign', 'For', 'AsyncFor', 'comprehension',
+    'withitem', 'NamedExpr') if hasattr(ast, name))
+
+
+def _linked_parts(node):
+    # The parts of a binding node that can refer to the same objects afterwards
+    if hasattr(node, 'targets'):
+        # Assign
+        return node.targets + [node.value]
+    elif hasattr(node, 'iter'):
+        # For, AsyncFor, comprehension
+        return [node.target, node.iter]
+    elif hasattr(node, 'context_expr'):
+        # withitem
+        return [node.context_expr] + (
+            [node.optional_vars] if node.optional_vars is not None else [])
+    else:
+        # AnnAssign, AugAssign, NamedExpr
+        return [node.target] + ([node.value] if node.value is not None else [])
+
+
+def find_mutated_names(tree, bindings):
+    """
+    Returns the set of names of the variables in ``tree`` whose objects
+    can be changed by it: the ones used as the roots of assignment targets
+    (e.g. ``x`` in ``x[0] = 1``), the receivers and the arguments of the calls
+    that are not known to be pure (see :py:func:`~peval.wisdom.is_known_pure`),
+    and the variables that can be bound to the same objects as these ones
+    (e.g. ``y`` in ``y = x``, or in ``for y in x``).
+
+    The analysis does not depend on the control flow, so it is conservative.
+    The known values of such variables can be used only if they are immutable
+    (see :py:func:`~peval.wisdom.is_immutable_value`).
+    """
+    roots = set()
+    neighbours = {}
+    for node in ast.walk(tree):
+        node_type = type(node)
+
+        if node_type in (ast.Attribute, ast.Subscript) and type(node.ctx) != ast.Load:
+            roots.update(_all_names(node.value))
+        elif node_type == ast.AugAssign:
+            # Changed in-place if the object supports it
+            roots.update(_all_names(node.target))
+        elif node_type == ast.Call:
+            evaluated, func = try_peval_expression(node.func, bindings)
+            if not (evaluated and is_known_pure(func)):
+                roots.update(_all_names([node.func] + _call_arguments(node)))
+
+        if isinstance(node, _LINKING_NODES):
+            names = _all_names(_linked_parts(node))
+            for name in names:
+                neighbours.setdefault(name, set()).update(names)
+
+    mutated_names = set()
+    to_visit = list(roots)
+    while len(to_visit) > 0:
+        name = to_visit.pop()
+        if name not in mutated_names:
+            mutated_names.add(name)
+            to_visit.extend(neighbours.get(name, ()))
+    return mutated_names
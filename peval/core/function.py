@@ -11,7 +11,9 @@ from types import FunctionType
 import funcsigs
 import astunparse
 
-from peval.tools import unindent, get_fn_arg_id, replace_fields, immutableadict
+from peval.tools import (
+    unindent, get_fn_arg_id, replace_fields, immutableadict, immutablechainmap, ast_inspector)
+from peval.core.ast_index import ast_index
 from peval.core.gensym import GenSym
 from peval.core.value import value_to_node
 from peval.core.symbol_finder import find_symbol_usages
@@ -27,16 +29,100 @@ FUTURE_FLAGS = reduce(
     lambda x, y: x | y, [feature.compiler_flag for feature in FUTURE_FEATURES.values()], 0)
 
 
+def _unparse(tree):
+    # ``astunparse`` does not know about the newer syntax (e.g. ``match``),
+    # so the standard library version is used where it is available.
+    if hasattr(ast, 'unparse'):
+        return ast.unparse(ast.fix_missing_locations(copy.deepcopy(tree))) + '\n'
+    else:
+        return astunparse.unparse(tree)
+
+
+# ``async def`` is only available in Py3.5+
+FUNCTION_DEF_TYPES = tuple(
+    getattr(ast, name) for name in ('FunctionDef', 'AsyncFunctionDef') if hasattr(ast, name))
+
+
+@ast_inspector
+class _find_yields:
+
+    @staticmethod
+    def handle_FunctionDef(node, state, skip_fields, **kwds):
+        skip_fields()
+        return state
+
+    @staticmethod
+    def handle_AsyncFunctionDef(node, state, skip_fields, **kwds):
+        skip_fields()
+        return state
+
+    @staticmethod
+    def handle_ClassDef(node, state, skip_fields, **kwds):
+        skip_fields()
+        return state
+
+    @staticmethod
+    def handle_Lambda(node, state, skip_fields, **kwds):
+        skip_fields()
+        return state
+
+    @staticmethod
+    def handle_Yield(node, state, **kwds):
+        return state.update(found=True)
+
+    @staticmethod
+    def handle_YieldFrom(node, state, **kwds):
+        return state.update(found=True)
+
+
+def is_generator(function_def):
+    """
+    Returns ``True`` if the body of the function definition contains
+    a ``yield`` (not counting nested functions and classes), that is,
+    if it defines a generator (or an asynchronous generator for ``async def``).
+    """
+    return _find_yields(function_def.body, state=dict(found=False)).found
+
+
+def _singleton_node(value):
+    # A node for ``True``, ``False`` or ``None``
+    if sys.version_info >= (3, 8):
+        return ast.Constant(value=value, kind=None)
+    elif sys.version_info >= (3, 4):
+        return ast.NameConstant(value=value)
+    else:
+        return ast.Name(id=str(value), ctx=ast.Load())
+
+
+def make_generator(function_def):
+    """
+    Returns a function definition that is a generator even if
+    there are no ``yield`` statements left in its body
+    (e.g. after all of them were found to be unreachable during specialization).
+    """
+    if is_generator(function_def):
+        return function_def
+
+    # An unreachable ``yield`` makes the compiler mark the function as a generator.
+    never = _singleton_node(False)
+    unreachable_yield = ast.If(
+        test=never, body=[ast.Expr(value=ast.Yield(value=None))], orelse=[])
+    return replace_fields(function_def, body=function_def.body + [unreachable_yield])
+
+
 def eval_function_def(function_def, globals_=None, flags=None):
     """
     Evaluates an AST of a function definition with an optional dictionary of globals.
     Returns a callable function (a ``types.FunctionType`` object).
     """
 
-    assert type(function_def) == ast.FunctionDef
+    assert type(function_def) in FUNCTION_DEF_TYPES
 
     # Making a copy before mutating
-    module = ast.Module(body=[copy.deepcopy(function_def)])
+    if sys.version_info >= (3, 8):
+        module = ast.Module(body=[copy.deepcopy(function_def)], type_ignores=[])
+    else:
+        module = ast.Module(body=[copy.deepcopy(function_def)])
 
     ast.fix_missing_locations(module)
 
@@ -65,12 +151,9 @@ def eval_function_def_as_closure(function_def, closure_names, globals_=None, fla
         that will be used during the call.
     """
 
-    assert type(function_def) == ast.FunctionDef
+    assert type(function_def) in FUNCTION_DEF_TYPES
 
-    if sys.version_info >= (3, 4):
-        none = ast.NameConstant(value=None)
-    else:
-        none = ast.Name(id='None', ctx=ast.Load())
+    none = _singleton_node(None)
 
     # We can't possibly recreate ASTs of existing closure variables
     # (because all we have are their values).
@@ -98,6 +181,8 @@ def eval_function_def_as_closure(function_def, closure_names, globals_=None, fla
             kwarg=None,
             defaults=[],
             kw_defaults=[])
+        if sys.version_info >= (3, 8):
+            empty_args.posonlyargs = []
 
     wrapper_def = ast.FunctionDef(
         name='__peval_wrapper',
@@ -188,25 +273,17 @@ def filter_arguments(arguments, bound_argnames):
 
 def filter_function_def(function_def, bound_argnames):
     """
-    Filters a node containing a function definition (an ``ast.FunctionDef`` object)
+    Filters a node containing a function definition
+    (an ``ast.FunctionDef`` or ``ast.AsyncFunctionDef`` object)
     to exclude all arguments with the names present in ``bound_arguments``.
-    Returns the new ``ast.arguments`` node.
+    Returns the new function definition node.
     """
 
-    assert type(function_def) == ast.FunctionDef
+    assert type(function_def) in FUNCTION_DEF_TYPES
 
     new_args = filter_arguments(function_def.args, bound_argnames)
 
-    params = dict(
-        name=function_def.name,
-        args=new_args,
-        body=function_def.body,
-        decorator_list=function_def.decorator_list)
-    if sys.version_info >= (3,):
-        params.update(dict(
-            returns=function_def.returns))
-
-    return ast.FunctionDef(**params)
+    return replace_fields(function_def, args=new_args)
 
 
 class Function(object):
@@ -238,23 +315,23 @@ class Function(object):
 
     def get_external_variables(self):
         """
-        Returns a unified dictionary of external variables for this function
-        (both globals and closure variables).
+        Returns a unified mapping of external variables for this function
+        (closure variables, globals and builtins, in the order of precedence).
+        The result is an :py:class:`~peval.tools.immutablechainmap`
+        referring to the globals and builtins without copying them;
+        the values added to it later are available via its ``overrides`` attribute.
         """
 
         # Builtins can be either a dict or a module
         builtins = self.globals['__builtins__']
-        if isinstance(builtins, dict):
-            result = dict(builtins)
-        else:
-            result = dict(vars(builtins))
+        if not isinstance(builtins, dict):
+            builtins = vars(builtins)
 
-        result.update(self.globals)
+        closure_vars = dict(
+            (name, cell.cell_contents)
+            for name, cell in zip(self.closure_names, self.closure_cells))
 
-        for name, val in zip(self.closure_names, self.closure_cells):
-            result[name] = val.cell_contents
-
-        return result
+        return immutablechainmap(closure_vars, self.globals, builtins)
 
     @classmethod
     def from_object(cls, function):
@@ -266,11 +343,14 @@ class Function(object):
 
         if hasattr(function, '_peval_source'):
             # An attribute created in ``Function.eval()``
-            src = getattr(function, '_peval_source')
+            tree = ast.parse(getattr(function, '_peval_source')).body[0]
         else:
-            src = unindent(inspect.getsource(function))
-
-        tree = ast.parse(src).body[0]
+            tree = ast_index.get_function_def(function)
+            if tree is None:
+                # Not a regular source file, or the source file has changed
+                # since the function was compiled.
+                src = unindent(inspect.getsource(function))
+                tree = ast.parse(src).body[0]
 
         globals_ = function.__globals__
         globals_[function.__name__] = function
@@ -358,7 +438,7 @@ class Function(object):
         # So we just save the source into an attribute for ``Function.from_object()``
         # to discover if we ever want to create a new ``Function`` object
         # out of this function.
-        vars(func)['_peval_source'] = astunparse.unparse(self.tree)
+        vars(func)['_peval_source'] = _unparse(self.tree)
 
         return func
 
@@ -0,0 +1,272 @@
+"""
+A configurable pipeline of optimization passes
+(functions with the signature ``pass(tree, constants) -> (new_tree, new_constants)``)
+run until a fixed point is reached.
+"""
+
+import ast
+import time
+import warnings
+from collections import OrderedDict
+
+from peval.tools import immutabledict, immutablechainmap
+
+
+# The default limit on the number of iterations of the fixed point loop.
+# The passes normally converge in a few iterations; reaching the limit
+# means that some of them keep changing the tree back and forth.
+DEFAULT_MAX_ITERATIONS = 100
+
+
+def count_nodes(tree):
+    """
+    Returns the number of AST nodes in ``tree``.
+    """
+    return sum(1 for _ in ast.walk(tree))
+
+
+class PassStats(object):
+    """
+    Statistics for a single pass collected during one specialization.
+
+    :ivar time: total wall time spent in the pass (in seconds).
+    :ivar calls: the number of times the pass was called.
+    :ivar changes: the number of calls that changed the tree or the constants.
+    :ivar node_delta: the total change of the number of AST nodes in the tree.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.time = 0.
+        self.calls = 0
+        self.changes = 0
+        self.node_delta = 0
+
+    def __repr__(self):
+        return (
+            "PassStats({name}, time={time:.6f}, calls={calls}, "
+            "changes={changes}, node_delta={node_delta})").format(
+            name=repr(self.name), time=self.time, calls=self.calls,
+            changes=self.changes, node_delta=self.node_delta)
+
+
+class PassReport(object):
+    """
+    Statistics collected during one run of a :py:class:`PassManager`.
+
+    :ivar iterations: the number of iterations of the fixed point loop.
+    :ivar converged: ``False`` if the loop was stopped by the iteration limit
+        before reaching the fixed point.
+    :ivar time: total wall time (in seconds).
+    :ivar passes: an ``OrderedDict`` of pass names to :py:class:`PassStats` objects.
+    """
+
+    def __init__(self, pass_names):
+        self.iterations = 0
+        self.converged = True
+        self.time = 0.
+        self.passes = OrderedDict((name, PassStats(name)) for name in pass_names)
+
+    def __repr__(self):
+        return (
+            "PassReport(iterations={iterations}, converged={converged}, "
+            "time={time:.6f}, passes={passes})").format(
+            iterations=self.iterations, converged=self.converged, time=self.time,
+            passes=list(self.passes.values()))
+
+
+class PassManager(object):
+    """
+    Runs a list of passes repeatedly until none of them changes the tree or the constants
+    (detected by identity, see :py:func:`~peval.tools.ast_walker`).
+
+    :param passes: a list of pairs ``(name, pass)``.
+    :param max_iterations: the maximum number of iterations of the fixed point loop
+        (``None`` for no limit). If it is reached, the result of the last iteration
+        is returned, and a ``RuntimeWarning`` is issued.
+    :param on_report: a function that will be called with a :py:class:`PassReport` object
+        after every run.
+
+    The report of the last run is also available as the ``last_report`` attribute.
+    The ``version`` attribute is incremented on every change of the configuration.
+    """
+
+    def __init__(self, passes=None, max_iterations=DEFAULT_MAX_ITERATIONS, on_report=None):
+        self._passes = OrderedDict()
+        self._disabled = set()
+        self._max_iterations = max_iterations
+        self.on_report = on_report
+        self.last_report = None
+        self.version = 0
+
+        if passes is not None:
+            for name, pass_ in passes:
+                self.register(name, pass_)
+
+    def _changed(self):
+        self.version += 1
+
+    @property
+    def max_iterations(self):
+        """
+        The maximum number of iterations of the fixed point loop.
+        Since it affects the results, changing it increments ``version``.
+        """
+        return self._max_iterations
+
+    @max_iterations.setter
+    def max_iterations(self, max_iterations):
+        self._max_iterations = max_iterations
+        self._changed()
+
+    def register(self, name, pass_, before=None, after=None):
+        """
+        Adds a new pass at the end of the list,
+        or right before or after the pass with the given name.
+        """
+        if name in self._passes:
+            raise ValueError("Pass " + repr(name) + " is already registered")
+        if before is not None and after is not None:
+            raise ValueError("Only one of `before` and `after` can be given")
+
+        anchor = before if before is not None else after
+        if anchor is None:
+            self._passes[name] = pass_
+        else:
+            if anchor not in self._passes:
+                raise KeyError(anchor)
+            new_passes = OrderedDict()
+            for existing_name, existing_pass in self._passes.items():
+                if existing_name == anchor and before is not None:
+                    new_passes[name] = pass_
+                new_passes[existing_name] = existing_pass
+                if existing_name == anchor and after is not None:
+                    new_passes[name] = pass_
+            self._passes = new_passes
+
+        self._changed()
+
+    def unregister(self, name):
+        """
+        Removes the pass with the given name.
+        """
+        del self._passes[name]
+        self._disabled.discard(name)
+        self._changed()
+
+    def reorder(self, names):
+        """
+        Sets the order of the passes.
+        ``names`` must contain the names of all the registered passes.
+        """
+        if sorted(names) != sorted(self._passes):
+            raise ValueError("The new order must contain all the registered passes")
+        self._passes = OrderedDict((name, self._passes[name]) for name in names)
+        self._changed()
+
+    def disable(self, name):
+        """
+        Disables the pass with the given name, keeping its place in the list.
+        """
+        if name not in self._passes:
+            raise KeyError(name)
+        self._disabled.add(name)
+        self._changed()
+
+    def enable(self, name):
+        """
+        Enables the previously disabled pass with the given name.
+        """
+        if name not in self._passes:
+            raise KeyError(name)
+        self._disabled.discard(name)
+        self._changed()
+
+    @property
+    def pass_names(self):
+        """
+        The names of all the registered passes (in order).
+        """
+        return list(self._passes)
+
+    @property
+    def enabled_pass_names(self):
+        """
+        The names of the enabled passes (in order).
+        """
+        return [name for name in self._passes if name not in self._disabled]
+
+    def copy(self):
+        """
+        Returns an independent copy of this pass manager.
+        """
+        new_manager = PassManager(
+            passes=self._passes.items(), max_iterations=self.max_iterations,
+            on_report=self.on_report)
+        for name in self._disabled:
+            new_manager.disable(name)
+        return new_manager
+
+    def run(self, tree, constants):
+        """
+        Runs the enabled passes until the fixed point
+        (or until the maximum number of iterations is reached).
+        Returns a tuple ``(new_tree, new_constants)``.
+        If ``constants`` is a mutable mapping, it is wrapped
+        in an :py:class:`~peval.tools.immutablechainmap` (without copying) first.
+        """
+        if not isinstance(constants, (immutabledict, immutablechainmap)):
+            constants = immutablechainmap(constants)
+
+        passes = [(name, self._passes[name]) for name in self.enabled_pass_names]
+        report = PassReport([name for name, _ in passes])
+        start = time.time()
+
+        node_count = None
+        while True:
+            if self.max_iterations is not None and report.iterations >= self.max_iterations:
+                report.converged = False
+                warnings.warn(
+                    "The passes did not reach a fixed point in {n} iterations".format(
+                        n=self.max_iterations),
+                    RuntimeWarning)
+                break
+
+            report.iterations += 1
+
+            new_tree = tree
+            new_constants = constants
+            for name, pass_ in passes:
+                stats = report.passes[name]
+
+                pass_start = time.time()
+                result_tree, result_constants = pass_(new_tree, new_constants)
+                stats.time += time.time() - pass_start
+                stats.calls += 1
+
+                # Counting the nodes only if something has changed
+                # to keep the overhead low.
+                if result_tree is not new_tree or result_constants is not new_constants:
+                    stats.changes += 1
+                    if result_tree is not new_tree:
+                        if node_count is None:
+                            node_count = count_nodes(new_tree)
+                        new_node_count = count_nodes(result_tree)
+                        stats.node_delta += new_node_count - node_count
+                        node_count = new_node_count
+
+                new_tree, new_constants = result_tree, result_constants
+
+            # The passes return the same objects if they did not change anything.
+            if new_tree is tree and new_constants is constants:
+                break
+
+            tree = new_tree
+            constants = new_constants
+
+        report.time = time.time() - start
+        self.last_report = report
+        if self.on_report is not None:
+            self.on_report(report)
+
+        return tree, constants
@@ -1,4 +1,6 @@
 import ast
+import sys
+
 import six
 
 from peval.tools import immutableset, ast_inspector
@@ -59,3 +61,212 @@ def find_symbol_usages(tree):
     '''
     state = _find_symbol_usages(tree, state=dict(names=immutableset()))
     return state.names
+
+
+# Nodes with their own scope that can appear in a statement
+_SCOPE_NODES = tuple(
+    getattr(ast, name) for name in ('GeneratorExp', 'ListComp', 'SetComp', 'DictComp', 'Lambda')
+    if hasattr(ast, name))
+
+_TRY_NODES = tuple(
+    getattr(ast, name) for name in ('Try', 'TryStar', 'TryExcept', 'TryFinally')
+    if hasattr(ast, name))
+
+
+def _local_creations(node):
+    # Same as ``find_symbol_creations()``, but skipping the nested scopes
+    # (the names assigned in a comprehension do not leak out of it in Py3).
+    # The assignment expressions in comprehensions are skipped too,
+    # which is conservative for the analysis below.
+    names = set()
+    if isinstance(node, _SCOPE_NODES):
+        return names
+    if isinstance(node, (ast.FunctionDef, ast.ClassDef)) or (
+            sys.version_info >= (3, 5) and type(node) == ast.AsyncFunctionDef):
+        names.add(node.name)
+        return names
+    if type(node) == ast.Name and type(node.ctx) in STORE_CTXS:
+        names.add(node.id)
+    elif type(node) == ast.alias:
+        names.update(find_symbol_creations(node))
+    elif type(node) == ast.ExceptHandler and _handler_name(node) is not None:
+        names.add(_handler_name(node))
+    elif sys.version_info >= (3, 10) and type(node) in (ast.MatchAs, ast.MatchStar):
+        if node.name is not None:
+            names.add(node.name)
+    elif sys.version_info >= (3, 10) and type(node) == ast.MatchMapping:
+        if node.rest is not None:
+            names.add(node.rest)
+    for child in ast.iter_child_nodes(node):
+        names.update(_local_creations(child))
+    return names
+
+
+def _local_usages(node):
+    # The names read by a simple statement or an expression
+    # (including the targets of augmented assignments and ``del``).
+    if isinstance(node, (ast.FunctionDef, ast.ClassDef)) or (
+            sys.version_info >= (3, 5) and type(node) == ast.AsyncFunctionDef):
+        # Only the decorators and the default values are evaluated
+        parts = list(node.decorator_list)
+        if type(node) == ast.ClassDef:
+            parts += node.bases
+        else:
+            parts += node.args.defaults + [
+                default for default in getattr(node.args, 'kw_defaults', [])
+                if default is not None]
+        names = set()
+        for part in parts:
+            names.update(find_symbol_usages(part))
+        return names
+
+    names = set(find_symbol_usages(node))
+    for subnode in ast.walk(node):
+        if type(subnode) == ast.AugAssign and type(subnode.target) == ast.Name:
+            names.add(subnode.target.id)
+        elif type(subnode) == ast.Name and type(subnode.ctx) == ast.Del:
+            names.add(subnode.id)
+    return names
+
+
+def _meet(names1, names2):
+    # ``None`` stands for the state at an unreachable point
+    if names1 is None:
+        return names2
+    elif names2 is None:
+        return names1
+    else:
+        return names1 & names2
+
+
+class _AssignmentAnalysis(object):
+
+    def __init__(self, assigned_before):
+        self.assigned_before = assigned_before
+        self.usages = []
+
+    def use(self, node, names):
+        self.usages.append((_local_usages(node), names))
+
+    def block(self, statements, names):
+        for statement in statements:
+            if names is None:
+                break
+            names = self.statement(statement, names)
+        return names
+
+    def statement(self, node, names):
+        if self.assigned_before is not None:
+            self.assigned_before[id(node)] = names
+
+        node_type = type(node)
+        if node_type == ast.If:
+            self.use(node.test, names)
+            return _meet(self.block(node.body, names), self.block(node.orelse, names))
+
+        elif node_type == ast.While:
+            self.use(node.test, names)
+            # Any state inside the loop includes the one before it,
+            # so analyzing a single iteration is enough.
+            self.block(node.body, names)
+            return self.block(node.orelse, names)
+
+        elif node_type == ast.For or (sys.version_info >= (3, 5) and node_type == ast.AsyncFor):
+            self.use(node.iter, names)
+            self.block(node.body, names | _local_creations(node.target))
+            return self.block(node.orelse, names)
+
+        elif node_type == ast.With or (sys.version_info >= (3, 5) and node_type == ast.AsyncWith):
+            items = node.items if sys.version_info >= (3, 3) else [node]
+            for item in items:
+                self.use(item.context_expr, names)
+                if item.optional_vars is not None:
+                    names = names | _local_creations(item.optional_vars)
+            return self.block(node.body, names)
+
+        elif isinstance(node, _TRY_NODES):
+            # Any statement in the ``try`` block can raise before its assignments take place
+            handlers = getattr(node, 'handlers', [])
+            body = node.body
+            orelse = getattr(node, 'orelse', [])
+            if node_type == getattr(ast, 'TryFinally', None) and len(body) == 1 and isinstance(
+                    body[0], _TRY_NODES):
+                handlers = body[0].handlers
+                orelse = body[0].orelse
+                body = body[0].body
+
+            result = self.block(orelse, self.block(body, names))
+            for handler in handlers:
+                if handler.type is not None:
+                    self.use(handler.type, names)
+                handler_name = _handler_name(handler)
+                handler_names = names | set([handler_name]) if handler_name else names
+                handler_result = self.block(handler.body, handler_names)
+                if handler_result is not None and handler_name:
+                    # The name of the exception is deleted at the end of the handler
+                    handler_result = handler_result - set([handler_name])
+                result = _meet(result, handler_result)
+
+            finalbody = getattr(node, 'finalbody', [])
+            final_result = self.block(finalbody, names)
+            if result is None or final_result is None:
+                return None
+            return result | final_result
+
+        elif sys.version_info >= (3, 10) and node_type == ast.Match:
+            self.use(node.subject, names)
+            result = names
+            for match_case in node.cases:
+                case_names = names | _local_creations(match_case.pattern)
+                self.use(match_case.pattern, case_names)
+                if match_case.guard is not None:
+                    self.use(match_case.guard, case_names)
+                result = _meet(result, self.block(match_case.body, case_names))
+            return result
+
+        elif node_type in (ast.Return, ast.Raise):
+            self.use(node, names)
+            return None
+
+        elif node_type in (ast.Break, ast.Continue):
+            return None
+
+        else:
+            self.use(node, names)
+            new_names = names | _local_creations(node)
+            if node_type == ast.Delete:
+                new_names = new_names - _deleted_names(node)
+            return new_names
+
+
+def _handler_name(handler):
+    # Before Py3 the name of the exception is an expression
+    if handler.name is None or isinstance(handler.name, str):
+        return handler.name
+    return handler.name.id if type(handler.name) == ast.Name else None
+
+
+def _deleted_names(node):
+    return set(
+        target.id for target in node.targets
+        if type(target) == ast.Name)
+
+
+def find_unassigned_usages(statements, assigned_names, assigned_before=None):
+    ''' Return a set of the names assigned in ``statements``
+    that can be used before being assigned (on some path through ``statements``),
+    provided that ``assigned_names`` are assigned before them.
+    If ``assigned_before`` is a dictionary, it is filled with the sets of names
+    assigned on every path to each statement (keyed by the ``id()`` of the statement node).
+    '''
+    analysis = _AssignmentAnalysis(assigned_before)
+    analysis.block(statements, frozenset(assigned_names))
+
+    local_names = set()
+    for statement in statements:
+        local_names.update(_local_creations(statement))
+
+    unassigned = set()
+    for used, names in analysis.usages:
+        unassigned.update((used - names) & local_names)
+    return unassigned
@@ -4,6 +4,8 @@ import sys
 
 NUMBER_TYPES = (int, float, complex) + (tuple() if sys.version_info >= (3,) else (long,))
 
+CONSTANT_TYPES = NUMBER_TYPES + (str, bytes)
+
 
 class KnownValue(object):
 
@@ -30,6 +32,11 @@ def kvalue_to_node(kvalue, gen_sym):
 
     value = kvalue.value
 
+    if sys.version_info >= (3, 8):
+        # All the literals are represented by ``ast.Constant``
+        if value is True or value is False or value is None or type(value) in CONSTANT_TYPES:
+            return ast.Constant(value=value, kind=None), gen_sym, {}
+
     if value is True or value is False or value is None:
         if sys.version_info >= (3, 4):
             return ast.NameConstant(value=value), gen_sym, {}
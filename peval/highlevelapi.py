@@ -1,17 +1,135 @@
 import ast
+import functools
+import threading
+from types import FunctionType
 
-from peval.core.function import Function
+import funcsigs
+
+from peval.core.function import Function, is_generator, make_generator
+from peval.core.cache import SpecializationCache, specialization_key
+from peval.core.pass_manager import PassManager
+from peval.components.macro import expand_macros
+from peval.components.tail_calls import eliminate_tail_calls
 from peval.components.inline import inline_functions
+from peval.components.clone import clone_functions
+from peval.components.unroll import unroll_loops
+from peval.components.unfold import unfold_loops
+from peval.components.execute import execute_loops
+from peval.components.licm import hoist_invariants
+from peval.components.cse import eliminate_common_subexpressions
 from peval.components.prune_cfg import prune_cfg
 from peval.components.prune_assignments import prune_assignments
 from peval.components.fold import fold
-from peval.tools import ast_equal
+
+
+# Optimization presets for ``make_pass_manager()``.
+OPTIMIZATION_LEVELS = {
+    'O0': [],
+    'O1': [
+        ('fold', fold),
+        ('prune_cfg', prune_cfg),
+        ('prune_assignments', prune_assignments)],
+    'O2': [
+        ('inline_functions', inline_functions),
+        ('fold', fold),
+        ('prune_cfg', prune_cfg),
+        ('prune_assignments', prune_assignments)],
+    # The experimental passes; these are opt-in until they get more real-world testing.
+    'O3': [
+        ('expand_macros', expand_macros),
+        ('eliminate_tail_calls', eliminate_tail_calls),
+        ('inline_functions', inline_functions),
+        ('clone_functions', clone_functions),
+        ('unroll_loops', unroll_loops),
+        ('execute_loops', execute_loops),
+        ('unfold_loops', unfold_loops),
+        ('fold', fold),
+        ('hoist_invariants', hoist_invariants),
+        ('eliminate_common_subexpressions', eliminate_common_subexpressions),
+        ('prune_cfg', prune_cfg),
+        ('prune_assignments', prune_assignments)],
+    }
+
+
+def make_pass_manager(level='O2', **kwds):
+    """
+    Creates a :py:class:`~peval.core.pass_manager.PassManager` with the passes
+    from the given optimization level preset (one of the keys of ``OPTIMIZATION_LEVELS``).
+    ``'O2'`` (the default) includes constant folding, dead code elimination and inlining,
+    and ``'O3'`` adds the experimental passes to them.
+    Keyword arguments are passed to the ``PassManager`` constructor.
+    """
+    if level not in OPTIMIZATION_LEVELS:
+        raise ValueError("Unknown optimization level: " + repr(level))
+    return PassManager(passes=OPTIMIZATION_LEVELS[level], **kwds)
+
+
+# The pass manager used by ``partial_apply()``.
+# Can be reconfigured in place, or substituted for a specific call site
+# by passing it to ``specialize()`` or ``specialize_on()``.
+default_pass_manager = make_pass_manager('O2')
+
+
+# The state of the specializations in progress in the current thread:
+# ``pass_managers`` is the list of their pass managers (the innermost one last),
+# and ``building_variant`` is set to ``True`` while ``specialize_on`` builds a variant,
+# so that the decorator re-applied by ``Function.eval()`` does not wrap the variant again.
+_local = threading.local()
+
+
+def _current_pass_manager():
+    """
+    Returns the pass manager of the innermost specialization in progress,
+    or ``default_pass_manager`` if there is none
+    (used by the passes that specialize other functions, like ``clone_functions``).
+    """
+    stack = getattr(_local, 'pass_managers', None)
+    if stack:
+        return stack[-1]
+    else:
+        return default_pass_manager
+
+
+# The cache for the results of ``partial_apply()``.
+# Can be reconfigured via ``specialization_cache.configure()``
+# (``max_entries=0`` effectively disables it).
+specialization_cache = SpecializationCache()
 
 
 def partial_apply(fn, *args, **kwds):
     ''' Return specialized version of fn, fixing given args and kwargs,
     just as functools.partial does, but specialized function should be faster
     '''
+    return specialize(fn, args, kwds)
+
+
+def specialize(fn, args=(), kwds=None, pass_manager=None):
+    ''' Same as ``partial_apply(fn, *args, **kwds)``, but uses the given pass manager
+    (or ``default_pass_manager`` if it is ``None``) for optimization.
+    '''
+    if kwds is None:
+        kwds = {}
+    if pass_manager is None:
+        pass_manager = default_pass_manager
+
+    options = (pass_manager, pass_manager.version)
+    key = specialization_key(fn, args, kwds, options=options)
+    new_fn = specialization_cache.get(key)
+    if new_fn is not None:
+        return new_fn
+
+    new_fn = _partial_apply(fn, args, kwds, pass_manager)
+
+    # ``Function.from_object()`` may have changed the globals of ``fn``,
+    # so the key is rebuilt to make subsequent lookups hit.
+    if key is not None:
+        key = specialization_key(fn, args, kwds, options=options)
+    specialization_cache.put(key, new_fn)
+
+    return new_fn
+
+
+def _partial_apply(fn, args, kwds, pass_manager):
     function = Function.from_object(fn)
 
     if len(args) > 0 or len(kwds) > 0:
@@ -19,12 +137,30 @@ def partial_apply(fn, *args, **kwds):
     else:
         bound_function = function
 
-    new_tree, bindings = optimized_ast(
-        bound_function.tree,
-        bound_function.get_external_variables())
+    if not hasattr(_local, 'pass_managers'):
+        _local.pass_managers = []
+    _local.pass_managers.append(pass_manager)
+    try:
+        new_tree, bindings = optimized_ast(
+            bound_function.tree,
+            bound_function.get_external_variables(),
+            pass_manager=pass_manager)
+    finally:
+        _local.pass_managers.pop()
 
-    globals_ = dict(bound_function.globals)
-    globals_.update(bindings)
+    # If all the ``yield`` statements turned out to be unreachable,
+    # the specialized function must still return a generator when called.
+    if is_generator(bound_function.tree):
+        new_tree = make_generator(new_tree)
+
+    # Only the bindings created during the optimization are added to globals;
+    # the rest of them (builtins, closure variables) are available to the function anyway.
+    new_bindings = bindings.overrides
+    if len(new_bindings) > 0:
+        globals_ = dict(bound_function.globals)
+        globals_.update(new_bindings)
+    else:
+        globals_ = bound_function.globals
 
     new_function = bound_function.replace(tree=new_tree, globals_=globals_)
 
@@ -35,18 +171,226 @@ def partial_eval(fn):
     return partial_apply(fn)
 
 
-def optimized_ast(tree, constants):
-    while True:
-        new_tree = tree
-        new_constants = constants
+def _typed_key(values):
+    # ``1``, ``1.0`` and ``True`` are equal and have the same hash,
+    # but lead to different specializations, so the types are a part of the key.
+    key = []
+    for value in values:
+        key.append(value)
+        key.append(type(value))
+    return tuple(key)
+
+
+def specialize_on(*names, **kwds):
+    ''' A decorator that creates a specialized variant of the function
+    (using ``partial_apply()``) for every distinct combination of the values
+    of the parameters listed in ``names``, and dispatches calls to it.
+
+    :param max_variants: the maximum number of variants to create (32 by default).
+        After it is reached, calls with previously unseen static values
+        (as well as calls with unhashable static values) go to the generic function.
+    :param pass_manager: a :py:class:`~peval.core.pass_manager.PassManager` object
+        to use for specialization (``default_pass_manager`` if not given).
+
+    The dispatcher has the attribute ``variants``, which is a dictionary
+    of the variants created so far, and the method ``get_generic_calls()``,
+    returning the number of calls that were dispatched to the generic function.
+
+    .. note::
+
+        Since the variants are created by re-evaluating the function definition,
+        all the other decorators of the function will be applied to each variant as well.
+    '''
+
+    max_variants = kwds.pop('max_variants', 32)
+    pass_manager = kwds.pop('pass_manager', None)
+    if len(kwds) > 0:
+        raise TypeError("Unexpected keyword arguments: " + ", ".join(sorted(kwds)))
+    if len(names) == 0:
+        raise ValueError("At least one parameter name must be provided")
+
+    def decorator(fn):
+        if getattr(_local, 'building_variant', False):
+            return fn
+        return _make_dispatcher(fn, names, max_variants, pass_manager)
+
+    return decorator
+
+
+# The template for a dispatcher with the same signature as the target function.
+# Having explicit parameters (instead of ``*args, **kwds``) lets the interpreter
+# do the binding, leaving only the dictionary lookup and the variant call on the hot path.
+_DISPATCHER_TEMPLATE = """
+def __peval_make_dispatcher(__peval_variants, __peval_call_slow, __peval_type{defaults}):
+    def {name}({params}):
+        try:
+            __peval_variant = __peval_variants[{key}]
+        except (KeyError, TypeError):
+            return __peval_call_slow(({all_args},), {{}})
+        return __peval_variant({dynamic_args})
+    return {name}
+"""
+
+
+def _build_fast_dispatcher(signature, names, variants, call_slow):
+    params = list(signature.parameters.values())
+
+    param_strs = []
+    defaults = []
+    for param in params:
+        if param.default is funcsigs.Parameter.empty:
+            param_strs.append(param.name)
+        else:
+            default_name = '__peval_default_' + str(len(defaults))
+            param_strs.append(param.name + '=' + default_name)
+            defaults.append((default_name, param.default))
+
+    key = "(" + "".join(
+        name + ", __peval_type(" + name + "), " for name in names) + ")"
+
+    source = _DISPATCHER_TEMPLATE.format(
+        defaults="".join(", " + name for name, _ in defaults),
+        name='__peval_dispatcher',
+        params=", ".join(param_strs),
+        key=key,
+        all_args=", ".join(param.name for param in params),
+        dynamic_args=", ".join(param.name for param in params if param.name not in names))
+
+    namespace = {}
+    exec(compile(source, '<peval dispatcher>', 'exec'), namespace)
+    return namespace['__peval_make_dispatcher'](
+        variants, call_slow, type, *[value for _, value in defaults])
+
+
+def _with_own_globals(fn):
+    """
+    Returns a copy of ``fn`` with a copy of its globals.
+    ``Function.from_object()`` binds the function name to the function in its globals,
+    and for a decorated function this would replace the dispatcher
+    for all the other threads while the variant is being built.
+    """
+    new_fn = FunctionType(
+        fn.__code__, dict(fn.__globals__), fn.__name__, fn.__defaults__, fn.__closure__)
+    for attr in ('__kwdefaults__', '__annotations__'):
+        if hasattr(fn, attr):
+            setattr(new_fn, attr, getattr(fn, attr))
+    vars(new_fn).update(vars(fn))
+    return new_fn
+
+
+def _make_dispatcher(fn, names, max_variants, pass_manager):
+
+    signature = funcsigs.signature(fn)
+
+    for name in names:
+        if name not in signature.parameters:
+            raise ValueError(
+                "Function " + fn.__name__ + " does not have a parameter " + repr(name))
+        if signature.parameters[name].kind in (
+                funcsigs.Parameter.VAR_POSITIONAL, funcsigs.Parameter.VAR_KEYWORD):
+            raise ValueError("Cannot specialize on a variadic parameter " + repr(name))
+
+    variants = {}
+    counters = dict(generic_calls=0)
+
+    # Guards the creation of variants, so that concurrent calls with the same static values
+    # get the same variant, and ``max_variants`` is not exceeded.
+    # Reentrant, since the function can be called during its own specialization
+    # (e.g. when a call to it is evaluated at compile time).
+    lock = threading.RLock()
+
+    def create_variant(key, static_values):
+        # Returns ``None`` if the limit on the number of variants has been reached.
+        with lock:
+            # Another thread may have created the variant (or reached the limit)
+            # since the lookup without the lock.
+            variant = variants.get(key)
+            if variant is not None:
+                return variant
+            if len(variants) >= max_variants:
+                return None
+
+            was_building = getattr(_local, 'building_variant', False)
+            _local.building_variant = True
+            try:
+                # The variants are stored in the dispatcher, so the shared cache is not used.
+                variant = _partial_apply(
+                    _with_own_globals(fn), (), dict(zip(names, static_values)),
+                    pass_manager if pass_manager is not None else default_pass_manager)
+            finally:
+                _local.building_variant = was_building
+
+            variants[key] = variant
+            return variant
+
+    def call_slow(args, kwds):
+        bargs = signature.bind(*args, **kwds)
+        arguments = bargs.arguments
+        static_values = tuple(
+            arguments[name] if name in arguments else signature.parameters[name].default
+            for name in names)
+
+        key = _typed_key(static_values)
+        try:
+            variant = variants.get(key)
+        except TypeError:
+            # Unhashable static values
+            variant = None
+            megamorphic = True
+        else:
+            megamorphic = variant is None and len(variants) >= max_variants
+
+        if variant is None and not megamorphic:
+            variant = create_variant(key, static_values)
+            megamorphic = variant is None
+
+        if megamorphic:
+            counters['generic_calls'] += 1
+            return fn(*args, **kwds)
+
+        # Rebuilding the argument list for the variant's signature
+        # (same as the original one, but without the static parameters).
+        new_args = []
+        new_kwds = {}
+        positional = True
+        for param in signature.parameters.values():
+            if param.name in names:
+                continue
+            if param.name not in arguments:
+                positional = False
+                continue
+
+            value = arguments[param.name]
+            if param.kind == funcsigs.Parameter.VAR_POSITIONAL:
+                new_args.extend(value)
+            elif param.kind == funcsigs.Parameter.VAR_KEYWORD:
+                new_kwds.update(value)
+            elif positional and param.kind != funcsigs.Parameter.KEYWORD_ONLY:
+                new_args.append(value)
+            else:
+                new_kwds[param.name] = value
+
+        return variant(*new_args, **new_kwds)
+
+    simple_signature = all(
+        param.kind == funcsigs.Parameter.POSITIONAL_OR_KEYWORD
+        for param in signature.parameters.values())
+
+    if simple_signature:
+        dispatcher = _build_fast_dispatcher(signature, names, variants, call_slow)
+    else:
+        def dispatcher(*args, **kwds):
+            return call_slow(args, kwds)
+
+    dispatcher = functools.wraps(fn)(dispatcher)
 
-        for func in (inline_functions, fold, prune_cfg, prune_assignments):
-            new_tree, new_constants = func(new_tree, new_constants)
+    dispatcher.variants = variants
+    dispatcher.get_generic_calls = lambda: counters['generic_calls']
 
-        if ast_equal(new_tree, tree) and new_constants == constants:
-            break
+    return dispatcher
 
-        tree = new_tree
-        constants = new_constants
 
-    return new_tree, new_constants
+def optimized_ast(tree, constants, pass_manager=None):
+    if pass_manager is None:
+        pass_manager = default_pass_manager
+    return pass_manager.run(tree, constants)
@@ -89,6 +89,19 @@ def is_macro(fn):
     return getattr(fn, '_peval_macro', None)
 
 
+def clone(fn):
+    """
+    Marks the function for call-site cloning: the calls with some of the arguments known
+    are replaced by the calls to the version of the function specialized for these arguments.
+    """
+    fn._peval_clone = True
+    return fn
+
+
+def is_clone(fn):
+    return getattr(fn, '_peval_clone', None)
+
+
 def unroll(seq):
     """
     Marks the sequence for unrolling (in a loop or in a comprehension).
@@ -1,4 +1,5 @@
 from peval.tools.dispatcher import Dispatcher
-from peval.tools.immutable import immutabledict, immutableset, immutableadict
+from peval.tools.immutable import (
+    immutabledict, immutableset, immutableadict, immutablechainmap)
 from peval.tools.utils import unindent, get_fn_arg_id, replace_fields, ast_equal
 from peval.tools.walker import ast_walker, ast_inspector, ast_transformer
@@ -6,6 +6,12 @@ with the built-in ``frozenset``, which does not have any modification methods,
 even pure ones.
 """
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    # Py2
+    from collections import Mapping
+
 
 class immutabledict(dict):
     """
@@ -226,3 +232,129 @@ class immutableset(set):
 
     def __repr__(self):
         return set.__repr__(self)
+
+
+# A marker for the keys deleted from an ``immutablechainmap``.
+_DELETED = object()
+_MISSING = object()
+
+
+class immutablechainmap(Mapping):
+    """
+    An immutable mapping looking up keys in a sequence of mappings (layers),
+    similarly to ``collections.ChainMap``.
+    The layers are not copied, so creating the map is cheap regardless of their size,
+    but they must not be changed while the map is in use.
+
+    Pure methods ``set``, ``update`` and ``del_`` (with the same semantics
+    as in :py:class:`immutabledict`) only copy the topmost layer with overrides
+    (which is owned by the map and is empty on creation), sharing the rest of the layers.
+    """
+
+    def __init__(self, *layers, **kwds):
+        self._layers = layers
+        self._overrides = kwds.pop('_overrides', {})
+
+    @property
+    def overrides(self):
+        """
+        A dictionary of the values set via ``set()`` and ``update()``
+        since the creation of the map from its layers.
+        Must not be modified.
+        """
+        return dict(
+            (key, value) for key, value in self._overrides.items() if value is not _DELETED)
+
+    def _with_overrides(self, overrides):
+        return self.__class__(*self._layers, _overrides=overrides)
+
+    def __getitem__(self, key):
+        if key in self._overrides:
+            value = self._overrides[key]
+            if value is _DELETED:
+                raise KeyError(key)
+            return value
+        for layer in self._layers:
+            if key in layer:
+                return layer[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        if key in self._overrides:
+            return self._overrides[key] is not _DELETED
+        for layer in self._layers:
+            if key in layer:
+                return True
+        return False
+
+    def _flatten(self):
+        # Merging the layers with ``dict.update()`` is much faster
+        # than looking up every key in Python code.
+        # Only used when the full contents of the map are requested.
+        result = {}
+        for layer in reversed(self._layers):
+            result.update(layer)
+        for key, value in self._overrides.items():
+            if value is _DELETED:
+                result.pop(key, None)
+            else:
+                result[key] = value
+        return result
+
+    def __iter__(self):
+        return iter(self._flatten())
+
+    def __len__(self):
+        return len(self._flatten())
+
+    def keys(self):
+        return self._flatten().keys()
+
+    def values(self):
+        return self._flatten().values()
+
+    def items(self):
+        return self._flatten().items()
+
+    def copy(self):
+        return self
+
+    def set(self, key, value):
+        if self.get(key, _MISSING) is value:
+            return self
+        overrides = dict(self._overrides)
+        overrides[key] = value
+        return self._with_overrides(overrides)
+
+    def update(self, *args, **kwds):
+        if len(args) > 0:
+            new_vals = dict(args[0])
+        else:
+            new_vals = {}
+        new_vals.update(kwds)
+
+        for key, value in new_vals.items():
+            if self.get(key, _MISSING) is not value:
+                break
+        else:
+            return self
+
+        overrides = dict(self._overrides)
+        overrides.update(new_vals)
+        return self._with_overrides(overrides)
+
+    def del_(self, key):
+        if key not in self:
+            return self
+        overrides = dict(self._overrides)
+        overrides[key] = _DELETED
+        return self._with_overrides(overrides)
+
+    def __repr__(self):
+        return "immutablechainmap(" + repr(self._flatten()) + ")"
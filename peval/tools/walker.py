@@ -33,6 +33,9 @@ def ast_walker(handler):
     :returns: a tuple ``(new_node, state)``, where ``state`` is the same object which was passed
         as the corresponding parameter.
         Does not mutate ``node``.
+        If no changes were made, ``new_node`` is ``node`` itself
+        (and, similarly, every unchanged subtree of ``new_node`` is the same object
+        as in ``node``), so ``new_node is not node`` can be used to detect changes.
 
     If ``handler`` is a function, it will be called for every node during the AST traversal
     (depth-first, pre-order).
@@ -195,6 +198,10 @@ class _Walker:
                 # If we're in the block context, we can't just return an empty list.
                 # Returning a single ``pass`` instead.
                     new_lst = [ast.Pass()]
+            else:
+                # Preserving the identity of unchanged lists,
+                # so that the parent node is not recreated needlessly.
+                new_lst = lst
         else:
             new_lst = lst
 
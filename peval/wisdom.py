@@ -1,6 +1,8 @@
+import inspect
 import operator
 import types
 import sys
+from functools import reduce
 
 import funcsigs
 
@@ -47,10 +49,13 @@ KNOWN_SIGNATURES = {
     isinstance: funcsigs.signature(lambda obj, tp: None),
     getattr: funcsigs.signature(lambda obj, name, default=None: None),
     iter: funcsigs.signature(lambda obj: None),
+    len: funcsigs.signature(lambda obj: None),
 
     str.__getitem__: funcsigs.signature(lambda self, index: None),
     range: funcsigs.signature(lambda *args: None),
     repr: funcsigs.signature(lambda *obj: None),
+    str: funcsigs.signature(lambda *args: None),
+    format: funcsigs.signature(lambda value, format_spec='': None),
 
     operator.pos: funcsigs.signature(lambda a: None),
     operator.neg: funcsigs.signature(lambda a: None),
@@ -84,6 +89,51 @@ if sys.version_info < (3,):
     KNOWN_SIGNATURES.update({
         operator.div: funcsigs.signature(lambda a, b: None),
     })
+else:
+    KNOWN_SIGNATURES.update({
+        ascii: funcsigs.signature(lambda obj: None),
+    })
+
+
+# The callables that have no side effects and do not mutate their arguments.
+# The functions consuming iterables (e.g. ``sum()`` or ``sorted()``) are not included,
+# since they exhaust the iterators passed to them.
+KNOWN_PURE = frozenset([
+    abs, bool, chr, divmod, float, hash, int, isinstance, issubclass, len, ord,
+    range, repr, round, str, type,
+
+    operator.pos, operator.neg, operator.not_, operator.invert,
+    operator.add, operator.sub, operator.mul, operator.truediv, operator.floordiv,
+    operator.mod, operator.pow, operator.lshift, operator.rshift,
+    operator.or_, operator.xor, operator.and_,
+    operator.eq, operator.ne, operator.lt, operator.le, operator.gt, operator.ge,
+    operator.is_, operator.is_not,
+    ])
+
+
+def is_known_pure(func_obj):
+    """
+    Returns ``True`` if calling ``func_obj`` is known to have no side effects
+    and to leave its arguments intact, that is, if it is one of ``KNOWN_PURE``,
+    or it is marked with :py:func:`~peval.tags.pure` and all its parameters are marked
+    with :py:func:`~peval.tags.nonmutating`.
+    """
+    try:
+        if func_obj in KNOWN_PURE:
+            return True
+    except TypeError:
+        # Unhashable callable
+        pass
+
+    mutating = getattr(func_obj, '_peval_mutating', None)
+    return (
+        is_pure(func_obj) is True and mutating is not None
+        and all(value is False for value in mutating.values()))
+
+
+# The builtin types whose methods can have their signatures
+# obtained with ``inspect.signature()`` if ``funcsigs`` fails.
+SIGNATURE_FALLBACK_TYPES = (bool, int, float, complex, str, bytes, tuple, frozenset, range)
 
 
 def get_signature(func_obj):
@@ -95,9 +145,64 @@ def get_signature(func_obj):
     except:
         pass
 
+    # The ``funcsigs`` backport does not support builtin slot wrappers
+    # (e.g. ``tuple.__getitem__``), but the standard library version
+    # can get their signatures in newer Python versions.
+    # Only the methods of immutable builtin types are allowed,
+    # since the rest of builtins may have side effects (e.g. ``print``).
+    if (hasattr(inspect, 'signature')
+            and getattr(func_obj, '__objclass__', None) in SIGNATURE_FALLBACK_TYPES):
+        try:
+            return inspect.signature(func_obj)
+        except:
+            pass
+
     raise ValueError("Cannot get signature from", func_obj)
 
 
+# The types of objects that cannot be changed after they are created
+# (functions, classes and modules are included, since the evaluator
+# never changes their attributes).
+IMMUTABLE_TYPES = (
+    bool, int, float, complex, str, bytes, tuple, frozenset, range, slice, type(None),
+    type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+if sys.version_info < (3,):
+    IMMUTABLE_TYPES += (long, unicode)
+
+
+def is_immutable_value(value):
+    """
+    Returns ``True`` if ``value`` cannot be changed after it is created,
+    that is, if it has one of ``IMMUTABLE_TYPES``, or its class is marked
+    with :py:func:`~peval.tags.immutable`.
+    The elements of tuples and frozen sets are checked too
+    (a tuple of lists can be changed through its elements).
+    """
+    value_type = type(value)
+    if value_type in (tuple, frozenset):
+        return all(is_immutable_value(elem) for elem in value)
+    return value_type in IMMUTABLE_TYPES or is_immutable(value_type) is True
+
+
+# Code flags of generators and coroutines
+# (the ones that are not available in the current Python version are ignored).
+RESUMABLE_FLAGS = reduce(
+    lambda x, y: x | y,
+    [getattr(inspect, name, 0) for name in (
+        'CO_GENERATOR', 'CO_COROUTINE', 'CO_ITERABLE_COROUTINE', 'CO_ASYNC_GENERATOR')],
+    0)
+
+
+def is_resumable(func_obj):
+    """
+    Returns ``True`` if ``func_obj`` is a generator or a coroutine function.
+    Calling such a function does not execute its body,
+    but creates a new single-use generator or coroutine object.
+    """
+    code = getattr(func_obj, '__code__', None)
+    return code is not None and code.co_flags & RESUMABLE_FLAGS != 0
+
+
 def get_mutation_info(func_obj, argtypes):
 
     new_argtypes = dict(argtypes)
@@ -110,6 +215,11 @@ def get_mutation_info(func_obj, argtypes):
         if not immutable:
             mutable_args.append(name)
 
+    if is_resumable(func_obj):
+        # The created object is stateful, and cannot be shared between calls
+        # even if the body of the function has no side effects.
+        return False, mutable_args
+
     pure = is_pure(func_obj)
     if pure is None:
         # POLICY
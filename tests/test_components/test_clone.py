@@ -0,0 +1,108 @@
+from __future__ import print_function
+
+import threading
+
+from peval.tags import clone
+from peval.components.clone import clone_functions, _cloning
+from peval import specialization_cache
+from tests.utils import check_component, partial_apply_all
+
+
+@clone
+def power(x, n):
+    if n == 0:
+        return 1
+    elif n % 2 == 0:
+        v = power(x, n // 2)
+        return v * v
+    else:
+        return x * power(x, n - 1)
+
+
+@clone
+def scale(x, factor=2, offset=0):
+    return x * factor + offset
+
+
+def test_component():
+
+    specialization_cache.clear()
+
+    def f(x, y):
+        return scale(x, 3) + scale(y, factor=3, offset=x)
+
+    def component(tree, constants):
+        result = clone_functions(tree, constants)
+        # Both call sites share the same clone
+        assert result[1]['__peval_temp_1'] is result[1]['__peval_temp_2']
+        return result
+
+    check_component(
+        component, f,
+        expected_source="""
+            def f(x, y):
+                return __peval_temp_1(x=x) + __peval_temp_2(x=y, offset=x)
+            """)
+
+
+def test_not_cloned():
+
+    def f_unknown(x, y):
+        return scale(x, y)
+
+    def f_starargs(x, args):
+        return scale(x, *args)
+
+    def f_untagged(x):
+        return abs(x)
+
+    check_component(clone_functions, f_unknown)
+    check_component(clone_functions, f_starargs)
+    check_component(clone_functions, f_untagged)
+
+
+def test_recursive():
+
+    def f(x):
+        return power(x, 10)
+
+    f2 = partial_apply_all(f)
+    for x in (0, 1, 2, 3.5):
+        assert f2(x) == x ** 10
+    assert 'power' not in f2._peval_source
+
+    # The cloned version of ``power`` for ``n=10`` calls the one for ``n=5``, and so on
+    power_10 = f2.__globals__['__peval_temp_1']
+    assert 'def power(x):' in power_10._peval_source
+    assert '__peval_temp_1(x=x)' in power_10._peval_source
+
+
+def test_threads():
+
+    specialization_cache.clear()
+
+    def f(x):
+        return scale(x, 3)
+
+    # The depth of cloning in progress in another thread does not limit this one
+    cloning = _cloning()
+    cloning.extend([scale] * 4)
+    try:
+        results = []
+        def worker():
+            check_component(
+                clone_functions, f,
+                expected_source="""
+                    def f(x):
+                        return __peval_temp_1(x=x)
+                    """)
+            results.append(True)
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        assert results == [True]
+
+        check_component(clone_functions, f)
+    finally:
+        del cloning[:]
@@ -0,0 +1,125 @@
+from __future__ import print_function
+
+from peval.tags import inline
+from peval.components.cse import eliminate_common_subexpressions
+from tests.utils import check_component, partial_apply_all
+
+
+def test_component():
+
+    def f(x, a, b, c):
+        n = x.shape[0] * 2
+        y = a * b + c
+        if c:
+            z = a * b - x.shape[0]
+        else:
+            a = 1
+        w = a * b + x.shape[0]
+        print(w)
+        return x.shape[0] + a * b
+
+    # ``a * b`` is recomputed after ``a`` is assigned in one of the branches,
+    # and ``x.shape[0]`` after a call that can mutate ``x``.
+    check_component(
+        eliminate_common_subexpressions, f,
+        expected_source="""
+            def f(x, a, b, c):
+                __peval_common_1 = x.shape[0]
+                n = __peval_common_1 * 2
+                __peval_common_2 = a * b
+                y = __peval_common_2 + c
+                if c:
+                    z = __peval_common_2 - __peval_common_1
+                else:
+                    a = 1
+                __peval_common_3 = a * b
+                w = __peval_common_3 + __peval_common_1
+                print(w)
+                return x.shape[0] + __peval_common_3
+            """)
+
+
+def test_same_statement():
+
+    def f(x):
+        t = (x + 1) * (x + 1) + len(x + 1)
+        return t
+
+    check_component(
+        eliminate_common_subexpressions, f,
+        expected_source="""
+            def f(x):
+                __peval_common_1 = x + 1
+                t = __peval_common_1 * __peval_common_1 + len(__peval_common_1)
+                return t
+            """)
+
+
+def test_not_eliminated():
+
+    def f_not_on_every_path(a, b, c):
+        if c:
+            y = a * b
+        return a * b
+
+    def f_mutation(x, i):
+        n = x[0] + 1
+        x[i] = 2
+        return x[0] + 1
+
+    def f_in_loop(a, b, n):
+        while n > a * b:
+            n = n - a * b
+        return n
+
+    def f_comprehension(x, n):
+        y = x + 1
+        return [x + 1 for x in range(n)]
+
+    def f_try(a, b):
+        try:
+            y = a / b
+        except ZeroDivisionError:
+            return 0
+        return a / b
+
+    def f_side_effect_before(log, a, b):
+        x = [log.append(1), a + b, a + b]
+        return x
+
+    def f_raises_before(t, i, a, b):
+        x = t[i] + (a + b) * (a + b)
+        return x
+
+    def f_raises_before_reuse(t, i, a, b):
+        x = t[i] + (a + b)
+        return a + b
+
+    check_component(eliminate_common_subexpressions, f_side_effect_before)
+    check_component(eliminate_common_subexpressions, f_raises_before)
+    check_component(eliminate_common_subexpressions, f_raises_before_reuse)
+    check_component(eliminate_common_subexpressions, f_not_on_every_path)
+    check_component(eliminate_common_subexpressions, f_mutation)
+    check_component(eliminate_common_subexpressions, f_in_loop)
+    check_component(eliminate_common_subexpressions, f_comprehension)
+    check_component(eliminate_common_subexpressions, f_try)
+
+
+@inline
+def norm2(x, y):
+    return x * x + y * y
+
+
+def kernel(p, k):
+    a = norm2(p.real, p.imag) * k
+    b = norm2(p.real, p.imag) + k
+    return a, b
+
+
+def test_inlined_kernel():
+
+    # The repeated inlined bodies are evaluated only once
+    f = partial_apply_all(kernel, k=2)
+    assert f(3 + 4j) == kernel(3 + 4j, 2)
+    assert f._peval_source.count('p.real') == 1
+    assert f._peval_source.count('p.imag') == 1
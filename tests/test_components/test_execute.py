@@ -0,0 +1,170 @@
+from __future__ import print_function
+
+import functools
+
+from peval.components.execute import execute_loops
+from tests.utils import check_component, partial_apply_all
+
+
+def test_counter():
+
+    def f(x):
+        i = 0
+        total = 0
+        while i < 5:
+            total += i
+            i += 1
+        return x + total
+
+    check_component(
+        execute_loops, f,
+        expected_source="""
+            def f(x):
+                i = 0
+                total = 0
+                i = 5
+                total = 10
+                return x + total
+            """)
+
+
+def test_nested_loops_and_jumps():
+
+    def f():
+        n = 10
+        primes = ()
+        while n < 20:
+            for d in range(2, n):
+                if n % d == 0:
+                    break
+            else:
+                primes = primes + (n,)
+            n += 1
+        return primes
+
+    check_component(
+        execute_loops, f,
+        expected_source="""
+            def f():
+                n = 10
+                primes = ()
+                d = 18
+                n = 20
+                primes = __peval_temp_1
+                return primes
+            """,
+        expected_new_bindings=dict(__peval_temp_1=(11, 13, 17, 19)))
+
+
+def test_table():
+
+    def f(x):
+        table = []
+        i = 0
+        while i < 4:
+            table.append(i * i)
+            i += 1
+        return table[x]
+
+    check_component(
+        execute_loops, f,
+        expected_source="""
+            def f(x):
+                table = []
+                i = 0
+                i = 4
+                table = __peval_temp_1.copy()
+                return table[x]
+            """,
+        expected_new_bindings=dict(__peval_temp_1=[0, 1, 4, 9]))
+
+    # Every call gets a new table
+    f_specialized = partial_apply_all(f)
+    assert f_specialized(3) == 9
+    assert 'while' not in f_specialized._peval_source
+
+
+def test_not_executed():
+
+    def f_unknown(x):
+        i = 0
+        while i < x:
+            i += 1
+        return i
+
+    def f_side_effects():
+        i = 0
+        while i < 2:
+            print(i)
+            i += 1
+
+    def f_infinite():
+        i = 0
+        while True:
+            i += 1
+
+    def f_long():
+        i = 0
+        while i < 1000:
+            i += 1
+        return i
+
+    def f_foreign_container():
+        table = lst
+        i = 0
+        while i < 2:
+            table.append(i)
+            i += 1
+
+    def f_alias():
+        table = []
+        alias = (table,)
+        i = 0
+        while i < 2:
+            table.append(i)
+            i += 1
+        return alias
+
+    def f_return():
+        i = 0
+        while i < 2:
+            return i
+
+    # ``table`` is not known after the call
+    def f_changed_in_prefix(x):
+        table = [1]
+        table.append(x)
+        i = 0
+        while i < 2:
+            table.append(i)
+            i += 1
+        return table
+
+    # ``lst`` is changed by every call
+    def f_changed_global(x):
+        n = 0
+        i = 0
+        while i < 2:
+            n += len(lst)
+            i += 1
+        lst.append(x)
+        return n
+
+    check_component(execute_loops, f_unknown)
+    check_component(execute_loops, f_side_effects)
+    check_component(execute_loops, f_infinite)
+    # The time limit is opt-in
+    check_component(functools.partial(execute_loops, max_time=0), f_long)
+    check_component(
+        execute_loops, f_long,
+        expected_source="""
+            def f_long():
+                i = 0
+                i = 1000
+                return i
+            """)
+    check_component(execute_loops, f_foreign_container, additional_bindings=dict(lst=[]))
+    check_component(execute_loops, f_alias)
+    check_component(execute_loops, f_return)
+    check_component(execute_loops, f_changed_in_prefix)
+    check_component(execute_loops, f_changed_global, additional_bindings=dict(lst=[1]))
@@ -1,10 +1,13 @@
+import ast
 import sys
 
 import pytest
 
-from peval.components.fold import fold
+from peval.core.function import Function
+from peval.tools import immutablechainmap, unindent
+from peval.components.fold import fold, Environment, Value, UNDEFINED, meet_envs
 
-from tests.utils import check_component
+from tests.utils import check_component, assert_ast_equal
 
 
 def dummy(x):
@@ -34,6 +37,203 @@ def test_fold():
             """.format(false_const='__peval_False_1' if sys.version_info < (3, 4) else 'False'))
 
 
+def test_unchanged_identity():
+    # If there is nothing to fold, the same objects are returned
+    function = Function.from_object(dummy)
+    bindings = function.get_external_variables()
+    new_tree, new_bindings = fold(function.tree, bindings)
+    tree, bindings = new_tree, new_bindings
+
+    new_tree, new_bindings = fold(tree, bindings)
+    assert new_tree is tree
+    assert new_bindings is bindings
+
+
+def test_environment():
+    base = immutablechainmap(dict(a=1, b=2))
+    env = Environment(base)
+
+    # Only the changed variables are stored in the environment
+    new_env = env.update(dict(b=Value(value=3), c=UNDEFINED))
+    assert new_env.values == dict(b=Value(value=3), c=UNDEFINED)
+    assert new_env.known_values() == dict(a=1, b=3)
+
+    env2 = env.update(dict(b=UNDEFINED))
+    assert env2.known_values() == dict(a=1)
+
+    # Unchanged environments are shared
+    assert new_env.update(dict(c=UNDEFINED)) is new_env
+    assert meet_envs(new_env, new_env) is new_env
+
+    met_env = meet_envs(new_env, env.update(dict(b=Value(value=3))))
+    assert met_env == new_env
+
+    # A variable missing from one of the environments has the value from the base
+    met_env = meet_envs(env, env.update(dict(a=Value(value=2), d=Value(value=4))))
+    assert met_env.known_values() == dict(b=2, d=4)
+
+
+def check_fold_source(source, bindings, expected_source):
+    # For the syntax that is not available in all the supported Python versions
+    tree = ast.parse(unindent(source)).body[0]
+    new_tree, _ = fold(tree, immutablechainmap(bindings))
+    assert_ast_equal(new_tree, ast.parse(unindent(expected_source)).body[0])
+
+
+def test_unpacking_assignment():
+
+    if sys.version_info < (3, 4):
+        pytest.skip()
+
+    check_fold_source(
+        """
+        def f(x):
+            a, (b, *c) = y = 1, (2, 3, 4)
+            d, e = x
+            return a + b + c + d + y
+        """,
+        dict(),
+        expected_source="""
+        def f(x):
+            a, (b, *c) = y = __peval_temp_1
+            d, e = x
+            return 3 + c + d + y
+        """)
+
+
+def test_augmented_assignment():
+
+    if sys.version_info < (3, 6):
+        pytest.skip()
+
+    check_fold_source(
+        """
+        def f(x):
+            n: int = 1
+            n += 2
+            s = 'a'
+            s *= n
+            x += n
+            l = x
+            l += [n]
+            return n + x, s, l
+        """,
+        dict(),
+        expected_source="""
+        def f(x):
+            n: int = 1
+            n += 2
+            s = 'a'
+            s *= 3
+            x += 3
+            l = x
+            l += [3]
+            return 3 + x, 'aaa', l
+        """)
+
+
+def test_loop_and_with_targets():
+
+    if sys.version_info < (3, 4):
+        pytest.skip()
+
+    # The values of loop and context manager targets are unknown,
+    # but the loop header is folded.
+    check_fold_source(
+        """
+        def f(x):
+            i = 0
+            for i in range(n):
+                pass
+            while i < n:
+                i = i + 1
+            with x as (i, j):
+                pass
+            return i
+        """,
+        dict(n=2, range=range),
+        expected_source="""
+        def f(x):
+            i = 0
+            for i in __peval_temp_5:
+                pass
+            while i < 2:
+                i = i + 1
+            with x as (i, j):
+                pass
+            return i
+        """)
+
+
+def test_bound_names():
+
+    if sys.version_info < (3, 4):
+        pytest.skip()
+
+    # Statements binding names make their values unknown
+    check_fold_source(
+        """
+        def f(x):
+            a = b = c = d = e = 1
+            try:
+                import os as a
+                from sys import path as b
+                def c():
+                    pass
+                del d
+            except Exception as e:
+                pass
+            return a, b, c, d, e
+        """,
+        dict(),
+        expected_source="""
+        def f(x):
+            a = b = c = d = e = 1
+            try:
+                import os as a
+                from sys import path as b
+                def c():
+                    pass
+                del d
+            except Exception as e:
+                pass
+            return a, b, c, d, e
+        """)
+
+
+def test_match():
+
+    if sys.version_info < (3, 10):
+        pytest.skip()
+
+    check_fold_source(
+        """
+        def f(x):
+            a = b = c = 1
+            match a + x:
+                case [a, *b] if (c := a):
+                    pass
+                case {'k': 1, **b}:
+                    pass
+                case _:
+                    pass
+            return a + b + c + 1
+        """,
+        dict(),
+        expected_source="""
+        def f(x):
+            a = b = c = 1
+            match 1 + x:
+                case [a, *b] if (c := a):
+                    pass
+                case {'k': 1, **b}:
+                    pass
+                case _:
+                    pass
+            return a + b + c + 1
+        """)
+
+
 def test_if_visit_only_true_branch():
 
     # This optimization can potentially save some time during constant propagation
@@ -79,6 +279,81 @@ def test_if_visit_only_true_branch():
     assert global_state['cnt'] == 1
 
 
+def test_shadowed_globals():
+
+    # The parameters and the local variables hide the globals with the same names
+    check_fold_source(
+        """
+        def f(x, y):
+            y = 1
+            if x:
+                z = y
+            return x + y + z
+        """,
+        dict(x=5, y=2, z=3),
+        expected_source="""
+        def f(x, y):
+            y = 1
+            if x:
+                z = 1
+            return x + 1 + z
+        """)
+
+
+def test_mutating_calls():
+
+    # The lists created in the function are not known,
+    # and the known ones are not known anywhere if they can be changed by the function
+    # (only the ones that are immutable or never changed are used).
+    check_fold_source(
+        """
+        def f(x):
+            s = [1]
+            s.append(x)
+            n = len(lst)
+            other(lst, t)
+            m = len(d)
+            d.clear()
+            return len(s) + n + len(lst) + len(t) + m + len(d) + len(u)
+        """,
+        dict(lst=[1], t=(1, 2), d={1: 2}, u=[1, 2, 3], len=len),
+        expected_source="""
+        def f(x):
+            s = [1]
+            s.append(x)
+            n = len(lst)
+            other(lst, t)
+            m = len(d)
+            d.clear()
+            return len(s) + n + len(lst) + 2 + m + len(d) + 3
+        """)
+
+
+def test_mutation_via_alias():
+
+    # ``lst`` can be changed through ``t`` or ``y``
+    check_fold_source(
+        """
+        def f(x):
+            t = (lst,)
+            t[0].append(x)
+            y = lst2
+            for z in y:
+                z.append(x)
+            return len(lst) + len(lst2[0])
+        """,
+        dict(lst=[1], lst2=([1],), len=len),
+        expected_source="""
+        def f(x):
+            t = (lst,)
+            t[0].append(x)
+            y = lst2
+            for z in y:
+                z.append(x)
+            return len(lst) + len(lst2[0])
+        """)
+
+
 # Test that nodes whose values are known first but are mutated later
 # are not substituted with values calculated at compile time.
 
@@ -1,16 +1,22 @@
 from __future__ import print_function, division
 
 import ast
+import functools
 import sys
+import types
 
 import pytest
 
 from peval.core.gensym import GenSym
-from peval.tags import inline
+from peval.core.function import Function
+from peval.core.pass_manager import count_nodes
+from peval.tools import immutableadict, replace_fields
+from peval.tags import inline, impure
+from peval import partial_apply
 from peval.components.inline import (
     inline_functions, _replace_returns, _wrap_in_loop, _build_parameter_assignments)
 
-from tests.utils import check_component, unindent, assert_ast_equal
+from tests.utils import check_component, unindent, assert_ast_equal, load_module
 
 
 def _test_replace_returns(source, expected_source, expected_returns_ctr, expected_returns_in_loops):
@@ -149,16 +155,30 @@ class TestReplaceReturns:
             expected_returns_in_loops=False)
 
 
-def _test_build_parameter_assignments(call_str, signature_str, expected_assignments):
+def _test_build_parameter_assignments(
+        call_str, signature_str, expected_assignments, bindings={}, expected_bindings={}):
 
     call_node = ast.parse("func(" + call_str + ")").body[0].value
-    signature_node = ast.parse("def func(" + signature_str + "):\n\tpass").body[0]
+    signature_src = "def func(" + signature_str + "):\n\tpass"
+    signature_node = ast.parse(signature_src).body[0]
+    globals_ = {}
+    exec(signature_src, globals_)
+    fn = globals_['func']
 
-    assignments = _build_parameter_assignments(call_node, signature_node)
+    gen_sym = GenSym.for_tree(call_node)
+    result = _build_parameter_assignments(
+        gen_sym, call_node, signature_node, fn, immutableadict(bindings))
+
+    if expected_assignments is None:
+        assert result is None
+        return
+
+    assignments, gen_sym, new_bindings = result
 
     expected_assignments = ast.parse(unindent(expected_assignments)).body
 
     assert_ast_equal(assignments, expected_assignments)
+    assert new_bindings == expected_bindings
 
 
 class TestBuildParameterAssignments:
@@ -174,6 +194,66 @@ class TestBuildParameterAssignments:
             f = 3
             """)
 
+    def test_keyword_args(self):
+        _test_build_parameter_assignments(
+            "a, f=b, e=1",
+            "c, d=2, e=3, f=4",
+            """
+            c = a
+            f = b
+            e = 1
+            d = 2
+            """)
+
+    def test_keyword_only_args(self):
+        _test_build_parameter_assignments(
+            "a, e=b",
+            "c, *, d=[1, 2], e",
+            """
+            c = a
+            e = b
+            d = __peval_temp_1
+            """,
+            expected_bindings=dict(__peval_temp_1=[1, 2]))
+
+    def test_varargs(self):
+        _test_build_parameter_assignments(
+            "a, b, 1, x + 1, y=c, z=2",
+            "c, *args, **kwds",
+            """
+            c = a
+            __peval_arg_1 = b
+            __peval_arg_2 = x + 1
+            __peval_arg_3 = c
+            args = (__peval_arg_1, 1, __peval_arg_2)
+            kwds = {'y': __peval_arg_3, 'z': 2}
+            """)
+
+    def test_known_star_args(self):
+        _test_build_parameter_assignments(
+            "*xs, d=1, **ys",
+            "a, b, c=3, d=4, e=5",
+            """
+            a = 1
+            b = 2
+            d = 1
+            e = 6
+            c = 3
+            """,
+            bindings=dict(xs=(1, 2), ys=dict(e=6)))
+
+    def test_cannot_bind(self):
+        # Unknown ``*args``
+        _test_build_parameter_assignments("*xs", "a, b", None)
+        # Missing argument
+        _test_build_parameter_assignments("a", "a, b", None)
+        # Too many arguments
+        _test_build_parameter_assignments("a, b, c", "a, b", None)
+        # Duplicate argument
+        _test_build_parameter_assignments("a, a=b", "a", None)
+        # Unknown keyword
+        _test_build_parameter_assignments("a, c=b", "a", None)
+
 
 def _test_wrap_in_loop(body_src, expected_src, format_kwds={}, expected_bindings={}):
     gen_sym = GenSym.for_tree()
@@ -315,3 +395,222 @@ def test_component():
                 return a
         ''')
 
+
+
+def test_component_keywords_and_varargs():
+
+    @inline
+    def inlined(y, *args, **kwds):
+        return y + len(args) + len(kwds)
+
+    def outer(x):
+        return inlined(x, 1, x, z=2)
+
+    check_component(
+        inline_functions, outer,
+        expected_source='''
+            def outer(x):
+                __peval_mangled_1 = x
+                __peval_arg_1 = x
+                __peval_mangled_2 = (1, __peval_arg_1)
+                __peval_mangled_3 = {'z': 2}
+                __peval_return_1 = __peval_mangled_1 + len(__peval_mangled_2) + len(__peval_mangled_3)
+                return __peval_return_1
+        ''')
+
+
+@inline
+def _scale(x, factor=2):
+    return x * factor
+
+
+class _Stepper(object):
+
+    def __init__(self, step):
+        self.step = step
+
+    @inline
+    def advance(self, x):
+        return x + self.step
+
+
+def test_component_resolved_callees():
+
+    helpers = types.ModuleType('helpers')
+    helpers.scale = _scale
+    stepper = _Stepper(3)
+    triple = functools.partial(_scale, factor=3)
+
+    def outer(x):
+        a = helpers.scale(x)
+        b = stepper.advance(a)
+        return triple(b)
+
+    check_component(
+        inline_functions, outer,
+        dict(helpers=helpers, stepper=stepper, triple=triple),
+        expected_source='''
+            def outer(x):
+                __peval_mangled_1 = x
+                __peval_mangled_2 = 2
+                __peval_return_1 = __peval_mangled_1 * __peval_mangled_2
+                a = __peval_return_1
+                __peval_mangled_3 = __peval_temp_1
+                __peval_mangled_4 = a
+                __peval_return_2 = __peval_mangled_4 + __peval_mangled_3.step
+                b = __peval_return_2
+                __peval_mangled_5 = b
+                __peval_mangled_6 = 3
+                __peval_return_3 = __peval_mangled_5 * __peval_mangled_6
+                return __peval_return_3
+        ''',
+        expected_new_bindings=dict(__peval_temp_1=stepper))
+
+
+def test_component_other_module_globals(tmpdir):
+
+    namespace = load_module(tmpdir, 'peval_inline_test_module', """
+        from peval.tags import inline
+
+        OFFSET = 10
+
+        def clip(x):
+            return x if x > 0 else 0
+
+        @inline
+        def shift(x):
+            return clip(max(x, -1)) + OFFSET
+        """)
+    shift = namespace['shift']
+
+    # ``OFFSET`` and ``clip`` are not available in the function ``shift`` is inlined in,
+    # and ``max`` is shadowed by a local variable.
+    def outer(x):
+        max = 1
+        return shift(x) + max
+
+    check_component(
+        inline_functions, outer, dict(shift=shift),
+        expected_source='''
+            def outer(x):
+                max = 1
+                __peval_mangled_1 = x
+                __peval_return_1 = __peval_temp_1(__peval_temp_2(__peval_mangled_1, -1)) + 10
+                return __peval_return_1 + max
+        ''',
+        expected_new_bindings=dict(__peval_temp_1=namespace['clip'], __peval_temp_2=max))
+
+
+@inline
+def _factorial(n):
+    if n <= 1:
+        return 1
+    return n * _factorial(n - 1)
+
+
+def test_recursion_depth():
+
+    def outer(x):
+        return _factorial(x)
+
+    # The recursive call is marked with its depth
+    check_component(
+        functools.partial(inline_functions, max_depth=2), outer,
+        expected_source='''
+            def outer(x):
+                __peval_mangled_1 = x
+                while True:
+                    if __peval_mangled_1 <= 1:
+                        __peval_return_1 = 1
+                        break
+                    __peval_return_1 = __peval_mangled_1 * __peval_recursion_1_1(__peval_mangled_1 - 1)
+                    break
+                return __peval_return_1
+        ''',
+        expected_new_bindings=dict(__peval_recursion_1_1=_factorial))
+
+    def outer_at_max_depth(x):
+        return __peval_recursion_2_1(x)
+
+    check_component(
+        functools.partial(inline_functions, max_depth=2), outer_at_max_depth,
+        dict(__peval_recursion_2_1=_factorial))
+
+    # Without the limit the specialization would never finish
+    outer_specialized = partial_apply(outer)
+    assert outer_specialized(5) == 120
+    assert '__peval_recursion_8_1(' in outer_specialized._peval_source
+    # The loops created for several returns are removed by ``prune_cfg``
+    assert 'while' not in outer_specialized._peval_source
+
+
+def test_conditional_calls():
+
+    def outer(x):
+        a = _scale(x) if x else 0
+        while _scale(x) < 10:
+            x = x + 1
+        return a or _scale(x)
+
+    check_component(inline_functions, outer)
+
+
+def test_code_growth_budget():
+
+    def outer(x):
+        return _scale(x)
+
+    check_component(functools.partial(inline_functions, max_size=10), outer)
+
+    # The budget limits the growth of the tree, not its size
+    function = Function.from_object(outer)
+    padding = ast.parse("x = x + 1\n" * 50).body
+    tree = replace_fields(function.tree, body=padding + function.tree.body)
+    assert count_nodes(tree) > 100
+
+    new_tree, _ = inline_functions(
+        tree, function.get_external_variables(), max_size=100)
+    assert not any(
+        type(node) == ast.Call and type(node.func) == ast.Name and node.func.id == '_scale'
+        for node in ast.walk(new_tree))
+
+
+def _small(x, y):
+    if y:
+        return x
+    return -x
+
+
+@impure
+def _small_impure(x):
+    return x
+
+
+def _large(x):
+    y = x * x + x * x + x * x
+    z = y * y + y * y + y * y
+    return y + z
+
+
+def test_auto_inline():
+
+    def outer(x):
+        return _small(x, True) + _small_impure(x) + _large(x)
+
+    check_component(
+        functools.partial(inline_functions, auto_inline_size=20), outer,
+        expected_source='''
+            def outer(x):
+                __peval_mangled_1 = x
+                __peval_mangled_2 = True
+                while True:
+                    if __peval_mangled_2:
+                        __peval_return_1 = __peval_mangled_1
+                        break
+                    __peval_return_1 = -__peval_mangled_1
+                    break
+                return __peval_return_1 + _small_impure(x) + _large(x)
+        ''')
+
+    # Disabled by default
+    check_component(inline_functions, outer)
@@ -0,0 +1,210 @@
+from __future__ import print_function
+
+from peval.tags import pure, nonmutating
+from peval.components.licm import hoist_invariants
+from tests.utils import check_component, partial_apply_all
+
+
+@pure
+def scale(x):
+    return x * 10
+nonmutating(scale, 'x')
+
+
+@pure
+def append_one(lst):
+    lst.append(1)
+    return lst
+
+
+def test_while_loop():
+
+    def f(table, x):
+        i = 0
+        total = 0
+        while i < len(table) - 1:
+            total += table[i] * scale(x + 1)
+            i += 1
+        return total
+
+    # ``table[i]`` can raise an exception before ``scale(x + 1)`` is evaluated,
+    # so only the expression from the condition is hoisted.
+    check_component(
+        hoist_invariants, f,
+        expected_source="""
+            def f(table, x):
+                i = 0
+                total = 0
+                __peval_invariant_1 = len(table) - 1
+                while i < __peval_invariant_1:
+                    total += table[i] * scale(x + 1)
+                    i += 1
+                return total
+            """)
+
+    def f_guarded(table, x):
+        i = 0
+        total = 0
+        while i < len(table) - 1:
+            total += scale(x + 1) * table[i]
+            i += 1
+        return total
+
+    # The expressions from the body are only evaluated if the loop is entered
+    check_component(
+        hoist_invariants, f_guarded,
+        expected_source="""
+            def f_guarded(table, x):
+                i = 0
+                total = 0
+                __peval_invariant_1 = len(table) - 1
+                if i < __peval_invariant_1:
+                    __peval_invariant_2 = scale(x + 1)
+                while i < __peval_invariant_1:
+                    total += __peval_invariant_2 * table[i]
+                    i += 1
+                return total
+            """)
+
+
+def test_range_loop():
+
+    def f(table, n):
+        s = 0
+        for i in range(n):
+            if i > len(table):
+                break
+            s = s + table[len(table) - 1] * i
+        else:
+            s = -1
+        return s
+
+    # ``table[...]`` is not evaluated if the loop is left on the first iteration,
+    # but the occurrences of the hoisted ``len(table)`` are replaced everywhere in the loop.
+    check_component(
+        hoist_invariants, f,
+        expected_source="""
+            def f(table, n):
+                s = 0
+                __peval_range_1 = range(n)
+                if __peval_range_1:
+                    __peval_invariant_1 = len(table)
+                for i in __peval_range_1:
+                    if i > __peval_invariant_1:
+                        break
+                    s = s + table[__peval_invariant_1 - 1] * i
+                else:
+                    s = -1
+                return s
+            """)
+
+
+def test_nested_loops():
+
+    def f(table, n):
+        s = 0
+        while n > 0:
+            j = 0
+            while j < n * 2:
+                s = s + len(table) + n
+                j += 1
+            n -= 1
+        return s
+
+    check_component(
+        hoist_invariants, f,
+        expected_source="""
+            def f(table, n):
+                s = 0
+                while n > 0:
+                    j = 0
+                    __peval_invariant_1 = n * 2
+                    if j < __peval_invariant_1:
+                        __peval_invariant_2 = len(table)
+                    while j < __peval_invariant_1:
+                        s = s + __peval_invariant_2 + n
+                        j += 1
+                    n -= 1
+                return s
+            """)
+
+
+def test_not_hoisted():
+
+    def f_impure_call(table, i):
+        while i < len(table):
+            print(i)
+            i += 1
+
+    def f_mutating_call(table, i):
+        while i < len(table):
+            append_one(table)
+            i += 1
+
+    def f_item_assignment(table, i):
+        while i < len(table) - 1:
+            table[i] = 0
+            i += 1
+
+    def f_conditional(table, i):
+        while i > 0:
+            i -= 1
+            if i > 1 and len(table) > 1:
+                break
+
+    def f_unknown_iterable(table, items):
+        s = 0
+        for x in items:
+            s = s + len(table) * x
+        return s
+
+    def f_try(table, i):
+        while i > 0:
+            try:
+                i -= table[0]
+            except IndexError:
+                break
+
+    def f_raises_before(table, d, i):
+        while i > 0:
+            x = table[i]
+            y = d['k']
+            i -= 1
+
+    def f_unassigned(table, n):
+        if n > 0:
+            i = 0
+        while i < len(table):
+            i += 1
+
+    def f_enclosing_try(table, i):
+        try:
+            while i < len(table):
+                i += 1
+        except TypeError:
+            return i
+
+    check_component(hoist_invariants, f_raises_before)
+    check_component(hoist_invariants, f_unassigned)
+    check_component(hoist_invariants, f_enclosing_try)
+    check_component(hoist_invariants, f_impure_call)
+    check_component(hoist_invariants, f_mutating_call)
+    check_component(hoist_invariants, f_item_assignment)
+    check_component(hoist_invariants, f_conditional)
+    check_component(hoist_invariants, f_unknown_iterable)
+    check_component(hoist_invariants, f_try)
+
+
+def last_items_sum(table, n, step):
+    total = 0
+    for i in range(n):
+        total += table[len(table) - 1 - i * step] * (step + 1)
+    return total
+
+
+def test_partial_apply():
+
+    f = partial_apply_all(last_items_sum, step=2)
+    for table, n in (([1, 2, 3, 4, 5], 3), ([], 0), ([1], 1)):
+        assert f(table, n) == last_items_sum(table, n, 2)
+    assert '__peval_invariant' in f._peval_source
@@ -0,0 +1,157 @@
+from __future__ import print_function
+
+from peval.tags import macro
+from peval.components.macro import expand_macros
+from tests.utils import check_component, partial_apply_all
+
+
+@macro
+def mad(x, y, z):
+    x * y + z
+
+
+@macro
+def first(seq):
+    """Returns the first element."""
+    return seq[0]
+
+
+@macro
+def log_twice(message):
+    print(message)
+    print(message)
+
+
+@macro
+def print_with_local(a, b, result):
+    tmp = a
+    print(tmp, b, result)
+
+
+SCALE = 10
+
+
+@macro
+def scaled(x):
+    return x * SCALE
+
+
+@macro
+def scaled_sum(x, y):
+    return scaled(x) + scaled(y)
+
+
+@macro
+def with_default(x, offset=1):
+    return x + offset
+
+
+@macro
+def assigns_parameter(x):
+    x = x + 1
+
+
+@macro
+def recursive(x):
+    return recursive(x)
+
+
+def test_expression_context():
+
+    def f(b, c, d):
+        a = mad(b[1], c + 10, d.value)
+        return first(a)
+
+    check_component(
+        expand_macros, f,
+        expected_source="""
+            def f(b, c, d):
+                a = b[1] * (c + 10) + d.value
+                return a[0]
+            """)
+
+
+def test_statement_context():
+
+    def f(x):
+        log_twice(x + 1)
+        print_with_local(x, 2, 3)
+
+    check_component(
+        expand_macros, f,
+        expected_source="""
+            def f(x):
+                print(x + 1)
+                print(x + 1)
+                __peval_mangled_5 = x
+                print(__peval_mangled_5, 2, 3)
+            """)
+
+
+def test_globals_and_nested_macros():
+
+    def f(x, y):
+        return scaled_sum(x, y)
+
+    check_component(
+        expand_macros, f,
+        expected_source="""
+            def f(x, y):
+                return x * SCALE + y * SCALE
+            """)
+
+    # A local variable shadowing the global used by the macro
+    def g(x):
+        SCALE = 2
+        return scaled(x) + SCALE
+
+    check_component(
+        expand_macros, g,
+        expected_source="""
+            def g(x):
+                SCALE = 2
+                return x * 10 + SCALE
+            """)
+
+
+def test_keywords_and_defaults():
+
+    def f(x):
+        return with_default(x) + with_default(offset=2, x=x)
+
+    check_component(
+        expand_macros, f,
+        expected_source="""
+            def f(x):
+                return (x + 1) + (x + 2)
+            """)
+
+
+def test_not_expanded():
+
+    def f_multiple_statements(x):
+        return log_twice(x)
+
+    def f_assigned_parameter(x):
+        assigns_parameter(x)
+
+    def f_recursive(x):
+        return recursive(x)
+
+    def f_starargs(x):
+        return mad(*x)
+
+    check_component(expand_macros, f_multiple_statements)
+    check_component(expand_macros, f_assigned_parameter)
+    check_component(expand_macros, f_recursive)
+    check_component(expand_macros, f_starargs)
+
+
+def test_partial_apply():
+
+    def f(x, n):
+        return scaled_sum(x, n)
+
+    f2 = partial_apply_all(f, n=2)
+    assert f2(1) == 30
+    assert 'scaled' not in f2._peval_source
@@ -205,3 +205,105 @@ def test_simplify_while_with_break():
                 else:
                     x = 10
             """)
+
+
+def test_flatten_single_iteration_loop():
+
+    # The structure created by the inliner for a function with several returns
+    def f(x):
+        while True:
+            if x > 1:
+                y = x
+                break
+            elif x < -1:
+                raise ValueError()
+            if x == 0:
+                y = 1
+            else:
+                y = 2
+            break
+        return y
+
+    check_component(
+        prune_cfg, f, {},
+        expected_source="""
+            def f(x):
+                if x > 1:
+                    y = x
+                else:
+                    if x < -1:
+                        raise ValueError()
+                    if x == 0:
+                        y = 1
+                    else:
+                        y = 2
+                return y
+            """)
+
+
+def test_flatten_return_flag():
+
+    # A return from a nested loop
+    def f(xs):
+        flag = False
+        while True:
+            for x in xs:
+                if x:
+                    y = x
+                    flag = True
+                    break
+            if flag:
+                break
+            y = None
+            break
+        return y
+
+    check_component(
+        prune_cfg, f, {},
+        expected_source="""
+            def f(xs):
+                flag = False
+                for x in xs:
+                    if x:
+                        y = x
+                        flag = True
+                        break
+                if not flag:
+                    y = None
+                return y
+            """)
+
+
+def test_not_flatten_loop():
+
+    def f_continue(x):
+        while x:
+            if x > 1:
+                x = x - 1
+                continue
+            break
+
+    def f_duplication(x):
+        while x:
+            if x > 1:
+                if x > 2:
+                    break
+                x = 1
+            else:
+                if x < 0:
+                    break
+                x = 2
+            x = x * 2
+            break
+
+    def f_break_in_try(x):
+        while x:
+            try:
+                break
+            finally:
+                x = 1
+            break
+
+    check_component(prune_cfg, f_continue, {})
+    check_component(prune_cfg, f_duplication, {})
+    check_component(prune_cfg, f_break_in_try, {})
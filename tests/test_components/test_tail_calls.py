@@ -0,0 +1,180 @@
+from __future__ import print_function
+
+import ast
+
+import pytest
+
+from peval.core.function import Function
+from peval.core.pass_manager import PassManager
+from peval.components.tail_calls import eliminate_tail_calls
+from peval import specialize
+from tests.utils import check_component, assert_ast_equal, unindent, partial_apply_all
+
+
+def power(x, n, acc=1):
+    if n == 0:
+        return acc
+    elif n % 2 == 0:
+        return power(x * x, n // 2, acc)
+    else:
+        return power(x, n - 1, acc * x)
+
+
+def swap(a, b, n):
+    """Swaps ``a`` and ``b`` ``n`` times."""
+    if n > 0:
+        return swap(b, a, n - 1)
+    print(a, b)
+
+
+def test_component():
+
+    check_component(
+        eliminate_tail_calls, power,
+        expected_source="""
+            def power(x, n, acc=1):
+                while True:
+                    if n == 0:
+                        return acc
+                    elif n % 2 == 0:
+                        x = x * x
+                        n = n // 2
+                        continue
+                    else:
+                        n = n - 1
+                        acc = acc * x
+                        continue
+            """)
+
+
+def test_simultaneous_assignment():
+
+    # The body falls off the end, so an explicit return is added
+    check_component(
+        eliminate_tail_calls, swap,
+        expected_source='''
+            def swap(a, b, n):
+                """Swaps ``a`` and ``b`` ``n`` times."""
+                while True:
+                    if n > 0:
+                        (a, b, n) = (b, a, n - 1)
+                        continue
+                    print(a, b)
+                    return
+            ''')
+
+
+def test_bound_parameters():
+
+    function = Function.from_object(power).bind_partial(n=5)
+    new_tree, _ = eliminate_tail_calls(function.tree, function.get_external_variables())
+
+    expected_tree = ast.parse(unindent("""
+        def power(x, acc=1):
+            n = 5
+            while True:
+                if n == 0:
+                    return acc
+                elif n % 2 == 0:
+                    x = x * x
+                    n = n // 2
+                    continue
+                else:
+                    n = n - 1
+                    acc = acc * x
+                    continue
+        """)).body[0]
+
+    assert_ast_equal(new_tree, expected_tree)
+
+
+def in_loop(xs, n):
+    for x in xs:
+        return in_loop(xs, n - 1)
+
+
+def in_try(n):
+    try:
+        return in_try(n - 1)
+    finally:
+        print(n)
+
+
+def with_closure(f, n):
+    if n == 0:
+        return f()
+    return with_closure(lambda: n, n - 1)
+
+
+def not_tail_call(n):
+    if n == 0:
+        return 1
+    return n * not_tail_call(n - 1)
+
+
+def unbound_local(n):
+    if n > 0:
+        x = 1
+    if n == 0:
+        return x
+    return unbound_local(n - 1)
+
+
+def assigned_local(n, acc):
+    if n > 0:
+        x = n
+    else:
+        x = 0
+    if x == 0:
+        return acc
+    return assigned_local(x - 1, acc + x)
+
+
+def test_not_eliminated():
+    check_component(eliminate_tail_calls, unbound_local)
+    check_component(eliminate_tail_calls, in_loop)
+    check_component(eliminate_tail_calls, in_try)
+    check_component(eliminate_tail_calls, with_closure)
+    check_component(eliminate_tail_calls, not_tail_call)
+
+
+def test_assigned_local():
+    check_component(
+        eliminate_tail_calls, assigned_local,
+        expected_source="""
+            def assigned_local(n, acc):
+                while True:
+                    if n > 0:
+                        x = n
+                    else:
+                        x = 0
+                    if x == 0:
+                        return acc
+                    n = x - 1
+                    acc = acc + x
+                    continue
+            """)
+
+
+def test_unbound_local():
+    # ``fold`` assumes the value of ``x`` from the only path where it is assigned,
+    # so the component is run alone.
+    pm = PassManager(passes=[('eliminate_tail_calls', eliminate_tail_calls)])
+    f = specialize(unbound_local, pass_manager=pm)
+    with pytest.raises(UnboundLocalError):
+        f(1)
+
+
+def test_partial_apply():
+
+    power_5 = partial_apply_all(power, n=5)
+    for x in (0, 1, 2, 3.5):
+        assert power_5(x) == x ** 5
+
+    # The loop is unfolded for the known ``n``
+    assert 'while' not in power_5._peval_source
+    assert 'power(' not in power_5._peval_source.split(':', 1)[1]
+
+    # No recursion limit
+    power_all = partial_apply_all(power)
+    assert power_all(1, 100000) == 1
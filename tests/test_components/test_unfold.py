@@ -0,0 +1,341 @@
+from __future__ import print_function
+
+import functools
+
+import pytest
+
+from peval.components.unfold import unfold_loops
+from tests.utils import check_component, partial_apply_all
+
+
+def test_counting_loop():
+
+    def f(x):
+        i = 0
+        while i < 3:
+            x = x * 2
+            i += 1
+        return x
+
+    check_component(
+        unfold_loops, f,
+        expected_source="""
+            def f(x):
+                i = 0
+                x = x * 2
+                x = x * 2
+                x = x * 2
+                i = 3
+                return x
+            """)
+
+
+def test_break_and_else():
+
+    def f(x):
+        i = 0
+        while i < 2:
+            if x:
+                break
+            i = i + 1
+        else:
+            print('done')
+        return i
+
+    check_component(
+        unfold_loops, f,
+        expected_source="""
+            def f(x):
+                i = 0
+                if x:
+                    i = 0
+                else:
+                    if x:
+                        i = 1
+                    else:
+                        print('done')
+                        i = 2
+                return i
+            """)
+
+
+def test_dispatch_loop():
+
+    # The static state at the loop head is reached from two different paths
+    # depending on the dynamic data, so a dispatching loop is created.
+    def f(x):
+        pc = 0
+        while pc < 2:
+            if pc == 0:
+                x = x - 1
+                pc = 1
+            else:
+                if x > 0:
+                    pc = 0
+                else:
+                    pc = 2
+        return x
+
+    check_component(
+        unfold_loops, f,
+        expected_source="""
+            def f(x):
+                pc = 0
+                __peval_state_1 = 0
+                while True:
+                    if __peval_state_1 == 0:
+                        x = x - 1
+                        if x > 0:
+                            __peval_state_1 = 0
+                            continue
+                        else:
+                            pc = 2
+                            break
+                return x
+            """)
+
+
+def test_not_unfolded():
+
+    def f_dynamic(x):
+        while x > 0:
+            x = x - 1
+        return x
+
+    def f_unknown_entry(x, i):
+        while i < 3:
+            i += 1
+        return x
+
+    def f_nested_function(x):
+        i = 0
+        while i < 3:
+            g = lambda: i
+            i += 1
+        return g
+
+    # The static counter does not decide anything, so the loop would only be duplicated
+    def f_accumulator(xs):
+        i = 0
+        s = 0
+        while i < len(xs):
+            s += xs[i]
+            i += 1
+        return s
+
+    def f_jump_in_nested_statement(x):
+        i = 0
+        while i < 3:
+            try:
+                break
+            finally:
+                pass
+            i += 1
+
+    check_component(unfold_loops, f_dynamic)
+    check_component(unfold_loops, f_unknown_entry)
+    check_component(unfold_loops, f_nested_function)
+    check_component(unfold_loops, f_jump_in_nested_statement)
+    check_component(unfold_loops, f_accumulator)
+
+
+def test_generalization():
+
+    # ``i`` grows while the control returns to the state 0 depending on the dynamic data,
+    # so it is made dynamic after the number of static states exceeds the limit,
+    # and the loop is specialized on ``state`` alone.
+    def f(x):
+        i = 0
+        state = 0
+        while state != 2:
+            i = i + 1
+            if state == 0:
+                state = 1
+            elif x > i:
+                state = 0
+            else:
+                state = 2
+        return i
+
+    check_component(
+        functools.partial(unfold_loops, max_states=6), f,
+        expected_source="""
+            def f(x):
+                i = 0
+                state = 0
+                __peval_state_1 = 0
+                while True:
+                    if __peval_state_1 == 0:
+                        i = i + 1
+                        i = i + 1
+                        if x > i:
+                            __peval_state_1 = 0
+                            continue
+                        else:
+                            state = 2
+                            break
+                return i
+            """)
+
+
+def test_other_statements():
+
+    # The statements not handled by the specializer get the static values substituted
+    def f_raise(n):
+        i = 0
+        while i < 2:
+            if n == i:
+                raise ValueError(i)
+            i += 1
+        return i
+
+    def f_try(n):
+        i = 0
+        while i < 2:
+            try:
+                n = n // (i + 1)
+            except ZeroDivisionError:
+                n = 0
+            i += 1
+        return n
+
+    def f_nested_loop(n):
+        i = 0
+        while i < 2:
+            j = n
+            while j > i:
+                j -= 1
+            n = n + j
+            i += 1
+        return n
+
+    check_component(
+        unfold_loops, f_raise,
+        expected_source="""
+            def f_raise(n):
+                i = 0
+                if n == 0:
+                    raise ValueError(0)
+                elif n == 1:
+                    raise ValueError(1)
+                else:
+                    i = 2
+                return i
+            """)
+
+    check_component(
+        unfold_loops, f_try,
+        expected_source="""
+            def f_try(n):
+                i = 0
+                try:
+                    n = n // (0 + 1)
+                except ZeroDivisionError:
+                    n = 0
+                try:
+                    n = n // (1 + 1)
+                except ZeroDivisionError:
+                    n = 0
+                i = 2
+                return n
+            """)
+
+    check_component(
+        unfold_loops, f_nested_loop,
+        expected_source="""
+            def f_nested_loop(n):
+                i = 0
+                j = n
+                while j > 0:
+                    j -= 1
+                n = n + j
+                j = n
+                while j > 1:
+                    j -= 1
+                n = n + j
+                i = 2
+                return n
+            """)
+
+    f = partial_apply_all(f_raise)
+    assert f(5) == 2
+    with pytest.raises(ValueError):
+        f(1)
+    for n in (0, 3, 7):
+        assert partial_apply_all(f_try)(n) == f_try(n)
+        assert partial_apply_all(f_nested_loop)(n) == f_nested_loop(n)
+
+
+def test_static_names():
+
+    def f(x):
+        i = 0
+        while i < 2:
+            x = x + i
+            i += 1
+        return x
+
+    check_component(
+        functools.partial(unfold_loops, static_names=['j']), f)
+
+
+def test_mutable_state():
+
+    # The known mutable objects that the function changes are not a part of the state
+    program = ('push', 'len')
+    stack = []
+
+    def f(x):
+        pc = 0
+        while pc < len(program):
+            op = program[pc]
+            if op == 'push':
+                stack.append(x)
+            elif op == 'len':
+                return len(stack)
+            pc += 1
+        return -1
+
+    check_component(
+        unfold_loops, f, dict(program=program, stack=stack),
+        expected_source="""
+            def f(x):
+                pc = 0
+                stack.append(x)
+                return len(stack)
+                return -1
+            """)
+
+
+def interpret(program, x):
+    # A tiny accumulator machine: the program is a tuple of (opcode, argument) pairs
+    pc = 0
+    while pc < len(program):
+        op, arg = program[pc]
+        pc = pc + 1
+        if op == 'mul':
+            x = x * arg
+        elif op == 'dec':
+            x = x - arg
+        elif op == 'jump_if_positive':
+            if x > 0:
+                pc = arg
+        elif op == 'return':
+            return x
+    return x
+
+
+def test_interpreter():
+
+    # while x > 0: x = x - 2; then x = x * 3
+    program = (('dec', 2), ('jump_if_positive', 0), ('mul', 3), ('return', None))
+
+    interpret_program = partial_apply_all(interpret, program=program)
+
+    for x in (-2, 0, 1, 2, 3, 10):
+        assert interpret_program(x=x) == interpret(program, x)
+
+    source = interpret_program._peval_source
+    assert 'program' not in source
+    assert 'pc' not in source
+    assert "'mul'" not in source
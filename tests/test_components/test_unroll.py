@@ -0,0 +1,219 @@
+from __future__ import print_function
+
+import functools
+
+from peval.tags import unroll
+from peval.components.unroll import unroll_loops
+from tests.utils import check_component, partial_apply_all
+
+
+def test_small_range():
+
+    def f():
+        for i in range(2):
+            print(i)
+        else:
+            print('done')
+
+    check_component(
+        unroll_loops, f,
+        expected_source="""
+            def f():
+                i = 0
+                print(i)
+                i = 1
+                print(i)
+                print('done')
+            """)
+
+
+def test_tuple_target():
+
+    def f():
+        for k, v in pairs:
+            print(k, v)
+
+    check_component(
+        unroll_loops, f, additional_bindings=dict(pairs=(('a', 1), ('b', 2))),
+        expected_source="""
+            def f():
+                (k, v) = __peval_temp_1
+                print(k, v)
+                (k, v) = __peval_temp_2
+                print(k, v)
+            """)
+
+
+def test_nested_loops():
+
+    def f():
+        for i in range(2):
+            for j in range(2):
+                print(i, j)
+
+    check_component(
+        unroll_loops, f,
+        expected_source="""
+            def f():
+                i = 0
+                j = 0
+                print(i, j)
+                j = 1
+                print(i, j)
+                i = 1
+                j = 0
+                print(i, j)
+                j = 1
+                print(i, j)
+            """)
+
+
+def test_not_unrolled():
+
+    def f_large(x):
+        for i in range(100):
+            x = x + i
+        return x
+
+    def f_break(x):
+        for i in range(2):
+            if x:
+                break
+        return x
+
+    def f_unknown(x):
+        for i in range(x):
+            print(i)
+
+    def f_mutated():
+        for i in lst:
+            lst.append(i)
+
+    def f_local():
+        range = lambda n: [1, 2, 3]
+        for i in range(2):
+            print(i)
+
+    # The new lists would be shared by the calls
+    def f_new_elements(x):
+        for row in [[1], [2]]:
+            row.append(x)
+
+    # ``table`` is changed through ``row``
+    def f_mutated_elements(x):
+        for row in table:
+            row.append(x)
+        for row in table:
+            print(row)
+
+    check_component(unroll_loops, f_large)
+    check_component(unroll_loops, f_break)
+    check_component(unroll_loops, f_unknown)
+    check_component(unroll_loops, f_mutated, additional_bindings=dict(lst=[1]))
+    check_component(unroll_loops, f_local)
+    check_component(unroll_loops, f_new_elements)
+    check_component(
+        unroll_loops, f_mutated_elements, additional_bindings=dict(table=([1], [2])))
+
+
+def test_new_container():
+
+    def f(x):
+        for i in [1, 2]:
+            x = x + i
+        return x
+
+    check_component(
+        unroll_loops, f,
+        expected_source="""
+            def f(x):
+                i = 1
+                x = x + i
+                i = 2
+                x = x + i
+                return x
+            """)
+
+
+def test_jumps_in_nested_loop():
+
+    def f():
+        for i in range(1):
+            for j in x:
+                break
+            else:
+                continue
+
+    # ``continue`` in the ``else`` clause of the nested loop belongs to the outer one
+    check_component(unroll_loops, f)
+
+    def g():
+        for i in range(1):
+            for j in x:
+                break
+
+    check_component(
+        unroll_loops, g,
+        expected_source="""
+            def g():
+                i = 0
+                for j in x:
+                    break
+            """)
+
+
+def test_explicit_unroll():
+
+    def f():
+        for i in unroll(range(10)):
+            print(i)
+
+    check_component(
+        unroll_loops, f,
+        expected_source="def f():\n" + "".join(
+            "    i = {i}\n    print(i)\n".format(i=i) for i in range(10)))
+
+
+def test_policy():
+
+    def f():
+        for i in range(2):
+            print(i)
+        for s in 'ab':
+            print(s)
+
+    def policy(node, iterable):
+        if isinstance(iterable, str):
+            return True
+        elif isinstance(iterable, range):
+            return False
+        else:
+            return None
+
+    check_component(
+        functools.partial(unroll_loops, policy=policy), f,
+        expected_source="""
+            def f():
+                for i in range(2):
+                    print(i)
+                s = 'a'
+                print(s)
+                s = 'b'
+                print(s)
+            """)
+
+    check_component(
+        functools.partial(unroll_loops, max_iterations=1), f)
+
+
+def test_partial_apply():
+
+    def power(x, n):
+        result = 1
+        for i in range(n):
+            result = result * x
+        return result
+
+    power3 = partial_apply_all(power, n=3)
+    assert power3(2) == 8
+    assert 'for' not in power3._peval_source
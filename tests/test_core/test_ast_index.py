@@ -0,0 +1,77 @@
+import os
+import ast
+
+from peval.core.ast_index import ASTIndex
+
+
+def decorator(func):
+    return func
+
+
+def plain(x):
+    return x
+
+
+@decorator
+def decorated(x):
+    return x
+
+
+def make_closure():
+    y = 1
+    def closure(x):
+        return x + y
+    return closure
+
+
+def test_get_function_def():
+    index = ASTIndex()
+
+    for func, name in ((plain, 'plain'), (decorated, 'decorated'), (make_closure(), 'closure')):
+        function_def = index.get_function_def(func)
+        assert type(function_def) == ast.FunctionDef
+        assert function_def.name == name
+
+    # The module is parsed only once
+    assert index.parses == 1
+
+    # The cached tree is returned
+    assert index.get_function_def(plain) is index.get_function_def(plain)
+
+
+def test_no_source():
+    index = ASTIndex()
+    namespace = {}
+    exec("def func(x):\n    return x", namespace)
+    assert index.get_function_def(namespace['func']) is None
+
+
+def load_function(path, name):
+    with open(path) as f:
+        source = f.read()
+    namespace = {}
+    exec(compile(source, path, 'exec'), namespace)
+    return namespace[name]
+
+
+def test_invalidate_on_change(tmpdir):
+    module_path = str(tmpdir.join('ast_index_test_module.py'))
+
+    with open(module_path, 'w') as f:
+        f.write("def func(x):\n    return x\n")
+    func = load_function(module_path, 'func')
+
+    index = ASTIndex()
+    function_def = index.get_function_def(func)
+    assert function_def.name == 'func'
+
+    with open(module_path, 'w') as f:
+        f.write("def func(x):\n    return x + 1\n")
+    stat = os.stat(module_path)
+    os.utime(module_path, (stat.st_atime, stat.st_mtime + 10))
+    func = load_function(module_path, 'func')
+
+    new_function_def = index.get_function_def(func)
+    assert new_function_def is not function_def
+    assert type(new_function_def.body[0].value) == ast.BinOp
+    assert index.parses == 2
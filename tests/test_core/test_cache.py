@@ -0,0 +1,136 @@
+import pytest
+
+from peval.core.cache import SpecializationCache, specialization_key
+
+
+def dummy(x, y):
+    return x + y + CONST
+
+
+CONST = 1
+
+
+def make_function(name):
+    def f():
+        pass
+    f.__name__ = name
+    vars(f)['_peval_source'] = "def " + name + "():\n    pass\n"
+    return f
+
+
+def test_key_equality():
+    assert specialization_key(dummy, (1,), {}) == specialization_key(dummy, (1,), {})
+    assert specialization_key(dummy, (1,), {}) != specialization_key(dummy, (2,), {})
+    assert (specialization_key(dummy, (), dict(x=1, y=2))
+        == specialization_key(dummy, (), dict(y=2, x=1)))
+
+
+def test_key_distinguishes_types():
+    # Equal values of different types lead to different specializations
+    assert specialization_key(dummy, (1,), {}) != specialization_key(dummy, (1.0,), {})
+    assert specialization_key(dummy, (1,), {}) != specialization_key(dummy, (True,), {})
+
+
+def test_key_unhashable():
+    assert specialization_key(dummy, ([1],), {}) is None
+
+
+def test_key_globals_version():
+    global CONST
+    old_key = specialization_key(dummy, (1,), {})
+    old_const = CONST
+    try:
+        CONST = 2
+        assert specialization_key(dummy, (1,), {}) != old_key
+    finally:
+        CONST = old_const
+    assert specialization_key(dummy, (1,), {}) == old_key
+
+
+def test_key_closure_version():
+
+    def make_closure(a):
+        def closure(x):
+            return x + a
+        return closure
+
+    c1 = make_closure(1)
+    c2 = make_closure(2)
+    assert c1.__code__ is c2.__code__
+    assert specialization_key(c1, (1,), {}) != specialization_key(c2, (1,), {})
+
+
+def test_key_empty_cell():
+
+    def make_closure():
+        def closure(x):
+            return x + a
+        key = specialization_key(closure, (1,), {})
+        a = 1
+        return closure, key
+
+    closure, key = make_closure()
+    assert key is not None
+    assert specialization_key(closure, (1,), {}) != key
+
+
+def test_hits_and_misses():
+    cache = SpecializationCache()
+    f = make_function('f')
+
+    assert cache.get('a') is None
+    cache.put('a', f)
+    assert cache.get('a') is f
+    assert cache.get(None) is None
+
+    info = cache.info()
+    assert info.hits == 1
+    assert info.misses == 1
+    assert info.uncacheable == 1
+    assert info.entries == 1
+
+
+def test_lru_entries_budget():
+    cache = SpecializationCache(max_entries=2)
+    f1, f2, f3 = [make_function(name) for name in ('f1', 'f2', 'f3')]
+
+    cache.put('f1', f1)
+    cache.put('f2', f2)
+    cache.get('f1') # `f2` is now the least recently used
+    cache.put('f3', f3)
+
+    assert cache.get('f2') is None
+    assert cache.get('f1') is f1
+    assert cache.get('f3') is f3
+    assert cache.info().evictions == 1
+
+
+def test_bytes_budget():
+    f1, f2 = make_function('f1'), make_function('f2')
+    cache = SpecializationCache(max_entries=None)
+    cache.put('f1', f1)
+    size = cache.info().bytes
+
+    cache.configure(max_bytes=size)
+    cache.put('f2', f2)
+    assert len(cache) == 1
+    assert cache.get('f2') is f2
+
+    cache.configure(max_bytes=0)
+    assert len(cache) == 0
+    assert cache.info().bytes == 0
+
+
+def test_invalid_budget():
+    with pytest.raises(ValueError):
+        SpecializationCache(max_entries=-1)
+
+
+def test_clear():
+    cache = SpecializationCache()
+    cache.put('f', make_function('f'))
+    cache.get('f')
+    cache.clear()
+    info = cache.info()
+    assert info.entries == 0
+    assert info.hits == 0
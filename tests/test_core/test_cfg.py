@@ -2,10 +2,13 @@ import ast
 import inspect
 import os, os.path
 import subprocess
+import sys
 
+import pytest
 from astunparse import unparse
 
-from peval.core.cfg import build_cfg
+from peval.tools import unindent
+from peval.core.cfg import build_cfg, BasicBlocks
 
 from tests.utils import print_diff
 
@@ -19,7 +22,7 @@ def make_label(node):
 
 def get_edges(cfg):
     edges = []
-    for node_id in cfg.graph._nodes:
+    for node_id in cfg.graph.node_ids():
         for child_id in cfg.graph.children_of(node_id):
             edges.append((node_id, child_id))
     return edges
@@ -62,14 +65,14 @@ def render_cfg(cfg, fname):
     directives.append(node_str('enter', 'enter'))
     directives.append(node_str('exit', 'exit'))
 
-    for node_id, node in cfg.graph._nodes.items():
-        directives.append(node_str(node_id, make_label(node)))
+    for node_id in cfg.graph.node_ids():
+        directives.append(node_str(node_id, make_label(cfg.graph._nodes[node_id])))
 
     directives.append(edge_str('enter', cfg.enter))
     for exit in cfg.exits:
         directives.append(edge_str(exit, 'exit'))
 
-    for node_id in cfg.graph._nodes:
+    for node_id in cfg.graph.node_ids():
         for child_id in cfg.graph.children_of(node_id):
             directives.append(edge_str(node_id, child_id))
 
@@ -182,20 +185,117 @@ def test_func_for():
         expected_edges=[
             ('a = 1', 'for i in range(5):'),
             ('for i in range(5):', 'b = 2'),
+            ('for i in range(5):', 'c = 3'),
+            ('c = 3', 'return b'),
             ('b = 2', 'if (i > 4):'),
             ('if (i > 4):', 'break'),
             ('if (i > 4):', 'if (i > 2):'),
             ('if (i > 2):', 'continue'),
             ('if (i > 2):', 'foo()'),
-            ('foo()', 'c = 3'),
             ('foo()', 'for i in range(5):'),
-            ('c = 3', 'return b'),
             ('continue', 'for i in range(5):'),
             ('break', 'return b')],
         expected_exits=['return b'],
         expected_raises=[])
 
 
+def test_reverse_postorder():
+    cfg = build_cfg(get_body(func_for))
+    graph = cfg.graph
+    order = graph.reverse_postorder(cfg.enter)
+
+    assert order[0] == cfg.enter
+    assert sorted(order) == list(graph.node_ids())
+    assert graph.reverse_postorder(cfg.enter) == order
+
+    # The only edges going backwards are the back edges of the loop
+    positions = dict((node_id, i) for i, node_id in enumerate(order))
+    for src_id, dest_id in get_edges(cfg):
+        if positions[dest_id] <= positions[src_id]:
+            assert make_label(graph._nodes[dest_id]) == 'for i in range(5):'
+
+
+def test_basic_blocks():
+    cfg = build_cfg(get_body(func_if))
+    blocks = BasicBlocks(cfg.graph, cfg.enter)
+
+    labels = [
+        [make_label(cfg.graph._nodes[node_id]) for node_id in statements]
+        for statements in blocks.statements]
+    assert labels == [
+        ['a = 1', 'b = 2', 'if (a > 2):'],
+        ['do_stuff()', 'do_smth_else()', 'return 3'],
+        ['if (a > 4):'],
+        ['foo()'],
+        ['bar()'],
+        ['return b']]
+
+    assert blocks.enter == 0
+    assert blocks.successors == [[1, 2], [], [3, 4], [5], [5], []]
+    assert blocks.predecessors == [[], [0], [0], [2], [2], [3, 4]]
+    assert blocks.reverse_postorder() == [0, 2, 4, 3, 5, 1]
+
+
+def test_dominators():
+    cfg = build_cfg(get_body(func_for))
+    graph = cfg.graph
+    dominators = graph.dominators(cfg.enter)
+
+    labels = dict(
+        (node_id, make_label(graph._nodes[node_id])) for node_id in graph.node_ids())
+    idoms = dict(
+        (labels[node_id], labels[idom] if idom is not None else None)
+        for node_id, idom in dominators.idoms.items())
+    assert idoms == {
+        'a = 1': None,
+        'for i in range(5):': 'a = 1',
+        'b = 2': 'for i in range(5):',
+        'if (i > 4):': 'b = 2',
+        'break': 'if (i > 4):',
+        'if (i > 2):': 'if (i > 4):',
+        'continue': 'if (i > 2):',
+        'foo()': 'if (i > 2):',
+        'c = 3': 'for i in range(5):',
+        'return b': 'for i in range(5):'}
+
+    ids = dict((label, node_id) for node_id, label in labels.items())
+    assert dominators.dominates(ids['b = 2'], ids['foo()'])
+    assert dominators.dominates(ids['foo()'], ids['foo()'])
+    assert not dominators.dominates(ids['c = 3'], ids['return b'])
+
+
+def func_nested_loops():
+    for i in range(5):
+        while i > 0:
+            i -= 1
+        foo()
+    return i
+
+
+def test_natural_loops():
+    cfg = build_cfg(get_body(func_nested_loops))
+    graph = cfg.graph
+    loops = graph.natural_loops(cfg.enter)
+
+    label = lambda node_id: make_label(graph._nodes[node_id])
+
+    assert len(loops) == 2
+    outer_loop, inner_loop = loops
+
+    assert label(outer_loop.header) == 'for i in range(5):'
+    assert [label(node_id) for node_id in outer_loop.latches] == ['foo()']
+    assert sorted(label(node_id) for node_id in outer_loop.nodes) == [
+        'foo()', 'for i in range(5):', 'i -= 1', 'while (i > 0):']
+    assert [label(node_id) for node_id in outer_loop.exiting_nodes(graph)] == [
+        'for i in range(5):']
+    assert outer_loop.parent is None
+
+    assert label(inner_loop.header) == 'while (i > 0):'
+    assert sorted(label(node_id) for node_id in inner_loop.nodes) == [
+        'i -= 1', 'while (i > 0):']
+    assert inner_loop.parent is outer_loop
+
+
 def func_try_except():
     a = 1
 
@@ -220,6 +320,7 @@ def test_func_try_except():
         func_try_except,
         expected_edges=[
             ('a = 1', 'for i in range(5):'),
+            ('for i in range(5):', 'return b'),
             ('for i in range(5):', 'try:'),
             ('try:', 'do()'),
             ('do()', 'except Exception:'),
@@ -234,12 +335,9 @@ def test_func_try_except():
             ('stuff()', 'except ValueError:'),
             ('except ValueError:', 'bar()'),
             ('bar()', 'for i in range(5):'),
-            ('bar()', 'return b'),
             ('except Exception:', 'foo()'),
             ('foo()', 'for i in range(5):'),
-            ('foo()', 'return b'),
             ('do_else()', 'for i in range(5):'),
-            ('do_else()', 'return b'),
             ('break', 'return b')],
         expected_exits=['return b'],
         expected_raises=[])
@@ -340,3 +438,75 @@ def test_func_try_except_else_finally():
             ('do_else()', 'do_finally()')],
         expected_exits=['return b'],
         expected_raises=[])
+
+
+def get_source_edges(source):
+    # For the syntax ``astunparse`` does not support,
+    # the nodes are labeled with the corresponding source lines.
+    lines = source.split("\n")
+    label = lambda node: lines[getattr(node, 'pattern', node).lineno - 1].strip()
+
+    cfg = build_cfg(ast.parse(source).body)
+    edges = sorted(
+        (label(cfg.graph._nodes[node_id].ast_node),
+            label(cfg.graph._nodes[child_id].ast_node))
+        for node_id, child_id in get_edges(cfg))
+    exits = sorted(label(cfg.graph._nodes[node_id].ast_node) for node_id in cfg.exits)
+    return edges, exits
+
+
+def test_match():
+
+    if sys.version_info < (3, 10):
+        pytest.skip()
+
+    source = unindent(
+        """
+        match x:
+            case 1:
+                one()
+            case [a, *b] if a:
+                many()
+        match y:
+            case z:
+                capture()
+            case 2:
+                unreachable()
+        """)
+    edges, exits = get_source_edges(source)
+
+    assert edges == sorted([
+        ('match x:', 'case 1:'),
+        ('case 1:', 'one()'),
+        ('case 1:', 'case [a, *b] if a:'),
+        ('case [a, *b] if a:', 'many()'),
+        # The last case of the first statement may not match
+        ('case [a, *b] if a:', 'match y:'),
+        ('one()', 'match y:'),
+        ('many()', 'match y:'),
+        ('match y:', 'case z:'),
+        # The capture pattern matches anything, so the following cases are not reachable
+        ('case z:', 'capture()')])
+    assert exits == ['capture()']
+
+
+def test_async():
+
+    if sys.version_info < (3, 5):
+        pytest.skip()
+
+    source = unindent(
+        """
+        async for x in y:
+            async with x:
+                foo()
+        bar()
+        """)
+    edges, exits = get_source_edges(source)
+
+    assert edges == sorted([
+        ('async for x in y:', 'async with x:'),
+        ('async with x:', 'foo()'),
+        ('foo()', 'async for x in y:'),
+        ('async for x in y:', 'bar()')])
+    assert exits == ['bar()']
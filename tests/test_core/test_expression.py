@@ -16,7 +16,7 @@ def expression_ast(source):
 
 def check_peval_expression(source, bindings, expected_source,
         fully_evaluated=False, expected_value=None, expected_temp_bindings=None,
-        py2_division=False):
+        py2_division=False, create_containers=False):
 
     source_tree = expression_ast(source)
 
@@ -30,7 +30,9 @@ def check_peval_expression(source, bindings, expected_source,
         expected_tree = expected_source
 
     gen_sym = GenSym()
-    result, gen_sym = peval_expression(source_tree, gen_sym, bindings, py2_division=py2_division)
+    result, gen_sym = peval_expression(
+        source_tree, gen_sym, bindings, py2_division=py2_division,
+        create_containers=create_containers)
 
     assert_ast_equal(result.node, expected_tree)
 
@@ -245,18 +247,20 @@ def test_ifexp_short_circuit():
 
 def test_dict():
     check_peval_expression('{a: b, c: d}', dict(a=2, d=1), '{2: b, c: 1}')
+    check_peval_expression('{a: b, c: d}', dict(a=1, b=2, c=3, d=4), '{1: 2, 3: 4}')
     check_peval_expression(
         '{a: b, c: d}', dict(a=1, b=2, c=3, d=4), '__peval_temp_1',
         expected_temp_bindings=dict(__peval_temp_1={1: 2, 3: 4}),
-        fully_evaluated=True, expected_value={1: 2, 3: 4})
+        fully_evaluated=True, expected_value={1: 2, 3: 4}, create_containers=True)
 
 
 def test_list():
     check_peval_expression('[a, b, c, d]', dict(a=2, d=1), '[2, b, c, 1]')
+    check_peval_expression('[a, b, c, d]', dict(a=1, b=2, c=3, d=4), '[1, 2, 3, 4]')
     check_peval_expression(
         '[a, b, c, d]', dict(a=1, b=2, c=3, d=4), '__peval_temp_1',
         expected_temp_bindings=dict(__peval_temp_1=[1, 2, 3, 4]),
-        fully_evaluated=True, expected_value=[1, 2, 3, 4])
+        fully_evaluated=True, expected_value=[1, 2, 3, 4], create_containers=True)
 
 
 def test_set():
@@ -264,10 +268,11 @@ def test_set():
         pytest.skip()
 
     check_peval_expression('{a, b, c, d}', dict(a=2, d=1), '{2, b, c, 1}')
+    check_peval_expression('{a, b, c, d}', dict(a=1, b=2, c=3, d=4), '{1, 2, 3, 4}')
     check_peval_expression(
         '{a, b, c, d}', dict(a=1, b=2, c=3, d=4), '__peval_temp_1',
         expected_temp_bindings=dict(__peval_temp_1=set([1, 2, 3, 4])),
-        fully_evaluated=True, expected_value=set([1, 2, 3, 4]))
+        fully_evaluated=True, expected_value=set([1, 2, 3, 4]), create_containers=True)
 
 
 def test_repr():
@@ -298,6 +303,8 @@ def test_subscript():
         'x[a]', dict(x="abc", a=1), '"b"', fully_evaluated=True, expected_value='b')
     check_peval_expression('x[a + 4]', dict(a=1), 'x[5]')
     check_peval_expression('x[a + 4]', dict(x='abc'), '"abc"[a + 4]')
+    check_peval_expression(
+        'x[a][0]', dict(x=(('b', 2),), a=0), '"b"', fully_evaluated=True, expected_value='b')
 
     # Slices
 
@@ -372,6 +379,11 @@ def test_function_call():
         expected_temp_bindings=dict(__peval_temp_1=((3, 4), {'a': 5})),
         fully_evaluated=True, expected_value=((3, 4), {'a': 5}))
 
+    # Builtins with known signatures
+    check_peval_expression(
+        'len(x)', dict(len=len, x=(1, 2)), '2', fully_evaluated=True, expected_value=2)
+    check_peval_expression('print(x)', dict(print=print, x=1), 'print(1)')
+
 
 def test_yield():
     check_peval_expression('yield a + b', dict(a=1), 'yield 1 + b')
@@ -388,15 +400,18 @@ def test_list_comprehension():
     check_peval_expression(
         '[x + 1 for x in range(a)]', dict(a=10, range=range), '__peval_temp_2',
         expected_temp_bindings=dict(__peval_temp_2=list(range(1, 11))),
-        fully_evaluated=True, expected_value=list(range(1, 11)))
+        fully_evaluated=True, expected_value=list(range(1, 11)), create_containers=True)
     check_peval_expression(
         '[x + 1 for x in range(a)]', dict(a=10), '[x + 1 for x in range(10)]')
+    check_peval_expression(
+        '[x + 1 for x in range(a)]', dict(a=10, range=range), '[x + 1 for x in __peval_temp_2]',
+        expected_temp_bindings=dict(__peval_temp_2=range(10)))
 
     check_peval_expression(
         '[x + y for x, y in [(1, 2), (2, 3)]]',
         dict(a=10, range=range, zip=zip), '__peval_temp_2',
         expected_temp_bindings=dict(__peval_temp_2=[3, 5]),
-        fully_evaluated=True, expected_value=[3, 5])
+        fully_evaluated=True, expected_value=[3, 5], create_containers=True)
 
 
 def test_set_comprehension():
@@ -405,7 +420,7 @@ def test_set_comprehension():
     check_peval_expression(
         '{x + 1 for x in range(a)}', dict(a=10, range=range), '__peval_temp_2',
         expected_temp_bindings=dict(__peval_temp_2=set(range(1, 11))),
-        fully_evaluated=True, expected_value=set(range(1, 11)))
+        fully_evaluated=True, expected_value=set(range(1, 11)), create_containers=True)
     check_peval_expression(
         '{x + 1 for x in range(a)}', dict(a=10), '{x + 1 for x in range(10)}')
 
@@ -416,7 +431,7 @@ def test_dict_comprehension():
     check_peval_expression(
         '{x+1:x+2 for x in range(a)}', dict(a=2, range=range), '__peval_temp_3',
         expected_temp_bindings=dict(__peval_temp_3={1:2, 2:3}),
-        fully_evaluated=True, expected_value={1:2, 2:3})
+        fully_evaluated=True, expected_value={1:2, 2:3}, create_containers=True)
     check_peval_expression(
         '{x+1:x+2 for x in range(a)}', dict(a=2), '{x+1:x+2 for x in range(2)}')
 
@@ -431,7 +446,7 @@ def test_generator_exp():
     bindings = dict(a=10, range=range)
 
     gen_sym = GenSym()
-    result, gen_sym = peval_expression(source_tree, gen_sym, bindings)
+    result, gen_sym = peval_expression(source_tree, gen_sym, bindings, create_containers=True)
 
     assert_ast_equal(result.node, expected_tree)
     assert result.fully_evaluated
@@ -446,7 +461,7 @@ def test_generator_exp():
     # in order to check the binding as well
 
     gen_sym = GenSym()
-    result, gen_sym = peval_expression(source_tree, gen_sym, bindings)
+    result, gen_sym = peval_expression(source_tree, gen_sym, bindings, create_containers=True)
 
     expected_genexp = (x + 1 for x in range(10))
 
@@ -521,3 +536,60 @@ def test_arithmetic():
         '3 % 2', {}, '1', fully_evaluated=True, expected_value=1)
     check_peval_expression(
         'x / y', dict(x=1, y=2.0), '0.5', fully_evaluated=True, expected_value=0.5)
+
+
+def test_unpacking_with_side_effects():
+
+    @pure
+    def fn_varargs(*args):
+        return args
+
+    # A generator is not exhausted at compile time
+    gen = (x for x in range(3))
+    check_peval_expression('fn(*gen)', dict(fn=fn_varargs, gen=gen), 'fn(*gen)')
+    assert list(gen) == [0, 1, 2]
+
+
+def test_formatted_string():
+
+    if sys.version_info < (3, 6):
+        pytest.skip()
+
+    check_peval_expression(
+        'f"{x}-{y!r:>5}"', dict(x=1, y='a'), '"1-  \'a\'"',
+        fully_evaluated=True, expected_value="1-  'a'")
+    check_peval_expression(
+        'f"{x}-{y:>{w}}-{z}"', dict(x=1, w=3), 'f"1-{y:>3}-{z}"')
+
+
+def test_named_expression():
+
+    if sys.version_info < (3, 8):
+        pytest.skip()
+
+    source_tree = expression_ast('(x := y + 1) + x')
+    result, _ = peval_expression(source_tree, GenSym(), dict(x=1, y=2))
+
+    # The assignment is preserved, and the new value of ``x`` is not known
+    assert_ast_equal(result.node, expression_ast('(x := 3) + x'))
+    assert not result.fully_evaluated
+    assert result.mutated_bindings == set(['x'])
+
+
+def test_await():
+
+    if sys.version_info < (3, 5):
+        pytest.skip()
+
+    # The awaitable is evaluated, but the ``await`` itself is left for the runtime
+    check_peval_expression('await (a + 1)', dict(a=1), 'await 2')
+
+
+def test_async_comprehension():
+
+    if sys.version_info < (3, 6):
+        pytest.skip()
+
+    # An asynchronous comprehension is not evaluated even if its iterable is known
+    check_peval_expression(
+        '[x + a async for x in b]', dict(a=1, b=[1, 2]), '[x + 1 async for x in b]')
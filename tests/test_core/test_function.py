@@ -4,8 +4,10 @@ import sys
 
 import astunparse
 import funcsigs
+import pytest
 
-from peval.core.function import Function
+from peval.core.function import (
+    Function, filter_function_def, is_generator, make_generator)
 from peval.tools import unindent
 
 from tests.utils import ast_to_source
@@ -149,6 +151,30 @@ def test_closure_contents():
     assert 'closure_var' in func.closure_names
 
 
+def test_external_variables():
+
+    func = Function.from_object(make_one_var_closure())
+    external = func.get_external_variables()
+
+    assert external['closure_var'] == [1]
+    assert external['global_var'] == 1
+    assert external['len'] is len
+
+    # Globals are not copied
+    assert external.get('not_yet_defined') is None
+    func.globals['not_yet_defined'] = 2
+    try:
+        assert external['not_yet_defined'] == 2
+    finally:
+        del func.globals['not_yet_defined']
+
+    new_external = external.set('global_var', 2)
+    assert new_external['global_var'] == 2
+    assert new_external.overrides == dict(global_var=2)
+    assert external['global_var'] == 1
+    assert func.globals['global_var'] == 1
+
+
 def test_restore_globals():
 
     global_var_writer(10)
@@ -363,3 +389,44 @@ def sample_fn3(x, y, foo='bar', **kwargs):
     else:
         return kwargs['zzz']
 
+
+
+def test_filter_async_function_def():
+
+    if sys.version_info < (3, 5):
+        pytest.skip()
+
+    function_def = ast.parse(unindent("""
+        async def func(x, y):
+            await x
+        """)).body[0]
+    new_function_def = filter_function_def(function_def, set(['x']))
+
+    assert type(new_function_def) == ast.AsyncFunctionDef
+    assert [arg.arg for arg in new_function_def.args.args] == ['y']
+    assert new_function_def.body is function_def.body
+
+
+def test_make_generator():
+    function_def = ast.parse(unindent("""
+        def func(x):
+            def inner():
+                yield x
+            return inner
+        """)).body[0]
+
+    # A ``yield`` in a nested function does not count
+    assert not is_generator(function_def)
+
+    new_function_def = make_generator(function_def)
+    assert is_generator(new_function_def)
+    assert make_generator(new_function_def) is new_function_def
+
+    # ``ast.NameConstant`` is deprecated since Py3.8
+    if sys.version_info >= (3, 8):
+        assert type(new_function_def.body[-1].test) == ast.Constant
+
+    namespace = {}
+    exec(compile(ast.fix_missing_locations(ast.Module(
+        body=[new_function_def], type_ignores=[])), '<test>', 'exec'), namespace)
+    assert list(namespace['func'](1)) == []
@@ -0,0 +1,124 @@
+import ast
+
+import pytest
+
+from peval.core.pass_manager import PassManager, count_nodes, DEFAULT_MAX_ITERATIONS
+from peval.tools import replace_fields
+
+
+def remove_first_statement(tree, constants):
+    if len(tree.body) > 1:
+        return replace_fields(tree, body=tree.body[1:]), constants
+    else:
+        return tree, constants
+
+
+def add_constant(tree, constants):
+    if 'a' in constants:
+        return tree, constants
+    else:
+        constants = dict(constants)
+        constants['a'] = 1
+        return tree, constants
+
+
+def identity(tree, constants):
+    return tree, constants
+
+
+def get_tree():
+    return ast.parse("def f():\n    x = 1\n    y = 2\n    return x").body[0]
+
+
+def test_fixed_point():
+    pm = PassManager(passes=[
+        ('remove', remove_first_statement), ('add', add_constant), ('identity', identity)])
+    tree = get_tree()
+    new_tree, constants = pm.run(tree, {})
+
+    assert len(new_tree.body) == 1
+    assert constants == dict(a=1)
+
+    report = pm.last_report
+    assert report.iterations == 3
+    assert report.passes['remove'].calls == 3
+    assert report.passes['remove'].changes == 2
+    assert report.passes['remove'].node_delta == count_nodes(new_tree) - count_nodes(tree)
+    assert report.passes['add'].changes == 1
+    assert report.passes['add'].node_delta == 0
+    assert report.passes['identity'].changes == 0
+
+
+def test_max_iterations():
+    pm = PassManager(passes=[('remove', remove_first_statement)], max_iterations=1)
+    with pytest.warns(RuntimeWarning):
+        new_tree, _ = pm.run(get_tree(), {})
+    assert len(new_tree.body) == 2
+    assert pm.last_report.iterations == 1
+    assert not pm.last_report.converged
+
+    # The limit is a part of the configuration
+    version = pm.version
+    pm.max_iterations = 5
+    assert pm.version > version
+
+    new_tree, _ = pm.run(get_tree(), {})
+    assert len(new_tree.body) == 1
+    assert pm.last_report.converged
+
+
+def test_default_max_iterations():
+
+    def flip(tree, constants):
+        # Never reaches a fixed point
+        return replace_fields(tree, name=tree.name + '_'), constants
+
+    pm = PassManager(passes=[('flip', flip)])
+    assert pm.max_iterations == DEFAULT_MAX_ITERATIONS
+    with pytest.warns(RuntimeWarning):
+        pm.run(get_tree(), {})
+    assert pm.last_report.iterations == DEFAULT_MAX_ITERATIONS
+
+
+def test_register_order():
+    pm = PassManager(passes=[('a', identity), ('c', identity)])
+    version = pm.version
+
+    pm.register('b', identity, before='c')
+    pm.register('d', identity, after='c')
+    pm.register('z', identity, before='a')
+    assert pm.pass_names == ['z', 'a', 'b', 'c', 'd']
+
+    pm.unregister('z')
+    pm.reorder(['d', 'c', 'b', 'a'])
+    assert pm.pass_names == ['d', 'c', 'b', 'a']
+    assert pm.version > version
+
+    with pytest.raises(ValueError):
+        pm.register('a', identity)
+    with pytest.raises(ValueError):
+        pm.reorder(['a', 'b'])
+    with pytest.raises(KeyError):
+        pm.register('e', identity, after='x')
+
+
+def test_disable():
+    pm = PassManager(passes=[('remove', remove_first_statement), ('add', add_constant)])
+    pm.disable('remove')
+    assert pm.enabled_pass_names == ['add']
+
+    new_tree, constants = pm.run(get_tree(), {})
+    assert len(new_tree.body) == 3
+    assert constants == dict(a=1)
+    assert list(pm.last_report.passes) == ['add']
+
+    pm.enable('remove')
+    assert pm.enabled_pass_names == ['remove', 'add']
+
+
+def test_on_report():
+    reports = []
+    pm = PassManager(passes=[('identity', identity)], on_report=reports.append)
+    pm.run(get_tree(), {})
+    pm.copy().run(get_tree(), {})
+    assert len(reports) == 2
@@ -0,0 +1,88 @@
+import ast
+
+from peval.core.symbol_finder import find_unassigned_usages
+from peval.tools import unindent
+
+
+def check_unassigned(source, assigned_names, expected):
+    statements = ast.parse(unindent(source)).body
+    assert find_unassigned_usages(statements, assigned_names) == set(expected)
+
+
+def test_branches():
+    check_unassigned(
+        """
+        if n > 0:
+            x = 1
+            y = 1
+        else:
+            x = 2
+        z = x + y + n + glob
+        """,
+        ['n'], ['y'])
+
+    # The branches ending with a jump do not reach the usage
+    check_unassigned(
+        """
+        if n > 0:
+            x = 1
+        else:
+            return
+        z = x
+        """,
+        ['n'], [])
+
+
+def test_loops():
+    check_unassigned(
+        """
+        while n > 0:
+            x = n
+            n = n - 1
+        for i in range(n):
+            y = i
+        z = x + y + i
+        """,
+        ['n'], ['x', 'y', 'i'])
+
+    # The usage in the next iteration
+    check_unassigned(
+        """
+        while n > 0:
+            if n == 1:
+                z = x
+            x = n
+        """,
+        ['n'], ['x'])
+
+
+def test_try():
+    check_unassigned(
+        """
+        try:
+            x = f()
+        except Exception as e:
+            y = e
+        z = x + e
+        """,
+        ['f'], ['x', 'e'])
+
+    check_unassigned(
+        """
+        try:
+            x = f()
+        finally:
+            y = 1
+        z = x + y
+        """,
+        ['f'], [])
+
+
+def test_del_and_comprehensions():
+    check_unassigned(
+        """
+        x = [i for i in range(3)]
+        del x
+        y = x + i
+        """,
+        [], ['x'])
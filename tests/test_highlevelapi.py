@@ -3,15 +3,19 @@ from __future__ import print_function
 import sys
 import ast
 import functools
+import threading
+import time
 
 import pytest
 
 from peval.core.function import Function
 from peval.tags import inline
-from peval import partial_apply
+from peval import (
+    partial_apply, specialize, specialize_on, specialization_cache, make_pass_manager,
+    default_pass_manager)
 from peval.tools import unindent
 
-from tests.utils import assert_ast_equal
+from tests.utils import assert_ast_equal, load_module
 
 
 def assert_func_equal_on(fn1, fn2, *args, **kwargs):
@@ -151,12 +155,361 @@ def test_if_on_recursive_power():
 
 def test_mutation_via_method():
 
-    # Currently mutation is not detected, so ``x.append``
-    # gets evaluated and replaced with ``None``.
-    pytest.xfail()
-
+    # ``x`` is not known after ``x.append`` is called
     def mutty(x, y):
         x.append('foo')
         return x + [y]
 
     check_partial_fn(mutty, lambda: dict(x=[1]), lambda: {'y': 2 })
+
+
+def test_created_containers():
+
+    def collect(x):
+        s = []
+        s.append(x)
+        return s
+
+    def count(x):
+        stack = []
+        stack.append(x)
+        return len(stack)
+
+    # Every call gets its own list
+    collect_specialized = partial_apply(collect)
+    assert collect_specialized(1) == [1]
+    assert collect_specialized(2) == [2]
+
+    assert partial_apply(count)(1) == 1
+
+
+def test_shadowed_global(tmpdir):
+
+    namespace = load_module(tmpdir, 'peval_shadowing_test_module', """
+        x = 5
+
+        def add(x, y):
+            return x + y
+        """)
+
+    # The parameter ``x`` hides the global one
+    add1 = partial_apply(namespace['add'], y=1)
+    assert add1(10) == 11
+
+
+def test_specialization_cache():
+
+    def scaled(a, x):
+        return a * x
+
+    specialization_cache.clear()
+
+    f1 = partial_apply(scaled, 2)
+    f2 = partial_apply(scaled, 2)
+    f3 = partial_apply(scaled, 3)
+
+    assert f1 is f2
+    assert f1 is not f3
+    assert f1(5) == 10
+    assert f3(5) == 15
+
+    info = specialization_cache.info()
+    assert info.hits == 1
+    assert info.misses == 2
+
+
+def test_specialization_cache_unhashable():
+
+    def scaled(a, x):
+        return a[0] * x
+
+    specialization_cache.clear()
+
+    f1 = partial_apply(scaled, [2])
+    f2 = partial_apply(scaled, [2])
+    assert f1 is not f2
+    assert f1(5) == f2(5) == 10
+    assert specialization_cache.info().uncacheable == 2
+
+
+@specialize_on('n', max_variants=3)
+def specialized_power(n, x):
+    v = 1
+    for _ in range(n):
+        v = v * x
+    return v
+
+
+def test_specialize_on():
+    specialized_power.variants.clear()
+
+    assert specialized_power(2, 3) == 9
+    assert specialized_power(2, x=4) == 16
+    assert specialized_power(n=3, x=2) == 8
+    assert len(specialized_power.variants) == 2
+
+    # The dispatcher is not replaced in globals by the specialization
+    assert globals()['specialized_power'] is specialized_power
+    assert specialized_power.__name__ == 'specialized_power'
+
+    # `n` is bound in the variants
+    for variant in specialized_power.variants.values():
+        assert variant(5) in (25, 125)
+
+
+def test_specialize_on_threads():
+    specialized_power.variants.clear()
+
+    results = {}
+    def worker(n):
+        results[n] = [specialized_power(n % 3, 2) for _ in range(20)]
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for n, values in results.items():
+        assert values == [2 ** (n % 3)] * 20
+    assert len(specialized_power.variants) == 3
+    assert globals()['specialized_power'] is specialized_power
+
+
+# A slow pass, so that the threads request the variants at the same time
+slow_pass_calls = []
+def slow_pass(tree, constants):
+    slow_pass_calls.append(tree.name)
+    time.sleep(0.01)
+    return tree, constants
+
+slow_pass_manager = make_pass_manager('O0')
+slow_pass_manager.register('slow', slow_pass)
+
+
+@specialize_on('n', max_variants=2, pass_manager=slow_pass_manager)
+def slowly_specialized_power(n, x):
+    return x ** n
+
+
+def test_specialize_on_concurrent_creation():
+    barrier = threading.Barrier(8)
+    results = {}
+    def worker(i):
+        barrier.wait()
+        results[i] = slowly_specialized_power(i % 4, 2)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == dict((i, 2 ** (i % 4)) for i in range(8))
+    # Every variant is created once, and the limit holds
+    assert len(slowly_specialized_power.variants) == 2
+    assert len(slow_pass_calls) == 2
+
+
+def test_specialize_on_megamorphic():
+    specialized_power.variants.clear()
+    generic_calls = specialized_power.get_generic_calls()
+
+    for n in range(5):
+        assert specialized_power(n, 2) == 2 ** n
+
+    assert len(specialized_power.variants) == 3
+    assert specialized_power.get_generic_calls() - generic_calls == 2
+
+
+def test_specialize_on_unhashable():
+
+    @specialize_on('seq')
+    def total(seq, x):
+        return sum(seq) + x
+
+    assert total([1, 2], 3) == 6
+    assert len(total.variants) == 0
+    assert total.get_generic_calls() == 1
+
+
+def test_specialize_on_defaults():
+
+    @specialize_on('b', 'a')
+    def combine(a, b=2, c=3):
+        return a * 100 + b * 10 + c
+
+    assert combine(1) == 123
+    assert combine(1, 4, 5) == 145
+    assert combine(1, c=6) == 126
+    assert len(combine.variants) == 2
+
+
+def test_specialize_on_varargs():
+
+    @specialize_on('n')
+    def collect(n, *args, **kwds):
+        return n, args, kwds
+
+    assert collect(2, 1, 2, a=3) == (2, (1, 2), dict(a=3))
+    assert collect(2) == (2, (), {})
+    assert len(collect.variants) == 1
+
+
+def test_specialize_on_wrong_name():
+    with pytest.raises(ValueError):
+        @specialize_on('y')
+        def f(x):
+            return x
+
+
+def test_optimization_levels():
+
+    def dummy(a, x):
+        if a:
+            return x
+        else:
+            return -x
+
+    o0 = make_pass_manager('O0')
+    f0 = specialize(dummy, kwds=dict(a=(1,)), pass_manager=o0)
+    assert f0(1) == 1
+    assert o0.last_report.iterations == 1
+    assert len(o0.last_report.passes) == 0
+
+    o1 = make_pass_manager('O1')
+    f1 = specialize(dummy, kwds=dict(a=(1,)), pass_manager=o1)
+    assert f1(1) == 1
+    assert f1 is not f0
+    report = o1.last_report
+    assert list(report.passes) == ['fold', 'prune_cfg', 'prune_assignments']
+    assert report.passes['prune_cfg'].node_delta < 0
+
+    # The experimental passes are opt-in
+    assert default_pass_manager.pass_names == [
+        'inline_functions', 'fold', 'prune_cfg', 'prune_assignments']
+    o3 = make_pass_manager('O3')
+    assert set(default_pass_manager.pass_names) < set(o3.pass_names)
+    assert 'unfold_loops' in o3.pass_names
+
+    with pytest.raises(ValueError):
+        make_pass_manager('O9')
+
+
+def test_pass_manager_cache_key():
+
+    def dummy(a, x):
+        return a + x
+
+    pm = make_pass_manager('O1')
+    f1 = specialize(dummy, args=(1,), pass_manager=pm)
+    assert specialize(dummy, args=(1,), pass_manager=pm) is f1
+
+    # Changing the configuration invalidates the cached specializations
+    pm.disable('fold')
+    assert specialize(dummy, args=(1,), pass_manager=pm) is not f1
+
+
+def test_async_function(tmpdir):
+
+    if sys.version_info < (3, 7):
+        pytest.skip()
+
+    import asyncio
+    import inspect
+
+    namespace = load_module(tmpdir, 'peval_async_test_module', """
+        async def numbers(n):
+            for i in range(n):
+                yield i
+
+        async def tick():
+            return 1
+
+        async def handler(n, scale, verbose):
+            total = 0
+            async for i in numbers(n):
+                total = total + i * scale
+            if verbose:
+                print(total)
+            ticks = [await tick() for _ in range(2)]
+            return total + sum(ticks) + sum([i async for i in numbers(n)])
+        """)
+    handler = namespace['handler']
+
+    new_handler = partial_apply(handler, scale=2, verbose=False)
+    assert inspect.iscoroutinefunction(new_handler)
+
+    function = Function.from_object(new_handler)
+    assert type(function.tree) == ast.AsyncFunctionDef
+    assert 'verbose' not in new_handler._peval_source
+
+    # The coroutine and async generator functions are not called during specialization,
+    # so the specialized function can be called several times.
+    for _ in range(2):
+        assert asyncio.run(new_handler(4)) == asyncio.run(handler(4, 2, False))
+
+
+def test_generator(tmpdir):
+
+    namespace = load_module(tmpdir, 'peval_generator_test_module', """
+        def gen(n, flag):
+            if flag:
+                yield n
+            x = yield n + 1
+            yield x
+
+        def maybe_gen(flag):
+            if flag:
+                yield 1
+        """)
+
+    check_partial_apply(
+        namespace['gen'], kwds=dict(flag=False),
+        expected_source="""
+            def gen(n):
+                x = yield n + 1
+                yield x
+            """)
+
+    g = partial_apply(namespace['gen'], flag=False)(1)
+    assert next(g) == 2
+    assert g.send(3) == 3
+
+    # If all the yields are eliminated, the function is still a generator
+    new_maybe_gen = partial_apply(namespace['maybe_gen'], False)
+    assert list(new_maybe_gen()) == []
+
+
+def test_newer_syntax(tmpdir):
+
+    if sys.version_info < (3, 10):
+        pytest.skip()
+
+    namespace = load_module(tmpdir, 'peval_newer_syntax_test_module', """
+        def f(point, scale, verbose):
+            x, y = point
+            x *= scale
+            match (x, y):
+                case (0, 0):
+                    result = 'origin'
+                case (0, _) | (_, 0):
+                    result = 'axis'
+                case _:
+                    result = 'plane'
+            if verbose:
+                print(result)
+            return result, x + y
+        """)
+    f = namespace['f']
+
+    new_f = partial_apply(f, scale=2, verbose=False)
+    assert 'verbose' not in new_f._peval_source
+    assert 'match' in new_f._peval_source
+
+    # The source of the specialized function can be parsed again
+    function = Function.from_object(new_f)
+    assert function.eval()._peval_source == new_f._peval_source
+
+    for point in ((0, 0), (0, 1), (1, 0), (2, 3)):
+        assert new_f(point) == f(point, 2, False)
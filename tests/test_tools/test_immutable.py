@@ -1,6 +1,6 @@
 import pytest
 
-from peval.tools import immutabledict, immutableadict, immutableset
+from peval.tools import immutabledict, immutableadict, immutableset, immutablechainmap
 
 
 # Immutable dictionary
@@ -278,3 +278,79 @@ def test_set_repr():
     ns = eval(repr(s))
     assert type(ns) == type(s)
     assert ns == s
+
+
+# Immutable chain map
+
+
+def test_chainmap_lookup():
+    top = dict(a=1)
+    bottom = dict(a=2, b=3)
+    m = immutablechainmap(top, bottom)
+
+    assert m['a'] == 1
+    assert m['b'] == 3
+    assert 'b' in m
+    assert 'c' not in m
+    assert m.get('c', 4) == 4
+    with pytest.raises(KeyError):
+        m['c']
+
+    assert sorted(m) == ['a', 'b']
+    assert len(m) == 2
+    assert m == dict(a=1, b=3)
+
+    # The layers are not copied
+    bottom['c'] = 5
+    assert m['c'] == 5
+
+
+def test_chainmap_set():
+    layer = dict(a=1)
+    m = immutablechainmap(layer)
+
+    nm = m.set('a', 1)
+    assert nm is m
+
+    nm = m.set('a', 2)
+    assert nm == dict(a=2)
+    assert m == dict(a=1)
+    assert layer == dict(a=1)
+    assert nm.overrides == dict(a=2)
+    assert m.overrides == dict()
+
+
+def test_chainmap_update():
+    layer = dict(a=1, b=2)
+    m = immutablechainmap(layer)
+
+    nm = m.update(dict(a=1), b=2)
+    assert nm is m
+
+    nm = m.update(dict(a=3), c=4)
+    assert type(nm) == immutablechainmap
+    assert nm == dict(a=3, b=2, c=4)
+    assert m == dict(a=1, b=2)
+    assert layer == dict(a=1, b=2)
+
+
+def test_chainmap_del():
+    layer = dict(a=1, b=2)
+    m = immutablechainmap(layer)
+
+    nm = m.del_('c')
+    assert nm is m
+
+    nm = m.del_('a')
+    assert nm == dict(b=2)
+    assert 'a' not in nm
+    assert nm.get('a') is None
+    assert layer == dict(a=1, b=2)
+
+    nm = nm.set('a', 3)
+    assert nm == dict(a=3, b=2)
+
+
+def test_chainmap_copy():
+    m = immutablechainmap(dict(a=1))
+    assert m.copy() is m
@@ -119,6 +119,31 @@ def test_change_node():
         """))
 
 
+def test_unchanged_identity():
+
+    @ast_transformer
+    def change_name(node, **kwds):
+        if isinstance(node, ast.Name) and node.id == 'a':
+            return ast.Name(id='b', ctx=node.ctx)
+        else:
+            return node
+
+    # Nothing to change - the same tree is returned
+    node = get_ast("""
+        def dummy(x, y):
+            c = 4
+            d = 1
+        """)
+    assert change_name(node) is node
+
+    # Unchanged subtrees are shared
+    node = get_ast(dummy)
+    new_node = change_name(node)
+    assert new_node is not node
+    assert new_node.body[0].args is node.body[0].args
+    assert new_node.body[0].body[0] is node.body[0].body[0]
+
+
 def test_add_statement():
 
     @ast_transformer
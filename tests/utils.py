@@ -2,11 +2,13 @@ from __future__ import print_function
 
 import ast
 import difflib
+import sys
 
 import astunparse
 
 from peval.tools import unindent, ast_equal
 from peval.core.function import Function
+from peval import specialize, make_pass_manager
 
 
 def ast_to_source(tree):
@@ -67,7 +69,7 @@ def check_component(component, func, additional_bindings=None,
     function = Function.from_object(func)
     bindings = function.get_external_variables()
     if additional_bindings is not None:
-        bindings.update(additional_bindings)
+        bindings = bindings.update(additional_bindings)
 
     new_tree, new_bindings = component(function.tree, bindings)
 
@@ -94,3 +96,24 @@ def check_component(component, func, additional_bindings=None,
                 assert list(binding) == list(expected_binding)
             else:
                 assert binding == expected_binding
+
+
+# A pass manager with all the passes enabled (including the opt-in ones)
+full_pass_manager = make_pass_manager('O3')
+
+
+def partial_apply_all(fn, *args, **kwds):
+    ''' Same as ``partial_apply()``, but with all the passes enabled.
+    '''
+    return specialize(fn, args, kwds, pass_manager=full_pass_manager)
+
+
+def load_module(tmpdir, name, source):
+    # For the syntax that is not available in all the supported Python versions,
+    # or for the functions that need their own module globals
+    path = str(tmpdir.join(name + '.py'))
+    with open(path, 'w') as f:
+        f.write(unindent(source))
+    namespace = dict(__name__=name)
+    exec(compile(unindent(source), path, 'exec'), namespace)
+    return namespace